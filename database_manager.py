@@ -52,6 +52,9 @@ class DatabaseManager:
             self._local.connection.row_factory = sqlite3.Row
             # 启用外键约束
             self._local.connection.execute("PRAGMA foreign_keys = ON")
+            # WAL模式下NORMAL同步即可保证一致性，减少每次提交的fsync
+            self._local.connection.execute("PRAGMA journal_mode = WAL")
+            self._local.connection.execute("PRAGMA synchronous = NORMAL")
         return self._local.connection
     
     @contextmanager
@@ -187,6 +190,12 @@ class DatabaseManager:
                 CREATE INDEX IF NOT EXISTS idx_usage_customer 
                 ON usage_records(customer_id)
             ''')
+            # 季度报告/账单按客户+日期范围查询，带上统计列使汇总和明细查询只读索引
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_usage_cust_date 
+                ON usage_records(customer_id, report_date, total_samples_loaded,
+                                 total_exports, total_splits, unique_samples)
+            ''')
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_invoices_customer 
                 ON invoices(customer_id)
@@ -319,6 +328,20 @@ class DatabaseManager:
             cursor = conn.execute(query, tuple(data.values()))
             return cursor.lastrowid
     
+    def insert_many(self, table: str, rows: List[Dict[str, Any]]) -> int:
+        """批量插入记录（所有记录需具有相同的字段，单个事务）"""
+        if not rows:
+            return 0
+        
+        keys = list(rows[0].keys())
+        columns = ', '.join(keys)
+        placeholders = ', '.join(['?' for _ in keys])
+        query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+        
+        with self.transaction() as conn:
+            cursor = conn.executemany(query, [tuple(row[k] for k in keys) for row in rows])
+            return cursor.rowcount
+    
     def update(self, table: str, data: Dict[str, Any], where: str, where_params: Tuple = ()) -> int:
         """更新记录"""
         set_clause = ', '.join([f"{k} = ?" for k in data.keys()])
@@ -440,6 +463,14 @@ class DatabaseManager:
         self.insert('invoices', invoice_data)
         return invoice_data['invoice_id']
     
+    def create_invoices(self, invoices: List[Dict[str, Any]]) -> List[str]:
+        """批量创建账单（管理员）"""
+        if self.mode != 'admin':
+            raise ValueError("此操作仅限管理员模式")
+        
+        self.insert_many('invoices', invoices)
+        return [invoice['invoice_id'] for invoice in invoices]
+    
     def get_invoice(self, invoice_id: str) -> Optional[Dict]:
         """获取账单（管理员）"""
         if self.mode != 'admin':
@@ -31,7 +31,7 @@ from PyQt5.QtGui import QIcon, QFont
 from pathlib import Path
 
 from data_loader import DataLoader
-from sample_comparison_dialog import SampleComparisonDialog
+from sample_comparison_dialog import SampleComparisonDialog, _nearest_mz_index
 from mass_calibration_manager import LockMassConfig, MassCalibrationManager
 from lock_mass_dialog import LockMassDialog
 from report_generator import ReportGenerator
@@ -228,6 +228,16 @@ class MetaboliteSearchDialog(QDialog):
             except Exception as e:
                 QMessageBox.warning(self, '错误', f'导出失败: {e}')
     
+    def done(self, result):
+        """关闭对话框时保存注释内存缓存并关闭数据库连接"""
+        if self.annotator is not None:
+            try:
+                self.annotator.close()
+            except Exception as e:
+                print(f"[警告] 关闭代谢物注释器失败: {e}")
+            self.annotator = None
+        super().done(result)
+    
     def show_cache_stats(self):
         """显示缓存统计信息"""
         if not self.use_enhanced or not hasattr(self.annotator, 'cache_db'):
@@ -340,7 +350,7 @@ class MultiIonComparisonDialog(QDialog):
             
             # 找到最接近的m/z
             mz_bins = self.data['mz_bins']
-            mz_index = np.argmin(np.abs(mz_bins - mz))
+            mz_index = _nearest_mz_index(mz_bins, mz)
             actual_mz = mz_bins[mz_index]
             
             intensities = self.data['intensity_matrix'][:, mz_index]
@@ -703,8 +713,8 @@ class IonTable(QTableWidget):
                             
                             print(f"[成功] 代谢物注释完成")
                             
-                            # 打印注释统计信息
-                            annotator.print_stats()
+                            # 打印注释统计信息，保存内存缓存并关闭数据库连接
+                            annotator.close()
                             
                             overall_progress.setValue(80)
                         
@@ -1163,7 +1173,7 @@ class ImagingCanvas(FigureCanvas):
         if mz_target is not None:
             # 找到最接近的m/z
             mz_bins = data['mz_bins']
-            self.current_mz_index = np.argmin(np.abs(mz_bins - mz_target))
+            self.current_mz_index = _nearest_mz_index(mz_bins, mz_target)
         
         mz = data['mz_bins'][self.current_mz_index]
         intensities = data['intensity_matrix'][:, self.current_mz_index]
@@ -2875,7 +2885,7 @@ class MainWindow(QMainWindow):
             except RuntimeError:
                 pass
             
-            splitter = MetaboliteSplitter(n_processes=n_processes, batch_size=50)
+            splitter = MetaboliteSplitter(n_processes=n_processes)
             
             # 进度对话框
             from PyQt5.QtWidgets import QProgressDialog
@@ -3029,7 +3039,7 @@ class MainWindow(QMainWindow):
             except RuntimeError:
                 pass
             
-            splitter = MetaboliteSplitter(n_processes=n_processes, batch_size=50)
+            splitter = MetaboliteSplitter(n_processes=n_processes)
             
             # 进度对话框
             from PyQt5.QtWidgets import QProgressDialog
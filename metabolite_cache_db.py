@@ -7,6 +7,7 @@
 
 import sqlite3
 import json
+from contextlib import contextmanager
 from pathlib import Path
 from typing import List, Dict, Optional
 from datetime import datetime
@@ -29,11 +30,15 @@ class MetaboliteCacheDB:
         self.conn = None
         self.cursor = None
         
+        # 事务嵌套深度：>0 时写操作不单独提交，由最外层 transaction() 统一提交
+        self._transaction_depth = 0
+        
         self._init_database()
     
     def _init_database(self):
         """初始化数据库表结构"""
-        self.conn = sqlite3.connect(self.db_path)
+        # 允许跨线程使用同一连接（OnlineMetaboliteAnnotator 在锁内串行访问）
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
         
         # 创建注释缓存表
@@ -68,6 +73,22 @@ class MetaboliteCacheDB:
             ON annotation_cache(mz, ion_mode)
         ''')
         
+        # 创建无匹配查询表：记录已确认在容差内没有任何匹配的查询，重启后无需重新检索
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS empty_queries (
+                mz REAL NOT NULL,
+                tolerance_ppm REAL NOT NULL,
+                ion_mode TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(mz, tolerance_ppm, ion_mode)
+            )
+        ''')
+        
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_empty_mode_mz
+            ON empty_queries(ion_mode, mz)
+        ''')
+        
         # 创建统计信息表
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS cache_stats (
@@ -92,7 +113,7 @@ class MetaboliteCacheDB:
         print(f"[成功] 代谢物缓存数据库已初始化: {self.db_path}")
     
     def query_cache(self, mz: float, tolerance_ppm: float, 
-                   ion_mode: str) -> List[Dict]:
+                   ion_mode: str) -> Optional[List[Dict]]:
         """
         从缓存查询注释结果
         
@@ -102,7 +123,7 @@ class MetaboliteCacheDB:
             ion_mode: 离子模式
         
         返回:
-            匹配的代谢物列表
+            匹配的代谢物列表；已记录为无匹配时返回空列表，缓存中没有信息时返回None
         """
         # 计算搜索范围
         mz_min = mz * (1 - tolerance_ppm / 1e6)
@@ -145,13 +166,126 @@ class MetaboliteCacheDB:
                     'source': row[13] + ' (cached)'
                 })
         
+        # 同一代谢物可能由不同的测量m/z各缓存了一行：按当前误差排序后按名称去重
+        results.sort(key=lambda x: x['error_ppm'])
+        seen_names = set()
+        results = [r for r in results
+                   if not (r['name'] in seen_names or seen_names.add(r['name']))]
+        
+        if not results and self._is_known_empty(mz, tolerance_ppm, ion_mode):
+            self._update_stats(cache_hit=True)
+            return []
+        
         # 更新统计信息
         if results:
             self._update_stats(cache_hit=True)
         else:
             self._update_stats(cache_hit=False)
         
-        return results
+        return results or None
+    
+    _INSERT_ANNOTATION_SQL = '''
+        INSERT OR REPLACE INTO annotation_cache
+        (mz, tolerance_ppm, ion_mode, metabolite_name, formula,
+         hmdb_id, molecular_weight, cas_number, kegg_id,
+         kingdom, super_class, class, sub_class,
+         theoretical_mz, error_ppm, error_da, source)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    @staticmethod
+    def _annotation_row(mz: float, tolerance_ppm: float,
+                        ion_mode: str, annotation: Dict) -> tuple:
+        """将注释结果字典转换为 annotation_cache 表的一行"""
+        return (
+            mz,
+            tolerance_ppm,
+            ion_mode,
+            annotation.get('name', ''),
+            annotation.get('formula', ''),
+            annotation.get('hmdb_id', ''),
+            annotation.get('molecular_weight', 0),
+            annotation.get('cas_number', ''),
+            annotation.get('kegg_id', ''),
+            annotation.get('kingdom', ''),
+            annotation.get('super_class', ''),
+            annotation.get('class', ''),
+            annotation.get('sub_class', ''),
+            annotation.get('theoretical_mz', 0),
+            annotation.get('error_ppm', 0),
+            annotation.get('error_da', 0),
+            annotation.get('source', 'Unknown')
+        )
+    
+    def _commit(self):
+        """提交当前写操作；处于 transaction() 内时推迟到事务结束"""
+        if self._transaction_depth == 0:
+            self.conn.commit()
+    
+    @contextmanager
+    def transaction(self):
+        """
+        将多次写操作合并为一个事务
+        
+        可以嵌套，只有最外层结束时才提交；发生异常时回滚。
+        
+        用法:
+            with cache_db.transaction():
+                cache_db.add_annotations(...)
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.conn.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.conn.commit()
+    
+    def checkpoint(self):
+        """在长事务中途提交已写入的数据，限制日志文件大小"""
+        self.conn.commit()
+    
+    def _is_known_empty(self, mz: float, tolerance_ppm: float, ion_mode: str) -> bool:
+        """
+        查询窗口是否被某条无匹配记录完全覆盖
+        
+        记录 (M, T) 表示 M±T ppm 内没有匹配；当前窗口 mz±tolerance_ppm 落在其中时同样没有匹配。
+        """
+        self.cursor.execute('''
+            SELECT mz, tolerance_ppm
+            FROM empty_queries
+            WHERE ion_mode = ?
+              AND mz >= ?
+              AND mz <= ?
+              AND tolerance_ppm >= ?
+        ''', (ion_mode, mz * (1 - tolerance_ppm / 1e6), mz * (1 + tolerance_ppm / 1e6),
+              tolerance_ppm))
+        
+        for empty_mz, empty_tolerance in self.cursor.fetchall():
+            if abs(mz - empty_mz) / empty_mz * 1e6 + tolerance_ppm <= empty_tolerance:
+                return True
+        return False
+    
+    def mark_empty(self, mz: float, tolerance_ppm: float, ion_mode: str):
+        """
+        记录一次无匹配的查询，之后 query_cache 对被其覆盖的查询返回空列表
+        
+        参数:
+            mz: m/z值
+            tolerance_ppm: 误差容忍度
+            ion_mode: 离子模式
+        """
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO empty_queries (mz, tolerance_ppm, ion_mode)
+            VALUES (?, ?, ?)
+        ''', (mz, tolerance_ppm, ion_mode))
+        
+        self._commit()
     
     def add_annotation(self, mz: float, tolerance_ppm: float, 
                       ion_mode: str, annotation: Dict):
@@ -164,35 +298,26 @@ class MetaboliteCacheDB:
             ion_mode: 离子模式
             annotation: 注释结果字典
         """
+        self.add_annotations(mz, tolerance_ppm, ion_mode, [annotation])
+    
+    def add_annotations(self, mz: float, tolerance_ppm: float,
+                        ion_mode: str, annotations: List[Dict]):
+        """
+        添加同一m/z的多条注释结果（一次 executemany，一次提交）
+        
+        参数:
+            mz: m/z值
+            tolerance_ppm: 误差容忍度
+            ion_mode: 离子模式
+            annotations: 注释结果字典列表
+        """
         try:
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO annotation_cache
-                (mz, tolerance_ppm, ion_mode, metabolite_name, formula,
-                 hmdb_id, molecular_weight, cas_number, kegg_id,
-                 kingdom, super_class, class, sub_class,
-                 theoretical_mz, error_ppm, error_da, source)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                mz,
-                tolerance_ppm,
-                ion_mode,
-                annotation.get('name', ''),
-                annotation.get('formula', ''),
-                annotation.get('hmdb_id', ''),
-                annotation.get('molecular_weight', 0),
-                annotation.get('cas_number', ''),
-                annotation.get('kegg_id', ''),
-                annotation.get('kingdom', ''),
-                annotation.get('super_class', ''),
-                annotation.get('class', ''),
-                annotation.get('sub_class', ''),
-                annotation.get('theoretical_mz', 0),
-                annotation.get('error_ppm', 0),
-                annotation.get('error_da', 0),
-                annotation.get('source', 'Unknown')
-            ))
+            self.cursor.executemany(self._INSERT_ANNOTATION_SQL, [
+                self._annotation_row(mz, tolerance_ppm, ion_mode, annotation)
+                for annotation in annotations
+            ])
             
-            self.conn.commit()
+            self._commit()
         except sqlite3.IntegrityError:
             # 如果已存在相同记录，忽略
             pass
@@ -204,8 +329,15 @@ class MetaboliteCacheDB:
         参数:
             annotations: [(mz, tolerance_ppm, ion_mode, annotation_dict), ...]
         """
-        for mz, tolerance_ppm, ion_mode, annotation in annotations:
-            self.add_annotation(mz, tolerance_ppm, ion_mode, annotation)
+        try:
+            self.cursor.executemany(self._INSERT_ANNOTATION_SQL, [
+                self._annotation_row(mz, tolerance_ppm, ion_mode, annotation)
+                for mz, tolerance_ppm, ion_mode, annotation in annotations
+            ])
+            
+            self._commit()
+        except sqlite3.IntegrityError:
+            pass
     
     def _update_stats(self, cache_hit: bool = True):
         """更新统计信息"""
@@ -225,7 +357,7 @@ class MetaboliteCacheDB:
                     last_updated = CURRENT_TIMESTAMP
                 WHERE id = 1
             ''')
-        self.conn.commit()
+        self._commit()
     
     def get_stats(self) -> Dict:
         """获取缓存统计信息"""
@@ -283,31 +415,34 @@ class MetaboliteCacheDB:
         
         df = pd.read_csv(csv_file)
         
+        # 按列取出数组后逐行组装参数，避免 iterrows 为每行构造 Series
+        rows = list(zip(
+            df['mz'].tolist(),
+            [10.0] * len(df),  # 默认容忍度
+            df['ion_mode'].tolist(),
+            df['metabolite_name'].tolist(),
+            df['formula'].tolist(),
+            df['hmdb_id'].tolist(),
+            df['theoretical_mz'].tolist(),
+            df['error_ppm'].tolist(),
+            [0.0] * len(df),  # error_da可从其他列计算
+            df['source'].tolist()
+        ))
+        
         count = 0
-        for _, row in df.iterrows():
+        for row in rows:
             try:
                 self.cursor.execute('''
                     INSERT OR REPLACE INTO annotation_cache
                     (mz, tolerance_ppm, ion_mode, metabolite_name, formula,
                      hmdb_id, theoretical_mz, error_ppm, error_da, source)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    row['mz'],
-                    10.0,  # 默认容忍度
-                    row['ion_mode'],
-                    row['metabolite_name'],
-                    row['formula'],
-                    row['hmdb_id'],
-                    row['theoretical_mz'],
-                    row['error_ppm'],
-                    0.0,  # error_da可从其他列计算
-                    row['source']
-                ))
+                ''', row)
                 count += 1
             except Exception as e:
                 print(f"[警告] 导入失败 (行{count}): {e}")
         
-        self.conn.commit()
+        self._commit()
         print(f"[成功] 已从CSV导入 {count} 条记录")
     
     def clear_old_cache(self, days: int = 365):
@@ -318,6 +453,12 @@ class MetaboliteCacheDB:
         ''', (days,))
         
         deleted = self.cursor.rowcount
+        
+        self.cursor.execute('''
+            DELETE FROM empty_queries
+            WHERE created_at < datetime('now', '-' || ? || ' days')
+        ''', (days,))
+        
         self.conn.commit()
         
         print(f"[成功] 已清除 {deleted} 条超过{days}天的缓存记录")
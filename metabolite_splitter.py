@@ -9,13 +9,88 @@
 import pandas as pd
 import numpy as np
 import os
+import gc
 import zipfile
 import time
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import multiprocessing
 from typing import Optional, Callable, List, Dict
 
+# Excel读取引擎（可选，Rust实现，比openpyxl快一个数量级）
+try:
+    import python_calamine
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+
+# Parquet缓存（可选）
+try:
+    import pyarrow
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# 限制子进程内BLAS/OpenMP线程数（可选）
+try:
+    import threadpoolctl
+    HAS_THREADPOOLCTL = True
+except ImportError:
+    HAS_THREADPOOLCTL = False
+
+# JIT加速（可选）
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def scatter_batch(yi, xi, values, out):
+        """
+        将一批物质的强度按坐标索引写入二维矩阵
+        
+        仅在子进程中调用，每个子进程单线程运行，因此编译为串行循环；
+        不在导入时预热，编译结果由 cache=True 缓存到磁盘。
+        
+        参数:
+            yi, xi: 每个扫描点的行/列索引 (N,)
+            values: 强度 (B, N)
+            out: 输出缓冲区 (B, ny, nx)
+        """
+        B, N = values.shape
+        for b in range(B):
+            for k in range(N):
+                out[b, yi[k], xi[k]] = values[b, k]
+else:
+    def scatter_batch(yi, xi, values, out):
+        """将一批物质的强度按坐标索引写入二维矩阵（NumPy实现）"""
+        out[:, yi, xi] = values
+
+
+def _worker_init(pin_cpu: bool = False):
+    """
+    子进程初始化：每个进程只用1个计算线程，避免 进程数 × BLAS线程数 超额订阅CPU
+    
+    参数:
+        pin_cpu: 是否将第i个子进程绑定到第i个可用CPU核（仅Linux）
+    """
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = '1'
+    
+    if HAS_THREADPOOLCTL:
+        threadpoolctl.threadpool_limits(1)
+    
+    if pin_cpu and hasattr(os, 'sched_setaffinity'):
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+            worker_index = multiprocessing.current_process()._identity[0] - 1
+            os.sched_setaffinity(0, {cpus[worker_index % len(cpus)]})
+        except (OSError, IndexError):
+            pass
+
 
 def process_metabolite_batch(args):
     """
@@ -49,19 +124,59 @@ def process_metabolite_batch(args):
     return results
 
 
+def process_metabolite_matrix_batch(args):
+    """
+    处理一批物质（子进程函数，内存数据路径）
+    
+    参数:
+        args: (yi, xi, y_values, x_values, values, metabolite_names, sample_output_dir) 元组，
+              yi/xi 为主进程因子化得到的每个扫描点的行/列索引，
+              values 为该批次的二维强度切片 (n_scans × batch)
+    """
+    yi, xi, y_values, x_values, values, metabolite_names, sample_output_dir = args
+    pid = os.getpid()
+    results = []
+    
+    # 一次性将整批强度写入 (B, ny, nx) 矩阵 (Y为行，X为列)，未覆盖的位置为NaN
+    dtype = np.result_type(values.dtype, np.float32)
+    matrices = np.full((len(metabolite_names), len(y_values), len(x_values)),
+                       np.nan, dtype=dtype)
+    scatter_batch(yi, xi, np.asarray(values, dtype=dtype).T, matrices)
+    
+    index = pd.Index(y_values, name='Y_mm')
+    columns = pd.Index(x_values, name='X_mm')
+    
+    for j, metabolite_name in enumerate(metabolite_names):
+        try:
+            matrix_df = pd.DataFrame(matrices[j], index=index, columns=columns)
+            
+            # 保存
+            output_file = Path(sample_output_dir) / f"{metabolite_name}.csv"
+            matrix_df.to_csv(output_file)
+            
+            results.append((True, metabolite_name, pid))
+        except Exception as e:
+            results.append((False, f"mz_{metabolite_name}: {e}", pid))
+    
+    return results
+
+
 class MetaboliteSplitter:
     """代谢物数据拆分器"""
     
-    def __init__(self, n_processes: int = 4, batch_size: int = 50):
+    def __init__(self, n_processes: int = 4, batch_size: Optional[int] = None,
+                 pin_cpu: bool = False):
         """
         初始化拆分器
         
         参数:
             n_processes: 并行进程数
-            batch_size: 每批处理的物质数
+            batch_size: 每批处理的物质数上限；None 表示按进程数自动确定
+            pin_cpu: 是否将每个子进程绑定到单独的CPU核（仅Linux）
         """
         self.n_processes = n_processes
         self.batch_size = batch_size
+        self.pin_cpu = pin_cpu
         self.stats = {
             'total_processed': 0,
             'success_count': 0,
@@ -69,17 +184,118 @@ class MetaboliteSplitter:
             'total_time': 0
         }
     
+    def _create_executor(self) -> ProcessPoolExecutor:
+        """
+        创建进程池
+        
+        使用spawn启动方式，子进程不继承主进程的内存与已启动的线程池；
+        并由初始化函数将每个子进程限制为单线程计算。
+        """
+        return ProcessPoolExecutor(
+            max_workers=self.n_processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_worker_init,
+            initargs=(self.pin_cpu,)
+        )
+    
+    def _effective_batch_size(self, n_metabolites: int) -> int:
+        """
+        根据物质数与进程数确定批大小
+        
+        每个进程约分到4批：既能在进程间均衡负载、减少最后一批的拖尾，
+        又能让每批的序列化开销得到摊薄。
+        """
+        auto_size = max(1, n_metabolites // (self.n_processes * 4))
+        if self.batch_size is None:
+            return auto_size
+        return max(1, min(self.batch_size, auto_size))
+    
+    def _read_table(self, excel_file: str, convert_to_parquet_cache: bool = False) -> pd.DataFrame:
+        """
+        读取二维空间格式的数据表（Excel或CSV）
+        
+        若同目录下存在不旧于源文件的同名 .parquet 缓存则直接读取缓存；
+        否则CSV用C解析器一次读入，Excel优先使用 calamine 引擎读取，
+        并可选地写入Parquet缓存供下次使用。
+        """
+        excel_path = Path(excel_file)
+        parquet_file = excel_path.with_suffix('.parquet')
+        
+        if (HAS_PYARROW and parquet_file.exists()
+                and parquet_file.stat().st_mtime >= excel_path.stat().st_mtime):
+            return pd.read_parquet(parquet_file)
+        
+        if excel_path.suffix.lower() == '.csv':
+            df = pd.read_csv(excel_file, engine='c')
+        elif HAS_CALAMINE:
+            df = pd.read_excel(excel_file, engine='calamine')
+        else:
+            df = pd.read_excel(excel_file)
+        
+        if convert_to_parquet_cache and HAS_PYARROW:
+            try:
+                df.to_parquet(parquet_file, index=False)
+            except Exception as e:
+                print(f"[警告] 写入Parquet缓存失败: {e}")
+        
+        return df
+    
+    def _read_header(self, table_file: str) -> List[str]:
+        """读取Feather文件的列名（不读取数据）"""
+        import pyarrow.ipc
+        with pyarrow.ipc.open_file(table_file) as reader:
+            return list(reader.schema.names)
+    
+    def _read_columns(self, table_file: str, columns: List[str]) -> pd.DataFrame:
+        """只读取Feather文件中的指定列"""
+        return pd.read_feather(table_file, columns=columns)
+    
+    def _iter_streaming_tasks(self, table_file: str, coords: Dict, mz_cols: List[str],
+                              batch_size: int, sample_output_dir: str):
+        """
+        按列组流式生成拆分任务，逐个产出 (批次列名, 任务)
+        
+        每次从Feather文件读取 n_processes 个批次的m/z列（列式存储，只读取所需列），
+        生成任务后即释放，内存占用与列组大小成正比而与总列数无关。
+        某个列组读取失败时，其各批次的任务为None，由调用方计为失败。
+        """
+        group_size = batch_size * self.n_processes
+        
+        for start in range(0, len(mz_cols), group_size):
+            group_cols = mz_cols[start:start+group_size]
+            try:
+                group_df = self._read_columns(table_file, group_cols)
+            except Exception as e:
+                print(f"[错误] 读取列组失败 ({group_cols[0]} 等 {len(group_cols)} 列): {e}")
+                group_df = None
+            
+            for i in range(0, len(group_cols), batch_size):
+                batch_cols = group_cols[i:i+batch_size]
+                if group_df is None:
+                    yield batch_cols, None
+                    continue
+                batch_data = dict(coords)
+                for col in batch_cols:
+                    batch_data[col] = group_df[col].to_numpy()
+                yield batch_cols, (batch_data, batch_cols, sample_output_dir)
+            
+            del group_df
+    
     def split_from_excel(self, excel_file: str, output_dir: str,
                          progress_callback: Optional[Callable] = None,
-                         create_archive: bool = True) -> Dict:
+                         create_archive: bool = True,
+                         convert_to_parquet_cache: bool = False) -> Dict:
         """
         从Excel文件拆分代谢物数据
         
         参数:
-            excel_file: 输入的Excel文件路径（二维空间格式）
+            excel_file: 输入的Excel文件路径（二维空间格式）；
+                        也支持 .csv（一次读入，可写Parquet缓存）和
+                        .feather（按列组流式读取）
             output_dir: 输出目录
             progress_callback: 进度回调函数 callback(current, total, message)
             create_archive: 是否创建zip压缩包
+            convert_to_parquet_cache: 是否在Excel旁写入Parquet缓存，加速下次读取
         
         返回:
             处理结果字典
@@ -105,14 +321,21 @@ class MetaboliteSplitter:
         if progress_callback:
             progress_callback(0, 100, f"正在读取文件: {Path(excel_file).name}")
         
+        # Feather按列组流式读取，不一次性载入整张表
+        streaming = Path(excel_file).suffix.lower() == '.feather'
+        
         try:
-            df = pd.read_excel(excel_file)
+            if streaming:
+                columns = self._read_header(excel_file)
+            else:
+                df = self._read_table(excel_file, convert_to_parquet_cache)
+                columns = list(df.columns)
         except Exception as e:
             result['error'] = f"读取文件失败: {e}"
             return result
         
         # 识别物质列
-        mz_cols = [col for col in df.columns if col.startswith('mz_')]
+        mz_cols = [col for col in columns if col.startswith('mz_')]
         
         if not mz_cols:
             result['error'] = "未找到m/z数据列（需要以'mz_'开头的列）"
@@ -124,21 +347,37 @@ class MetaboliteSplitter:
             progress_callback(10, 100, f"找到 {len(mz_cols)} 个代谢物，准备拆分...")
         
         # 检查必需的坐标列
-        if 'X_mm' not in df.columns or 'Y_mm' not in df.columns:
+        if 'X_mm' not in columns or 'Y_mm' not in columns:
             result['error'] = "缺少坐标列（需要X_mm和Y_mm列）"
             return result
         
-        # 转换为字典格式
-        data_dict = {col: df[col].values for col in ['X_mm', 'Y_mm'] + mz_cols}
-        
-        # 分批处理
-        tasks = []
-        for i in range(0, len(mz_cols), self.batch_size):
-            batch_cols = mz_cols[i:i+self.batch_size]
-            batch_data = {'X_mm': data_dict['X_mm'], 'Y_mm': data_dict['Y_mm']}
-            for col in batch_cols:
-                batch_data[col] = data_dict[col]
-            tasks.append((batch_data, batch_cols, str(sample_output_dir)))
+        batch_size = self._effective_batch_size(len(mz_cols))
+        result['batch_size'] = batch_size
+        
+        if streaming:
+            try:
+                coords_df = self._read_columns(excel_file, ['X_mm', 'Y_mm'])
+            except Exception as e:
+                result['error'] = f"读取文件失败: {e}"
+                return result
+            coords = {col: coords_df[col].to_numpy() for col in ['X_mm', 'Y_mm']}
+            del coords_df
+            tasks = self._iter_streaming_tasks(excel_file, coords, mz_cols, batch_size,
+                                               str(sample_output_dir))
+        else:
+            # 转换为字典格式（不复制列数据），随后释放DataFrame，降低创建进程池时的峰值内存
+            data_dict = {col: df[col].to_numpy(copy=False) for col in ['X_mm', 'Y_mm'] + mz_cols}
+            del df
+            gc.collect()
+            
+            # 分批处理
+            tasks = []
+            for i in range(0, len(mz_cols), batch_size):
+                batch_cols = mz_cols[i:i+batch_size]
+                batch_data = {'X_mm': data_dict['X_mm'], 'Y_mm': data_dict['Y_mm']}
+                for col in batch_cols:
+                    batch_data[col] = data_dict[col]
+                tasks.append((batch_cols, (batch_data, batch_cols, str(sample_output_dir))))
         
         # 多进程处理
         success_count = 0
@@ -146,30 +385,49 @@ class MetaboliteSplitter:
         completed_count = 0
         
         if progress_callback:
-            progress_callback(15, 100, f"开始多进程拆分 ({self.n_processes} 进程)...")
+            progress_callback(15, 100, f"开始多进程拆分 ({self.n_processes} 进程, 每批 {batch_size} 个)...")
         
-        with ProcessPoolExecutor(max_workers=self.n_processes) as executor:
-            futures = [executor.submit(process_metabolite_batch, task) for task in tasks]
-            
-            for future in as_completed(futures):
-                try:
-                    batch_results = future.result()
+        def collect(future, n_batch):
+            nonlocal success_count, error_count, completed_count
+            try:
+                batch_results = future.result()
+                
+                for success, msg, pid in batch_results:
+                    completed_count += 1
+                    if success:
+                        success_count += 1
+                    else:
+                        error_count += 1
                     
-                    for success, msg, pid in batch_results:
-                        completed_count += 1
-                        if success:
-                            success_count += 1
-                        else:
-                            error_count += 1
-                        
-                        # 更新进度 (15-85%)
-                        if progress_callback:
-                            progress = 15 + int((completed_count / len(mz_cols)) * 70)
-                            progress_callback(progress, 100, 
-                                f"拆分进度: {completed_count}/{len(mz_cols)} ({completed_count/len(mz_cols)*100:.1f}%)")
+                    # 更新进度 (15-85%)
+                    if progress_callback:
+                        progress = 15 + int((completed_count / len(mz_cols)) * 70)
+                        progress_callback(progress, 100, 
+                            f"拆分进度: {completed_count}/{len(mz_cols)} ({completed_count/len(mz_cols)*100:.1f}%)")
+            
+            except Exception as e:
+                error_count += n_batch
+        
+        # 限制在途批次数：流式读取时内存中只保留约两组列数据
+        max_pending = self.n_processes * 2
+        
+        with self._create_executor() as executor:
+            futures = {}
+            for batch_cols, task in tasks:
+                if task is None:
+                    # 数据读取失败的批次与子进程出错的批次一样计入失败数
+                    error_count += len(batch_cols)
+                    completed_count += len(batch_cols)
+                    continue
+                futures[executor.submit(process_metabolite_batch, task)] = len(batch_cols)
                 
-                except Exception as e:
-                    error_count += self.batch_size
+                if len(futures) >= max_pending:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future, futures.pop(future))
+            
+            for future in as_completed(futures):
+                collect(future, futures[future])
         
         result['success_count'] = success_count
         result['error_count'] = error_count
@@ -239,11 +497,14 @@ class MetaboliteSplitter:
         
         # 选择要导出的m/z
         if max_mz and max_mz < len(mz_bins):
-            # 按平均强度排序，选择Top N
-            mean_intensity = np.mean(intensity_matrix, axis=0)
-            sorted_indices = np.argsort(mean_intensity)[::-1][:max_mz]
-            selected_mz = [mz_bins[i] for i in sorted_indices]
-            selected_intensity = intensity_matrix[:, sorted_indices]
+            # 按总强度（与平均强度排序一致）选择Top N：先O(n)分区，再只对N个排序
+            total_intensity = np.sum(intensity_matrix, axis=0)
+            top_indices = np.argpartition(-total_intensity, max_mz)[:max_mz]
+            sorted_indices = top_indices[np.argsort(-total_intensity[top_indices])]
+            selected_mz = np.asarray(mz_bins)[sorted_indices]
+            # 直接按列取到预分配的float32缓冲区，避免花式索引先生成一份float64副本
+            selected_intensity = np.empty((intensity_matrix.shape[0], max_mz), dtype=np.float32)
+            np.take(intensity_matrix, sorted_indices, axis=1, out=selected_intensity)
         else:
             selected_mz = mz_bins
             selected_intensity = intensity_matrix
@@ -253,26 +514,23 @@ class MetaboliteSplitter:
         if progress_callback:
             progress_callback(10, 100, f"准备拆分 {len(selected_mz)} 个代谢物...")
         
-        # 构建数据字典
-        data_dict = {
-            'X_mm': coords[:, 0],
-            'Y_mm': coords[:, 1]
-        }
+        # 物质名称；强度保持为二维数组，按列切片分批传给子进程
+        metabolite_names = [f"{mz:.4f}" for mz in selected_mz]
+        n_metabolites = len(metabolite_names)
         
-        mz_cols = []
-        for i, mz in enumerate(selected_mz):
-            col_name = f"mz_{mz:.4f}"
-            data_dict[col_name] = selected_intensity[:, i]
-            mz_cols.append(col_name)
+        # 坐标只因子化一次，子进程直接按索引写入，不再构建DataFrame做pivot
+        x_values, xi = np.unique(coords[:, 0], return_inverse=True)
+        y_values, yi = np.unique(coords[:, 1], return_inverse=True)
+        xi = xi.astype(np.int64)
+        yi = yi.astype(np.int64)
         
         # 分批处理
+        batch_size = self._effective_batch_size(n_metabolites)
+        result['batch_size'] = batch_size
         tasks = []
-        for i in range(0, len(mz_cols), self.batch_size):
-            batch_cols = mz_cols[i:i+self.batch_size]
-            batch_data = {'X_mm': data_dict['X_mm'], 'Y_mm': data_dict['Y_mm']}
-            for col in batch_cols:
-                batch_data[col] = data_dict[col]
-            tasks.append((batch_data, batch_cols, str(sample_output_dir)))
+        for i in range(0, n_metabolites, batch_size):
+            tasks.append((yi, xi, y_values, x_values, selected_intensity[:, i:i+batch_size],
+                          metabolite_names[i:i+batch_size], str(sample_output_dir)))
         
         # 多进程处理
         success_count = 0
@@ -280,10 +538,11 @@ class MetaboliteSplitter:
         completed_count = 0
         
         if progress_callback:
-            progress_callback(15, 100, f"开始多进程拆分...")
+            progress_callback(15, 100, f"开始多进程拆分 (每批 {batch_size} 个)...")
         
-        with ProcessPoolExecutor(max_workers=self.n_processes) as executor:
-            futures = [executor.submit(process_metabolite_batch, task) for task in tasks]
+        with self._create_executor() as executor:
+            futures = {executor.submit(process_metabolite_matrix_batch, task): len(task[5])
+                       for task in tasks}
             
             for future in as_completed(futures):
                 try:
@@ -297,12 +556,12 @@ class MetaboliteSplitter:
                             error_count += 1
                         
                         if progress_callback:
-                            progress = 15 + int((completed_count / len(mz_cols)) * 70)
+                            progress = 15 + int((completed_count / n_metabolites) * 70)
                             progress_callback(progress, 100, 
-                                f"拆分进度: {completed_count}/{len(mz_cols)}")
+                                f"拆分进度: {completed_count}/{n_metabolites}")
                 
                 except Exception as e:
-                    error_count += self.batch_size
+                    error_count += futures[future]
         
         result['success_count'] = success_count
         result['error_count'] = error_count
@@ -343,7 +602,8 @@ class MetaboliteSplitter:
     
     def batch_split_from_excel(self, excel_files: List[str], output_dir: str,
                                progress_callback: Optional[Callable] = None,
-                               create_archives: bool = True) -> List[Dict]:
+                               create_archives: bool = True,
+                               convert_to_parquet_cache: bool = False) -> List[Dict]:
         """
         批量处理多个Excel文件
         
@@ -352,6 +612,7 @@ class MetaboliteSplitter:
             output_dir: 输出目录
             progress_callback: 进度回调 callback(current_file, total_files, file_progress, message)
             create_archives: 是否创建压缩包
+            convert_to_parquet_cache: 是否为每个Excel文件写入Parquet缓存
         
         返回:
             处理结果列表
@@ -367,7 +628,8 @@ class MetaboliteSplitter:
             result = self.split_from_excel(
                 excel_file, output_dir,
                 progress_callback=file_progress,
-                create_archive=create_archives
+                create_archive=create_archives,
+                convert_to_parquet_cache=convert_to_parquet_cache
             )
             results.append(result)
         
@@ -385,7 +647,7 @@ if __name__ == "__main__":
     multiprocessing.freeze_support()
     
     # 测试单文件处理
-    splitter = MetaboliteSplitter(n_processes=4, batch_size=50)
+    splitter = MetaboliteSplitter(n_processes=4)
     
     test_file = "/Volumes/US100 256G/results/test_sample.xlsx"
     output_dir = "/Volumes/US100 256G/results/split_test"
@@ -5,7 +5,9 @@ m/z偏差合并算法
 将偏差范围内的m/z识别为同一物质
 """
 
+import heapq
 import numpy as np
+from scipy import sparse
 from scipy.cluster.hierarchy import linkage, fcluster
 import logging
 
@@ -16,7 +18,7 @@ class MzMerger:
     """m/z合并器"""
     
     def __init__(self, tolerance_ppm=10, tolerance_da=None, 
-                 merge_method='weighted_mean'):
+                 merge_method='weighted_mean', dtype=np.float32):
         """
         初始化m/z合并器
         
@@ -28,13 +30,18 @@ class MzMerger:
             绝对容差（Da），如果指定则优先使用
         merge_method : str
             合并方法: 'mean', 'weighted_mean', 'median'
+        dtype : numpy dtype
+            数据集强度矩阵的计算精度（默认float32）。质谱强度在bin求和尺度上
+            不需要float64的动态范围，float32可减半内存带宽；需要时可传入np.float64
         """
         self.tolerance_ppm = tolerance_ppm
         self.tolerance_da = tolerance_da
         self.merge_method = merge_method
+        self.dtype = np.dtype(dtype)
         
         # 合并历史
         self.merge_groups = []
+        self._stats_cache = {}
     
     def calculate_tolerance(self, mz):
         """
@@ -59,6 +66,8 @@ class MzMerger:
         """
         合并相近的m/z值
         
+        排序后相邻m/z之差不超过容差（ppm容差按较小的m/z计算）即归为同一组。
+        
         Parameters:
         -----------
         mz_values : array
@@ -78,11 +87,11 @@ class MzMerger:
                 'merge_info': list         # 详细的合并信息
             }
         """
-        mz_values = np.array(mz_values)
+        mz_values = np.asarray(mz_values, dtype=float)
         n = len(mz_values)
         
         if intensities is not None:
-            intensities = np.array(intensities)
+            intensities = np.asarray(intensities, dtype=float)
         else:
             intensities = np.ones(n)
         
@@ -91,87 +100,89 @@ class MzMerger:
         sorted_mz = mz_values[sort_idx]
         sorted_intensity = intensities[sort_idx]
         
-        # 分组：使用滑动窗口法
-        groups = []
-        current_group = [0]
-        current_group_mz = [sorted_mz[0]]
-        
-        for i in range(1, n):
-            # 计算与当前组的距离
-            group_center = np.mean(current_group_mz)
-            tolerance = self.calculate_tolerance(group_center)
-            
-            if abs(sorted_mz[i] - group_center) <= tolerance:
-                # 属于当前组
-                current_group.append(i)
-                current_group_mz.append(sorted_mz[i])
-            else:
-                # 开始新组
-                groups.append(current_group)
-                current_group = [i]
-                current_group_mz = [sorted_mz[i]]
-        
-        # 添加最后一组
-        groups.append(current_group)
-        
-        logger.info(f"将 {n} 个m/z值合并为 {len(groups)} 组")
-        
-        # 合并每个组
-        merged_mz = []
-        merged_intensity = []
-        group_ids = np.zeros(n, dtype=int)
-        group_sizes = []
-        merge_info = []
+        # 分组：相邻m/z之差超过容差即断开（向量化，容差按每条边计算一次）
+        if self.tolerance_da is None:
+            tolerance = sorted_mz[:-1] * (self.tolerance_ppm / 1e6)
+        else:
+            tolerance = np.full(n - 1, self.tolerance_da)
+        breaks = np.diff(sorted_mz) > tolerance
+        sorted_group_ids = np.concatenate(([0], np.cumsum(breaks)))
+        n_groups = int(sorted_group_ids[-1]) + 1
+        
+        # 每组在排序数组中的起止位置
+        starts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+        ends = np.concatenate((starts[1:], [n]))
+        group_sizes = ends - starts
+        
+        logger.info(f"将 {n} 个m/z值合并为 {n_groups} 组")
+        
+        # 合并强度（求和）
+        merged_intensity = np.bincount(sorted_group_ids, weights=sorted_intensity,
+                                       minlength=n_groups)
+        mean_mz = np.bincount(sorted_group_ids, weights=sorted_mz,
+                              minlength=n_groups) / group_sizes
+        
+        # 根据方法计算代表性m/z
+        if self.merge_method == 'weighted_mean':
+            weighted_sum = np.bincount(sorted_group_ids,
+                                       weights=sorted_mz * sorted_intensity,
+                                       minlength=n_groups)
+            # 组内强度全为0时退回算术平均
+            nonzero = merged_intensity != 0
+            merged_mz = mean_mz.copy()
+            merged_mz[nonzero] = weighted_sum[nonzero] / merged_intensity[nonzero]
+        elif self.merge_method == 'median':
+            merged_mz = np.array([np.median(sorted_mz[s:e]) for s, e in zip(starts, ends)])
+        else:
+            merged_mz = mean_mz
+        
+        # 组内标准差、范围（排序后首尾即为最小/最大值）
+        deviation = sorted_mz - mean_mz[sorted_group_ids]
+        mz_std = np.sqrt(np.bincount(sorted_group_ids, weights=deviation * deviation,
+                                     minlength=n_groups) / group_sizes)
+        mz_min = sorted_mz[starts]
+        mz_max = sorted_mz[ends - 1]
         
-        for group_id, group_indices in enumerate(groups):
-            group_mz = sorted_mz[group_indices]
-            group_intensity = sorted_intensity[group_indices]
-            
-            # 根据方法计算代表性m/z
-            if self.merge_method == 'mean':
-                representative_mz = np.mean(group_mz)
-            elif self.merge_method == 'weighted_mean':
-                representative_mz = np.average(group_mz, weights=group_intensity)
-            elif self.merge_method == 'median':
-                representative_mz = np.median(group_mz)
-            else:
-                representative_mz = np.mean(group_mz)
-            
-            # 合并强度（求和）
-            representative_intensity = np.sum(group_intensity)
-            
-            merged_mz.append(representative_mz)
-            merged_intensity.append(representative_intensity)
-            group_sizes.append(len(group_indices))
-            
-            # 记录组ID
-            for idx in group_indices:
-                original_idx = sort_idx[idx]
-                group_ids[original_idx] = group_id
-            
-            # 详细信息
+        # 记录组ID（映射回原始顺序）
+        group_ids = np.empty(n, dtype=int)
+        group_ids[sort_idx] = sorted_group_ids
+        
+        # 详细信息
+        merge_info = []
+        for group_id in range(n_groups):
+            s, e = starts[group_id], ends[group_id]
             info = {
                 'group_id': group_id,
-                'n_members': len(group_indices),
-                'representative_mz': float(representative_mz),
-                'mz_range': [float(np.min(group_mz)), float(np.max(group_mz))],
-                'mz_std': float(np.std(group_mz)),
-                'total_intensity': float(representative_intensity),
-                'member_mz': [float(mz) for mz in group_mz]
+                'n_members': int(group_sizes[group_id]),
+                'representative_mz': float(merged_mz[group_id]),
+                'mz_range': [float(mz_min[group_id]), float(mz_max[group_id])],
+                'mz_std': float(mz_std[group_id]),
+                'total_intensity': float(merged_intensity[group_id]),
+                'member_mz': sorted_mz[s:e].tolist()
             }
             merge_info.append(info)
         
         self.merge_groups = merge_info
         
+        # 缓存统计信息，get_merge_statistics 无需再遍历合并组
+        self._stats_cache = {
+            'n_groups': n_groups,
+            'n_multi_member_groups': int(np.count_nonzero(group_sizes > 1)),
+            'mean_group_size': float(group_sizes.mean()),
+            'max_group_size': int(group_sizes.max()),
+            'min_mz': float(merged_mz.min()),
+            'max_mz': float(merged_mz.max())
+        }
+        
         return {
-            'merged_mz': np.array(merged_mz),
-            'merged_intensity': np.array(merged_intensity),
+            'merged_mz': merged_mz,
+            'merged_intensity': merged_intensity,
             'group_ids': group_ids,
-            'group_sizes': np.array(group_sizes),
+            'group_sizes': group_sizes,
             'merge_info': merge_info,
             'n_original': n,
-            'n_merged': len(merged_mz),
-            'reduction_rate': (n - len(merged_mz)) / n * 100
+            'n_merged': n_groups,
+            'reduction_rate': (n - n_groups) / n * 100
         }
     
     def merge_dataset_ions(self, data, intensity_threshold=0):
@@ -195,12 +206,13 @@ class MzMerger:
             - 'intensity_matrix': 合并后的强度矩阵
             - 'merge_info': 合并信息
         """
-        mz_bins = np.array(data['mz_bins'])
-        intensity_matrix = np.array(data['intensity_matrix'])
+        mz_bins = np.asarray(data['mz_bins'])
+        # 列优先存储，使按列(axis=0)归约与按列切片均访问连续内存
+        intensity_matrix = np.asarray(data['intensity_matrix'], dtype=self.dtype, order='F')
         n_scans, n_bins = intensity_matrix.shape
         
         # 计算每个m/z的总强度
-        total_intensity = np.sum(intensity_matrix, axis=0)
+        total_intensity = intensity_matrix.sum(axis=0)
         
         # 过滤低强度离子
         valid_mask = total_intensity > intensity_threshold
@@ -213,17 +225,25 @@ class MzMerger:
         # 合并m/z值
         merge_result = self.merge_mz_values(valid_mz, valid_total_intensity)
         
-        # 重建强度矩阵
-        n_merged = len(merge_result['merged_mz'])
-        merged_intensity_matrix = np.zeros((n_scans, n_merged))
+        # 重建强度矩阵：每个组至少有一个成员，输出的每个元素都会被写入，无需预先清零
+        n_valid = len(valid_mz)
+        n_merged = merge_result['n_merged']
+        group_ids = merge_result['group_ids']
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(group_ids, minlength=n_merged))))
         
-        for scan_idx in range(n_scans):
-            scan_intensity = valid_intensity_matrix[scan_idx, :]
-            
-            # 按组合并强度
-            for group_id in range(n_merged):
-                group_mask = merge_result['group_ids'] == group_id
-                merged_intensity_matrix[scan_idx, group_id] = np.sum(scan_intensity[group_mask])
+        if np.all(group_ids[1:] >= group_ids[:-1]):
+            # m/z bins已排序（常见情况）：组成员为连续列，按组起点分段求和
+            merged_intensity_matrix = np.add.reduceat(valid_intensity_matrix, indptr[:-1], axis=1)
+        else:
+            # 以稀疏分组矩阵 G (n_valid × n_merged) 一次性按组求和
+            # G 按列压缩存储，第g列的非零行即组g的成员；由组ID的稳定排序直接得到，
+            # 无需逐组构造掩码
+            indices = np.argsort(group_ids, kind='stable')
+            grouping = sparse.csc_matrix(
+                (np.ones(n_valid, dtype=self.dtype), indices, indptr),
+                shape=(n_valid, n_merged)
+            )
+            merged_intensity_matrix = valid_intensity_matrix @ grouping
         
         merged_data = {
             'sample_name': data.get('sample_name', 'Unknown'),
@@ -261,20 +281,13 @@ class MzMerger:
                 'max_group_size': 0
             }
         
-        group_sizes = [g['n_members'] for g in self.merge_groups]
-        multi_member_groups = [g for g in self.merge_groups if g['n_members'] > 1]
-        
-        return {
-            'n_groups': len(self.merge_groups),
-            'n_multi_member_groups': len(multi_member_groups),
-            'mean_group_size': float(np.mean(group_sizes)),
-            'max_group_size': int(np.max(group_sizes)),
-            'min_mz': float(min(g['representative_mz'] for g in self.merge_groups)),
-            'max_mz': float(max(g['representative_mz'] for g in self.merge_groups)),
-            'largest_groups': sorted(multi_member_groups, 
-                                   key=lambda x: x['n_members'], 
-                                   reverse=True)[:10]
-        }
+        stats = dict(self._stats_cache)
+        stats['largest_groups'] = heapq.nlargest(
+            10,
+            (g for g in self.merge_groups if g['n_members'] > 1),
+            key=lambda x: x['n_members']
+        )
+        return stats
 
 
 if __name__ == '__main__':
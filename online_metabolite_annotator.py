@@ -5,23 +5,151 @@
 支持HMDB和MetaboAnalyst公共数据库查询
 """
 
-import requests
-import json
+import os
+import math
+import pickle
+import contextlib
+import csv
+import functools
+import importlib.util
+import threading
 import time
-from typing import List, Dict, Optional
-import pandas as pd
-from urllib.parse import urlencode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Optional, Union
+import numpy as np
+
+# pandas、polars、pyarrow、numba 导入较慢，只检测是否可用，首次使用时再导入
+# 可选：多线程CSV读取器，用于加速HMDB文件的首次载入
+HAS_POLARS = importlib.util.find_spec('polars') is not None
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+# JIT加速（可选）
+HAS_NUMBA = importlib.util.find_spec('numba') is not None
+
+
+def _match_window_loops(mz, tolerance_ppm, hmdb_mz, inv_mz, start, stop):
+    """
+    在排序m/z数组的 [start, stop) 段中查找容差窗口，并计算窗口内各条目的误差
+    
+    二分查找与误差计算写成显式循环，由 _match_window_kernel 交给numba编译为一次调用。
+    
+    参数:
+        mz: 查询m/z
+        tolerance_ppm: 误差容忍度（ppm）
+        hmdb_mz: 排序的理论m/z数组
+        inv_mz: 1e6 / hmdb_mz
+        start, stop: 查找范围（条带索引给出）
+    
+    返回:
+        (lo, hi, error_da, error_ppm)，窗口为 hmdb_mz[lo:hi]
+    """
+    tolerance_da = (tolerance_ppm / 1e6) * mz
+    mass_min = mz - tolerance_da
+    mass_max = mz + tolerance_da
+    
+    # 左边界：第一个 >= mass_min 的位置
+    lo, hi = start, stop
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if hmdb_mz[mid] < mass_min:
+            lo = mid + 1
+        else:
+            hi = mid
+    first = lo
+    
+    # 右边界：第一个 > mass_max 的位置
+    hi = stop
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if hmdb_mz[mid] <= mass_max:
+            lo = mid + 1
+        else:
+            hi = mid
+    last = lo
+    
+    n = last - first
+    error_da = np.empty(n)
+    error_ppm = np.empty(n)
+    for k in range(n):
+        diff = abs(mz - hmdb_mz[first + k])
+        error_da[k] = diff
+        error_ppm[k] = diff * inv_mz[first + k]
+    return first, last, error_da, error_ppm
+
+
+def _match_window_numpy(mz, tolerance_ppm, hmdb_mz, inv_mz, start, stop):
+    """在排序m/z数组的 [start, stop) 段中查找容差窗口并计算误差（NumPy实现）"""
+    tolerance_da = (tolerance_ppm / 1e6) * mz
+    strip = hmdb_mz[start:stop]
+    lo = start + int(np.searchsorted(strip, mz - tolerance_da, side='left'))
+    hi = start + int(np.searchsorted(strip, mz + tolerance_da, side='right'))
+    
+    error_da = np.abs(mz - hmdb_mz[lo:hi])
+    return lo, hi, error_da, error_da * inv_mz[lo:hi]
+
+
+@functools.lru_cache(maxsize=None)
+def _match_window_kernel():
+    """
+    首次查询时选择窗口匹配的实现
+    
+    有numba时编译 _match_window_loops（nogil 使 batch_annotate 的线程可以并行执行，
+    编译结果由 cache=True 缓存到磁盘），否则使用NumPy实现。
+    """
+    if HAS_NUMBA:
+        from numba import njit
+        return njit(nogil=True, cache=True)(_match_window_loops)
+    return _match_window_numpy
+
+
+# 预下载的HMDB代谢物CSV文件（列：name, formula, hmdb_id, mz_positive, mz_negative）
+DEFAULT_HMDB_CSV_FILE = "/Volumes/US100 256G/mouse DESI data/desi_gui_v2/hmdb_metabolites.csv"
+
+HMDB_TEXT_COLUMNS = ('name', 'formula', 'hmdb_id')
+HMDB_MZ_COLUMNS = ('mz_positive', 'mz_negative')
+# 重复度高、按字典编码读取的文本列
+HMDB_CATEGORY_COLUMNS = ('formula',)
+
+# HMDB m/z条带索引的条带宽度（Da）
+HMDB_BIN_WIDTH_DA = 5.0
+
+# 批量注释进度打印的最小间隔（秒）
+PROGRESS_PRINT_INTERVAL = 0.5
 
 
 class OnlineMetaboliteAnnotator:
     """在线代谢物注释器（支持本地缓存数据库）"""
     
-    def __init__(self, use_cache_db: bool = True):
+    # 内存缓存的m/z分桶宽度（占容差的比例），相近的重复查询落入同一个桶
+    MEMORY_CACHE_BUCKET_FRACTION = 0.05
+    
+    # HMDB结果字典模板：复制预先建好键的字典再赋值，比逐个构造字典字面量更快
+    _HMDB_RESULT_TEMPLATE = dict.fromkeys(['name', 'formula', 'hmdb_id', 'theoretical_mz',
+                                           'measured_mz', 'error_ppm', 'error_da'])
+    _HMDB_RESULT_TEMPLATE['source'] = 'HMDB'
+    
+    def __init__(self, use_cache_db: bool = True, hmdb_csv_file: Optional[str] = None,
+                 memory_cache_file: Optional[str] = None,
+                 memory_cache_size: int = 200_000):
         self.hmdb_api_base = "https://hmdb.ca"
         self.metaboanalyst_base = "https://www.metaboanalyst.ca"
         
-        # 内存缓存（会话级别）
-        self.memory_cache = {}
+        # HMDB CSV文件，首次查询时一次性载入为按m/z排序的数组
+        self.hmdb_csv_file = hmdb_csv_file or DEFAULT_HMDB_CSV_FILE
+        self._hmdb_library = None
+        
+        # 本地小数据库（metabolite_db），首次备用查询时创建；False 表示不可用
+        self._local_db = None
+        
+        # 内存缓存：启动时从磁盘快照预热，close() 时写回，跨会话命中无需查询数据库。
+        # 按LRU策略保留最多 memory_cache_size 条，被淘汰的结果仍保存在数据库缓存中
+        self.memory_cache_size = max(1, int(memory_cache_size))
+        if memory_cache_file is None:
+            memory_cache_file = Path.home() / ".desi_analytics" / "annotation_cache.pkl"
+        self.memory_cache_file = Path(memory_cache_file)
+        self.memory_cache = self._load_memory_cache()
         
         # 持久化缓存数据库
         self.use_cache_db = use_cache_db
@@ -48,6 +176,19 @@ class OnlineMetaboliteAnnotator:
         # 由于我们现在主要使用本地HMDB数据库，不需要延迟
         self.request_delay = 0.0
         
+        # 保护内存缓存、统计信息和数据库缓存连接（batch_annotate 多线程共享）
+        self._lock = threading.RLock()
+        # 保护HMDB CSV和本地数据库的延迟创建
+        self._library_lock = threading.Lock()
+        
+        # 按优先级排列的查询数据源，见 _annotate
+        self._sources = [
+            self._lookup_memory_cache,
+            self._lookup_cache_db,
+            self._lookup_hmdb_db,
+            self._lookup_fallback,
+        ]
+        
         # 统计信息
         self.stats = {
             'total_queries': 0,
@@ -57,8 +198,88 @@ class OnlineMetaboliteAnnotator:
             'new_queries': 0
         }
         
+    def _load_memory_cache(self) -> OrderedDict:
+        """从磁盘快照载入内存缓存；快照早于HMDB CSV文件时视为过期"""
+        if not self.memory_cache_file.exists():
+            return OrderedDict()
+        
+        try:
+            if (os.path.exists(self.hmdb_csv_file) and
+                    os.path.getmtime(self.hmdb_csv_file) > self.memory_cache_file.stat().st_mtime):
+                return OrderedDict()
+            
+            with open(self.memory_cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            
+            if isinstance(cache, dict):
+                # 仅保留 (查询m/z, 结果) 格式的条目，丢弃旧格式快照；
+                # 快照按最近使用顺序保存，超出容量时保留最近使用的部分
+                entries = [(key, value) for key, value in cache.items()
+                           if isinstance(value, tuple) and len(value) == 2]
+                cache = OrderedDict(entries[-self.memory_cache_size:])
+                print(f"[成功] 已载入 {len(cache)} 条注释内存缓存")
+                return cache
+        except Exception as e:
+            print(f"[警告] 无法载入注释内存缓存: {e}")
+        
+        return OrderedDict()
+    
+    def _save_memory_cache(self):
+        """将内存缓存写入磁盘快照（先写临时文件再替换，避免写入中断损坏快照）"""
+        try:
+            self.memory_cache_file.parent.mkdir(parents=True, exist_ok=True)
+            data = pickle.dumps(self.memory_cache, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_file = self.memory_cache_file.with_suffix('.tmp')
+            tmp_file.write_bytes(data)
+            os.replace(tmp_file, self.memory_cache_file)
+        except Exception as e:
+            print(f"[警告] 无法保存注释内存缓存: {e}")
+    
+    def _memory_cache_key(self, mz: float, tolerance_ppm: float, ion_mode: str) -> str:
+        """
+        内存缓存键：按对数m/z分桶，桶宽为固定的ppm值（容差 × 分桶比例）
+        
+        键中包含容差，容差改变时自然不会命中旧结果。
+        """
+        if mz <= 0:
+            return f"{mz:.4f}_{tolerance_ppm}_{ion_mode}"
+        bucket_ppm = tolerance_ppm * self.MEMORY_CACHE_BUCKET_FRACTION
+        bucket = int(math.log(mz) * 1e6 / bucket_ppm)
+        return f"{bucket}_{tolerance_ppm}_{ion_mode}"
+    
+    def _memory_cache_get(self, cache_key: str, mz: float,
+                          tolerance_ppm: float) -> Optional[List[Dict]]:
+        """
+        查询内存缓存
+        
+        命中同一个桶内的不同m/z时，按当前m/z重新计算误差，
+        并过滤掉超出容差的结果（与数据库缓存的策略一致）。
+        """
+        entry = self.memory_cache.get(cache_key)
+        if entry is None:
+            return None
+        self.memory_cache.move_to_end(cache_key)
+        
+        cached_mz, cached_results = entry
+        if cached_mz == mz:
+            return cached_results
+        
+        results = []
+        for result in cached_results:
+            theoretical_mz = result['theoretical_mz']
+            error_da = abs(mz - theoretical_mz)
+            error_ppm = (error_da / theoretical_mz) * 1e6
+            if error_ppm <= tolerance_ppm:
+                results.append(dict(result, measured_mz=mz,
+                                    error_ppm=error_ppm, error_da=error_da))
+        
+        results.sort(key=lambda x: x['error_ppm'])
+        return results
+    
     def annotate_mz(self, mz: float, tolerance_ppm: float = 10, 
-                   ion_mode: str = 'positive') -> List[Dict]:
+                   ion_mode: str = 'positive',
+                   max_results: Optional[int] = None,
+                   early_exit_ppm: Optional[float] = None) -> List[Dict]:
         """
         注释单个m/z值（多级缓存策略）
         
@@ -71,77 +292,162 @@ class OnlineMetaboliteAnnotator:
             mz: m/z值
             tolerance_ppm: 质量误差容忍度（ppm）
             ion_mode: 离子模式 ('positive' or 'negative')
+            max_results: 最多返回的匹配数（按误差排序），None表示全部
+            early_exit_ppm: 备用数据源中一旦找到误差小于该值的匹配就不再查询后续数据源
         
         返回:
             匹配的代谢物列表
         """
-        self.stats['total_queries'] += 1
+        results = self._annotate(mz, tolerance_ppm, ion_mode, early_exit_ppm=early_exit_ppm)
+        return self._limit_results(results, max_results)
+    
+    @staticmethod
+    def _limit_results(results: List[Dict], max_results: Optional[int]) -> List[Dict]:
+        """按误差排序后截取前 max_results 个匹配"""
+        if max_results is None or len(results) <= max_results:
+            return results
+        if max_results == 1:
+            return [min(results, key=lambda x: x['error_ppm'])]
+        return sorted(results, key=lambda x: x['error_ppm'])[:max_results]
+    
+    def _memory_cache_put(self, cache_key: str, mz: float, results: List[Dict]):
+        """写入内存缓存，超出容量时淘汰最久未使用的条目"""
+        self.memory_cache[cache_key] = (mz, results)
+        self.memory_cache.move_to_end(cache_key)
+        while len(self.memory_cache) > self.memory_cache_size:
+            self.memory_cache.popitem(last=False)
+    
+    def _annotate(self, mz: float, tolerance_ppm: float, ion_mode: str,
+                  hmdb_csv_results: Optional[List[Dict]] = None,
+                  early_exit_ppm: Optional[float] = None) -> List[Dict]:
+        """
+        注释单个m/z值（annotate_mz 的实现）
         
-        # 第1级：检查内存缓存
-        cache_key = f"{mz:.4f}_{tolerance_ppm}_{ion_mode}"
-        if cache_key in self.memory_cache:
-            self.stats['memory_cache_hits'] += 1
-            return self.memory_cache[cache_key]
+        依次尝试 self._sources 中的数据源，第一个给出结果的数据源即为答案，
+        结果再写回其上游的缓存层。
         
-        # 第2级：检查数据库缓存
-        if self.use_cache_db and self.cache_db:
+        参数:
+            hmdb_csv_results: 批量注释时预先查好的HMDB CSV结果；为None时按需查询
+            early_exit_ppm: 见 annotate_mz；提前结束时结果不完整，不写入缓存
+        """
+        cache_key = self._memory_cache_key(mz, tolerance_ppm, ion_mode)
+        with self._lock:
+            self.stats['total_queries'] += 1
+        
+        for lookup in self._sources:
+            found = lookup(mz, tolerance_ppm, ion_mode, cache_key,
+                           hmdb_csv_results=hmdb_csv_results, early_exit_ppm=early_exit_ppm)
+            if found is not None:
+                results, promote_levels = found
+                self._promote(mz, tolerance_ppm, ion_mode, cache_key, results, promote_levels)
+                return results
+        
+        return []
+    
+    def _promote(self, mz: float, tolerance_ppm: float, ion_mode: str, cache_key: str,
+                 results: List[Dict], promote_levels: int):
+        """
+        将结果写回上游缓存层
+        
+        promote_levels: 0 不写入；1 写入内存缓存；2 同时写入数据库缓存（无结果时记录为无匹配）
+        """
+        if promote_levels < 1:
+            return
+        
+        with self._lock:
+            self._memory_cache_put(cache_key, mz, results)
+            
+            if promote_levels < 2 or not (self.use_cache_db and self.cache_db):
+                return
+            
             try:
-                db_results = self.cache_db.query_cache(mz, tolerance_ppm, ion_mode)
-                if db_results:
-                    self.stats['db_cache_hits'] += 1
-                    # 同时保存到内存缓存
-                    self.memory_cache[cache_key] = db_results
-                    return db_results
+                if results:
+                    self.cache_db.add_annotations(mz, tolerance_ppm, ion_mode, results)
+                else:
+                    self.cache_db.mark_empty(mz, tolerance_ppm, ion_mode)
             except Exception as e:
-                print(f"[警告] 数据库缓存查询失败: {e}")
+                print(f"[警告] 保存到数据库缓存失败: {e}")
+    
+    # 数据源：返回None表示未命中（继续查询下一级），
+    # 否则返回 (结果列表, 需要写回的上游缓存层数)。
+    # 内存缓存、统计信息和数据库缓存（共享一个SQLite连接）的访问都持有 self._lock，
+    # HMDB数据库和CSV的查询在锁外进行，batch_annotate 的多个线程可以并行查询
+    
+    def _lookup_memory_cache(self, mz: float, tolerance_ppm: float, ion_mode: str,
+                             cache_key: str, **options):
+        """第1级：内存缓存"""
+        with self._lock:
+            results = self._memory_cache_get(cache_key, mz, tolerance_ppm)
+            if results is None:
+                return None
+            self.stats['memory_cache_hits'] += 1
+        return results, 0
+    
+    def _lookup_cache_db(self, mz: float, tolerance_ppm: float, ion_mode: str,
+                         cache_key: str, **options):
+        """第2级：数据库缓存（返回空列表表示此前已确认无匹配，同样视为命中）"""
+        if not (self.use_cache_db and self.cache_db):
+            return None
         
-        # 第3级：从HMDB完整数据库查询
-        if self.hmdb_db and self.hmdb_db.db_available:
+        with self._lock:
             try:
-                hmdb_results = self.hmdb_db.search(mz, tolerance_ppm, ion_mode)
-                
-                # 保存到缓存（无论是否有结果）
-                self.memory_cache[cache_key] = hmdb_results
-                
-                if hmdb_results:
-                    self.stats['hmdb_db_hits'] += 1
-                    
-                    # 保存到数据库缓存
-                    if self.use_cache_db and self.cache_db:
-                        try:
-                            for result in hmdb_results:
-                                self.cache_db.add_annotation(mz, tolerance_ppm, ion_mode, result)
-                        except Exception as e:
-                            print(f"[警告] 保存到缓存数据库失败: {e}")
-                else:
-                    # 没有匹配，记录为新查询（但不再查询其他数据源）
-                    self.stats['new_queries'] += 1
-                
-                # 直接返回结果（可能为空），不再查询其他数据源
-                return hmdb_results
-                
+                results = self.cache_db.query_cache(mz, tolerance_ppm, ion_mode)
             except Exception as e:
-                print(f"[警告] HMDB数据库查询失败: {e}")
+                print(f"[警告] 数据库缓存查询失败: {e}")
+                return None
+            if results is None:
+                return None
+            self.stats['db_cache_hits'] += 1
+        return results, 1
+    
+    def _lookup_hmdb_db(self, mz: float, tolerance_ppm: float, ion_mode: str,
+                        cache_key: str, **options):
+        """第3级：HMDB完整数据库（结果可能为空，不再查询其他数据源）"""
+        if not (self.hmdb_db and self.hmdb_db.db_available):
+            return None
+        
+        try:
+            results = self.hmdb_db.search(mz, tolerance_ppm, ion_mode)
+        except Exception as e:
+            print(f"[警告] HMDB数据库查询失败: {e}")
+            return None
         
-        # 第4级：从其他数据源查询（备用）
-        self.stats['new_queries'] += 1
+        with self._lock:
+            if results:
+                self.stats['hmdb_db_hits'] += 1
+            else:
+                # 没有匹配，记录为新查询
+                self.stats['new_queries'] += 1
+        return results, 2
+    
+    def _lookup_fallback(self, mz: float, tolerance_ppm: float, ion_mode: str,
+                         cache_key: str, hmdb_csv_results: Optional[List[Dict]] = None,
+                         early_exit_ppm: Optional[float] = None, **options):
+        """第4级：HMDB CSV文件与本地小数据库（备用，总是给出结果）"""
         results = []
         
         # 1. 尝试从HMDB CSV文件查询
         try:
-            hmdb_csv_results = self._query_hmdb(mz, tolerance_ppm, ion_mode)
+            if hmdb_csv_results is None:
+                hmdb_csv_results = self._query_hmdb(mz, tolerance_ppm, ion_mode)
             results.extend(hmdb_csv_results)
         except Exception as e:
             print(f"[警告] HMDB CSV查询失败 (m/z={mz:.4f}): {e}")
         
+        # 已找到足够好的匹配时不再查询后续数据源
+        exited_early = (early_exit_ppm is not None and
+                        any(r['error_ppm'] < early_exit_ppm for r in results))
+        
         # 2. 尝试从本地小数据库查询（作为补充）
-        try:
-            local_results = self._query_local_database(mz, tolerance_ppm, ion_mode)
-            results.extend(local_results)
-        except Exception as e:
-            print(f"[警告] 本地数据库查询失败: {e}")
+        if not exited_early:
+            try:
+                local_results = self._query_local_database(mz, tolerance_ppm, ion_mode)
+                results.extend(local_results)
+            except Exception as e:
+                print(f"[警告] 本地数据库查询失败: {e}")
         
-        # 去重（根据名称）
+        # 先按误差排序，再根据名称去重：同名结果保留误差最小的一条
+        results.sort(key=lambda x: x['error_ppm'])
         unique_results = []
         seen_names = set()
         for result in results:
@@ -149,81 +455,298 @@ class OnlineMetaboliteAnnotator:
                 unique_results.append(result)
                 seen_names.add(result['name'])
         
-        # 按误差排序
-        unique_results.sort(key=lambda x: x['error_ppm'])
+        with self._lock:
+            self.stats['new_queries'] += 1
+        return unique_results, 0 if exited_early else 2
+    
+    def _load_hmdb_library(self) -> Dict[str, Dict]:
+        """
+        一次性载入HMDB CSV文件
         
-        # 保存到缓存
-        self.memory_cache[cache_key] = unique_results
+        每种离子模式保存按m/z排序的数组及对应的名称、分子式、HMDB ID，
+        以及按 HMDB_BIN_WIDTH_DA 划分的条带索引，之后的查询只需在一个条带内二分查找。
+        文件不存在或读取失败时返回空字典。
         
-        # 保存到数据库缓存
-        if self.use_cache_db and self.cache_db and unique_results:
-            try:
-                for result in unique_results:
-                    self.cache_db.add_annotation(mz, tolerance_ppm, ion_mode, result)
-            except Exception as e:
-                print(f"[警告] 保存到数据库缓存失败: {e}")
+        返回:
+            {ion_mode: {'mz': array, 'bin_edges': array, 'inv_mz': array,
+                        'name': array, 'formula': array, 'hmdb_id': array}}
+        """
+        if self._hmdb_library is not None:
+            return self._hmdb_library
         
-        return unique_results
+        with self._library_lock:
+            if self._hmdb_library is None:
+                self._hmdb_library = self._build_hmdb_library()
+        return self._hmdb_library
+    
+    def _build_hmdb_library(self) -> Dict[str, Dict]:
+        """读取HMDB CSV并构建按离子模式划分的排序数组（见 _load_hmdb_library）"""
+        library_by_mode = {}
+        
+        if not os.path.exists(self.hmdb_csv_file):
+            return library_by_mode
+        
+        try:
+            columns = self._read_hmdb_csv(self.hmdb_csv_file)
+        except Exception as e:
+            print(f"[警告] HMDB文件读取失败: {e}")
+            return library_by_mode
+        
+        # 根据离子模式选择适当的m/z列：[M+H]+ / [M-H]-
+        for ion_mode, mz_col in (('positive', 'mz_positive'), ('negative', 'mz_negative')):
+            if mz_col not in columns:
+                continue
+            
+            mz_values = columns[mz_col]
+            keep = np.flatnonzero(~np.isnan(mz_values))
+            order = keep[np.argsort(mz_values[keep], kind='stable')]
+            
+            library = {'mz': np.ascontiguousarray(mz_values[order])}
+            library['bin_edges'] = self._build_bin_edges(library['mz'])
+            # 预先计算 1e6 / m/z，查询时ppm误差只需乘法
+            library['inv_mz'] = 1e6 / library['mz']
+            for col, default in (('name', 'Unknown'), ('formula', ''), ('hmdb_id', '')):
+                if col in columns:
+                    library[col] = columns[col][order]
+                else:
+                    library[col] = np.full(len(order), default, dtype=object)
+            
+            library_by_mode[ion_mode] = library
+        
+        return library_by_mode
+    
+    @staticmethod
+    def _build_bin_edges(sorted_mz: np.ndarray) -> np.ndarray:
+        """
+        构建m/z条带索引：第b个条带覆盖 [b, b+1) × HMDB_BIN_WIDTH_DA，
+        对应排序数组中的 [bin_edges[b], bin_edges[b+1])
+        
+        首尾条带分别延伸到数组两端，保证任何范围查询都落在条带内。
+        """
+        n_bins = int(sorted_mz[-1] // HMDB_BIN_WIDTH_DA) + 1 if len(sorted_mz) else 1
+        n_bins = max(n_bins, 1)
+        bin_edges = np.searchsorted(sorted_mz, np.arange(n_bins + 1) * HMDB_BIN_WIDTH_DA,
+                                    side='left')
+        bin_edges[0] = 0
+        bin_edges[-1] = len(sorted_mz)
+        return bin_edges
+    
+    @staticmethod
+    def _read_hmdb_csv(hmdb_file: str) -> Dict[str, np.ndarray]:
+        """
+        只读取HMDB CSV中需要的列，返回 {列名: numpy数组}
+        
+        优先使用polars或pyarrow的多线程读取器，都不可用时回退到pandas。
+        m/z列为float64（缺失值为NaN），文本列为object数组；
+        重复度高的列（HMDB_CATEGORY_COLUMNS）按字典编码读取，相同的值共用一个字符串对象。
+        """
+        # utf-8-sig 去掉Excel等工具写入的BOM，否则首列名会带上'\ufeff'而被当作未知列
+        with open(hmdb_file, 'r', encoding='utf-8-sig', newline='') as f:
+            header = next(csv.reader(f), [])
+        mz_cols = [c for c in HMDB_MZ_COLUMNS if c in header]
+        text_cols = [c for c in HMDB_TEXT_COLUMNS if c in header]
+        category_cols = [c for c in HMDB_CATEGORY_COLUMNS if c in text_cols]
+        usecols = text_cols + mz_cols
+        if not usecols:
+            return {}
+        
+        if HAS_POLARS:
+            import polars as pl
+            frame = pl.read_csv(
+                hmdb_file, columns=usecols,
+                schema_overrides={**{c: pl.Float64 for c in mz_cols},
+                                  **{c: pl.Categorical for c in category_cols}}
+            )
+            # polars把空文本读作null，与pyarrow/pandas一致填为空字符串
+            return {
+                **{c: frame[c].fill_null('').to_numpy().astype(object) for c in text_cols},
+                **{c: frame[c].fill_null(np.nan).to_numpy().astype(np.float64) for c in mz_cols},
+            }
+        
+        if HAS_PYARROW:
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+            table = pa_csv.read_csv(
+                hmdb_file,
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=usecols,
+                    column_types={**{c: pa.float64() for c in mz_cols},
+                                  **{c: pa.dictionary(pa.int32(), pa.string())
+                                     for c in category_cols}}
+                )
+            )
+            return {
+                **{c: table[c].to_numpy().astype(object) for c in text_cols},
+                **{c: table[c].fill_null(np.nan).to_numpy() for c in mz_cols},
+            }
+        
+        import pandas as pd
+        df = pd.read_csv(hmdb_file, usecols=usecols, engine='c',
+                         dtype={**{c: np.float64 for c in mz_cols},
+                                **{c: 'category' for c in category_cols}})
+        columns = {c: df[c].to_numpy(dtype=np.float64) for c in mz_cols}
+        # 文本列的空值与pyarrow一致读作空字符串
+        for c in text_cols:
+            if c in category_cols:
+                # 按编码从类别中取值，缺失值（编码-1）取到末尾的空字符串
+                categories = np.append(df[c].cat.categories.to_numpy(dtype=object), '')
+                columns[c] = categories[df[c].cat.codes.to_numpy()]
+            else:
+                columns[c] = df[c].fillna('').to_numpy(dtype=object)
+        return columns
     
     def _query_hmdb(self, mz: float, tolerance_ppm: float, ion_mode: str) -> List[Dict]:
         """
         查询HMDB数据库
         
-        注意：HMDB没有公开的简单REST API，这里使用模拟查询
-        实际应用中可能需要下载HMDB数据库文件或使用第三方API
+        HMDB没有公开的简单REST API，这里使用预下载的HMDB CSV文件
+        （首次查询时载入，见 _load_hmdb_library）
         """
-        results = []
+        library = self._load_hmdb_library().get(
+            'positive' if ion_mode == 'positive' else 'negative'
+        )
+        if library is None:
+            return []
         
         # 计算质量搜索范围
         tolerance_da = (tolerance_ppm / 1e6) * mz
         mass_min = mz - tolerance_da
         mass_max = mz + tolerance_da
         
-        # HMDB提供了数据下载，可以使用预下载的数据库文件
-        # 这里使用本地HMDB数据库（如果存在）
-        hmdb_file = "/Volumes/US100 256G/mouse DESI data/desi_gui_v2/hmdb_metabolites.csv"
+        # 先由条带索引定位覆盖 [mass_min, mass_max] 的条带，只在这一小段上二分查找
+        bin_edges = library['bin_edges']
+        last_bin = len(bin_edges) - 2
+        bin_lo = min(max(int(mass_min // HMDB_BIN_WIDTH_DA), 0), last_bin)
+        bin_hi = min(max(int(mass_max // HMDB_BIN_WIDTH_DA), 0), last_bin)
         
-        try:
-            import os
-            if os.path.exists(hmdb_file):
-                df = pd.read_csv(hmdb_file)
-                
-                # 根据离子模式选择适当的m/z列
-                if ion_mode == 'positive':
-                    mz_col = 'mz_positive'  # [M+H]+
-                else:
-                    mz_col = 'mz_negative'  # [M-H]-
-                
-                if mz_col in df.columns:
-                    # 筛选在误差范围内的代谢物
-                    matches = df[(df[mz_col] >= mass_min) & (df[mz_col] <= mass_max)]
-                    
-                    for _, row in matches.iterrows():
-                        theoretical_mz = row[mz_col]
-                        error_da = abs(mz - theoretical_mz)
-                        error_ppm = (error_da / theoretical_mz) * 1e6
-                        
-                        results.append({
-                            'name': row.get('name', 'Unknown'),
-                            'formula': row.get('formula', ''),
-                            'hmdb_id': row.get('hmdb_id', ''),
-                            'theoretical_mz': theoretical_mz,
-                            'measured_mz': mz,
-                            'error_ppm': error_ppm,
-                            'error_da': error_da,
-                            'source': 'HMDB'
-                        })
-        except Exception as e:
-            print(f"[警告] HMDB文件读取失败: {e}")
+        lo, hi, error_da, error_ppm = _match_window_kernel()(
+            float(mz), float(tolerance_ppm), library['mz'], library['inv_mz'],
+            bin_edges[bin_lo], bin_edges[bin_hi + 1]
+        )
+        
+        return self._hmdb_slice_results(library, mz, lo, hi, error_da, error_ppm)
+    
+    def _hmdb_slice_results(self, library: Dict, mz: float, lo: int, hi: int,
+                            error_da: np.ndarray, error_ppm: np.ndarray) -> List[Dict]:
+        """将HMDB排序数组中 [lo, hi) 范围内的条目及其误差转换为结果字典列表"""
+        template = self._HMDB_RESULT_TEMPLATE
+        results = []
+        for name, formula, hmdb_id, theoretical_mz, err_ppm, err_da in zip(
+                library['name'][lo:hi], library['formula'][lo:hi], library['hmdb_id'][lo:hi],
+                library['mz'][lo:hi].tolist(), error_ppm.tolist(), error_da.tolist()):
+            result = template.copy()
+            result['name'] = name
+            result['formula'] = formula
+            result['hmdb_id'] = hmdb_id
+            result['theoretical_mz'] = theoretical_mz
+            result['measured_mz'] = mz
+            result['error_ppm'] = err_ppm
+            result['error_da'] = err_da
+            results.append(result)
         
         return results
     
+    def _batch_query_columns(self, mz_array: np.ndarray, tolerance_ppm: float,
+                             ion_mode: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        批量查询HMDB CSV数据，以列式（每个字段一个数组）返回全部匹配
+        
+        先对查询m/z排序，再以两次向量化 searchsorted 得到全部查询的窗口，
+        把所有窗口展开为一组扁平的行索引，误差等字段整列计算。
+        
+        返回:
+            {'query_index', 'measured_mz', 'theoretical_mz', 'error_ppm', 'error_da',
+             'name', 'formula', 'hmdb_id'}，query_index 为 mz_array 中的位置，
+            同一查询的行相邻且按理论m/z升序；HMDB CSV不可用时返回None
+        """
+        library = self._load_hmdb_library().get(
+            'positive' if ion_mode == 'positive' else 'negative'
+        )
+        if library is None:
+            return None
+        
+        order = np.argsort(mz_array, kind='stable')
+        mz_sorted = mz_array[order]
+        tolerance_da = (tolerance_ppm / 1e6) * mz_sorted
+        lo_arr = np.searchsorted(library['mz'], mz_sorted - tolerance_da, side='left')
+        hi_arr = np.searchsorted(library['mz'], mz_sorted + tolerance_da, side='right')
+        
+        # 展开窗口：第k个查询对应库中 [lo_k, hi_k) 的行
+        counts = np.maximum(hi_arr - lo_arr, 0)
+        starts = np.cumsum(counts) - counts
+        query_pos = np.repeat(np.arange(len(mz_sorted)), counts)
+        rows = lo_arr[query_pos] + (np.arange(counts.sum()) - starts[query_pos])
+        
+        measured_mz = mz_sorted[query_pos]
+        theoretical_mz = library['mz'][rows]
+        error_da = np.abs(measured_mz - theoretical_mz)
+        
+        return {
+            'query_index': order[query_pos],
+            'measured_mz': measured_mz,
+            'theoretical_mz': theoretical_mz,
+            'error_ppm': error_da * library['inv_mz'][rows],
+            'error_da': error_da,
+            'name': library['name'][rows],
+            'formula': library['formula'][rows],
+            'hmdb_id': library['hmdb_id'][rows],
+        }
+    
+    def _batch_annotate_vectorized(self, mz_array: np.ndarray, tolerance_ppm: float,
+                                   ion_mode: str) -> Optional[List[List[Dict]]]:
+        """
+        批量查询HMDB CSV数据，返回与 mz_array 顺序一致的匹配结果列表
+        
+        匹配在 _batch_query_columns 中按列计算，只在这里转换为结果字典；
+        HMDB CSV不可用时返回None。
+        """
+        columns = self._batch_query_columns(mz_array, tolerance_ppm, ion_mode)
+        if columns is None:
+            return None
+        
+        template = self._HMDB_RESULT_TEMPLATE
+        results = [[] for _ in range(len(mz_array))]
+        for k, name, formula, hmdb_id, theoretical_mz, measured_mz, error_ppm, error_da in zip(
+                columns['query_index'].tolist(), columns['name'], columns['formula'],
+                columns['hmdb_id'], columns['theoretical_mz'].tolist(),
+                columns['measured_mz'].tolist(), columns['error_ppm'].tolist(),
+                columns['error_da'].tolist()):
+            result = template.copy()
+            result['name'] = name
+            result['formula'] = formula
+            result['hmdb_id'] = hmdb_id
+            result['theoretical_mz'] = theoretical_mz
+            result['measured_mz'] = measured_mz
+            result['error_ppm'] = error_ppm
+            result['error_da'] = error_da
+            results[k].append(result)
+        
+        return results
+    
+    def _get_local_db(self):
+        """
+        首次使用时创建本地代谢物数据库并复用
+        
+        模块不可用或创建失败时只提示一次，之后返回None。
+        """
+        if self._local_db is None:
+            with self._library_lock:
+                if self._local_db is None:
+                    try:
+                        from metabolite_db import MetaboliteDatabase
+                        self._local_db = MetaboliteDatabase()
+                    except Exception as e:
+                        print(f"[警告] 本地代谢物数据库不可用: {e}")
+                        self._local_db = False
+        return self._local_db or None
+    
     def _query_local_database(self, mz: float, tolerance_ppm: float, 
                              ion_mode: str) -> List[Dict]:
         """查询本地代谢物数据库（内置常见代谢物）"""
-        from metabolite_db import MetaboliteDatabase
+        db = self._get_local_db()
+        if db is None:
+            return []
         
-        db = MetaboliteDatabase()
         local_results = db.search(mz, tolerance_ppm, ion_mode)
         
         # 转换格式
@@ -242,9 +765,19 @@ class OnlineMetaboliteAnnotator:
         
         return formatted_results
     
+    def _cache_db_transaction(self):
+        """数据库缓存可用时返回其事务上下文，否则返回空上下文"""
+        if self.use_cache_db and self.cache_db:
+            return self.cache_db.transaction()
+        return contextlib.nullcontext()
+    
     def batch_annotate(self, mz_list: List[float], tolerance_ppm: float = 10,
                       ion_mode: str = 'positive', 
-                      progress_callback=None) -> Dict[float, List[Dict]]:
+                      progress_callback=None,
+                      n_workers: Optional[int] = None,
+                      max_results: Optional[int] = None,
+                      early_exit_ppm: Optional[float] = None,
+                      best_only: bool = False) -> Dict[float, Union[List[Dict], Optional[Dict]]]:
         """
         批量注释m/z列表
         
@@ -252,33 +785,72 @@ class OnlineMetaboliteAnnotator:
             mz_list: m/z值列表
             tolerance_ppm: 误差容忍度
             ion_mode: 离子模式
-            progress_callback: 进度回调函数 callback(current, total)
+            progress_callback: 进度回调函数 callback(current, total)，在调用线程中执行
+            n_workers: 并行查询的线程数，默认为CPU核心数
+            max_results: 每个m/z最多返回的匹配数，见 annotate_mz
+            early_exit_ppm: 见 annotate_mz
+            best_only: 为True时每个m/z只返回误差最小的匹配（无匹配为None）
         
         返回:
-            {mz: [匹配结果列表]} 字典
+            {mz: [匹配结果列表]} 字典；best_only 时为 {mz: 最佳匹配或None}
         """
+        if best_only:
+            max_results = 1
         annotations = {}
         total = len(mz_list)
         
         print(f"\n[SEARCH] 开始批量注释 {total} 个m/z值...")
         
-        for i, mz in enumerate(mz_list):
+        # HMDB完整数据库不可用时会回退到HMDB CSV：一次性向量化查好全部m/z
+        prefetched = None
+        if not (self.hmdb_db and self.hmdb_db.db_available):
+            try:
+                prefetched = self._batch_annotate_vectorized(
+                    np.asarray(mz_list, dtype=np.float64), tolerance_ppm, ion_mode
+                )
+            except Exception as e:
+                print(f"[警告] HMDB CSV批量查询失败: {e}")
+        
+        def annotate_one(i):
+            mz = mz_list[i]
             try:
-                matches = self.annotate_mz(mz, tolerance_ppm, ion_mode)
-                annotations[mz] = matches
+                matches = self._annotate(mz, tolerance_ppm, ion_mode,
+                                         prefetched[i] if prefetched is not None else None,
+                                         early_exit_ppm=early_exit_ppm)
+                return self._limit_results(matches, max_results)
+            except Exception as e:
+                print(f"[错误] 注释失败 m/z={mz:.4f}: {e}")
+                return []
+        
+        max_workers = max(1, min(n_workers or os.cpu_count() or 1, total))
+        last_print = time.monotonic()
+        
+        # 整个批次的数据库缓存写入放在一个事务中，每1000个m/z提交一次
+        with self._cache_db_transaction(), \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map 按输入顺序返回结果，进度回调始终在调用线程中执行
+            for i, matches in enumerate(executor.map(annotate_one, range(total))):
+                if best_only:
+                    annotations[mz_list[i]] = matches[0] if matches else None
+                else:
+                    annotations[mz_list[i]] = matches
                 
+                # 有回调时由回调报告进度，否则按时间节流打印（最多每0.5秒一次）
                 if progress_callback:
                     progress_callback(i + 1, total)
-                
-                if (i + 1) % 10 == 0:
+                elif time.monotonic() - last_print >= PROGRESS_PRINT_INTERVAL:
                     print(f"   进度: {i+1}/{total} ({(i+1)/total*100:.1f}%)")
-            
-            except Exception as e:
-                print(f"[错误] 注释失败 m/z={mz:.4f}: {e}")
-                annotations[mz] = []
+                    last_print = time.monotonic()
+                
+                if self.use_cache_db and self.cache_db and (i + 1) % 1000 == 0:
+                    with self._lock:
+                        self.cache_db.checkpoint()
         
         print(f"[成功] 批量注释完成: {total} 个m/z值")
         
+        # 批量注释后立即写入内存缓存快照，调用方未调用close()时下次启动也能命中
+        self._save_memory_cache()
+        
         return annotations
     
     def get_best_match(self, matches: List[Dict], 
@@ -334,35 +906,24 @@ class OnlineMetaboliteAnnotator:
             annotations: {mz: [匹配结果]} 字典
             output_file: 输出文件路径
         """
-        rows = []
-        
-        for mz, matches in annotations.items():
-            if matches:
-                for match in matches:
-                    rows.append({
-                        'measured_mz': f"{mz:.4f}",
-                        'metabolite_name': match['name'],
-                        'formula': match['formula'],
-                        'hmdb_id': match.get('hmdb_id', ''),
-                        'theoretical_mz': f"{match['theoretical_mz']:.4f}",
-                        'error_ppm': f"{match['error_ppm']:.2f}",
-                        'error_da': f"{match['error_da']:.6f}",
-                        'source': match['source']
-                    })
-            else:
-                rows.append({
-                    'measured_mz': f"{mz:.4f}",
-                    'metabolite_name': '未匹配',
-                    'formula': '',
-                    'hmdb_id': '',
-                    'theoretical_mz': '',
-                    'error_ppm': '',
-                    'error_da': '',
-                    'source': ''
-                })
-        
-        df = pd.DataFrame(rows)
-        df.to_csv(output_file, index=False, encoding='utf-8-sig')
+        # 逐行流式写出，不在内存中构建完整的表
+        with open(output_file, 'w', buffering=1 << 20, newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(['measured_mz', 'metabolite_name', 'formula', 'hmdb_id',
+                             'theoretical_mz', 'error_ppm', 'error_da', 'source'])
+            
+            for mz, matches in annotations.items():
+                measured_mz = f"{mz:.4f}"
+                if matches:
+                    writer.writerows(
+                        [measured_mz, match['name'], match['formula'], match.get('hmdb_id', ''),
+                         f"{match['theoretical_mz']:.4f}", f"{match['error_ppm']:.2f}",
+                         f"{match['error_da']:.6f}", match['source']]
+                        for match in matches
+                    )
+                else:
+                    writer.writerow([measured_mz, '未匹配', '', '', '', '', '', ''])
+        
         print(f"[成功] 注释结果已导出到: {output_file}")
     
     def print_stats(self):
@@ -406,9 +967,11 @@ class OnlineMetaboliteAnnotator:
                 print(f"[警告] 无法获取数据库统计: {e}")
     
     def close(self):
-        """关闭数据库连接并打印统计信息"""
+        """保存内存缓存、关闭数据库连接并打印统计信息"""
         self.print_stats()
         
+        self._save_memory_cache()
+        
         if self.cache_db:
             self.cache_db.close()
     
@@ -5,7 +5,9 @@
 按季度样本处理次数收费的完整流程
 """
 
+import hashlib
 import json
+import os
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Tuple
@@ -13,6 +15,49 @@ from database_manager import DatabaseManager
 from data_encryptor import DataEncryptor
 from invoice_generator import InvoiceGenerator
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+# 季度边界：(季度, 开始月日, 结束月日)，按 (month - 1) // 3 索引
+_QUARTER_BOUNDS = (
+    ("Q1", "01-01", "03-31"),
+    ("Q2", "04-01", "06-30"),
+    ("Q3", "07-01", "09-30"),
+    ("Q4", "10-01", "12-31"),
+)
+_QUARTER_MAP = {q: (start, end) for q, start, end in _QUARTER_BOUNDS}
+
+# 季度报告类型及导入时必须包含的字段
+REPORT_TYPE = 'quarterly_usage'
+_REQUIRED_REPORT_FIELDS = frozenset({
+    'customer_id', 'quarter', 'period_start', 'period_end',
+    'usage_summary', 'integrity'
+})
+
+# 报告校验算法，记录在报告的integrity中
+# 固定使用标准库的SHA-256，客户端与管理端无论安装了哪些可选库都能相互验证
+REPORT_CHECKSUM_ALGORITHM = 'sha256'
+
+# usage_details字段，顺序与明细查询的列顺序一致（校验和按此顺序计算）
+USAGE_DETAIL_FIELDS = ('date', 'samples_loaded', 'exports', 'splits', 'unique_samples')
+
+
+def _write_file_bytes(path: str, data: bytes):
+    """用底层文件描述符一次性写入已编码的字节（仅所有者可读写）"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
 
 class QuarterlyBillingWorkflow:
     """季度计费工作流程管理器"""
@@ -31,27 +76,11 @@ class QuarterlyBillingWorkflow:
         """
         now = datetime.now()
         year = now.year
-        month = now.month
         
         # 确定季度
-        if month <= 3:
-            quarter = "Q1"
-            start = f"{year}-01-01"
-            end = f"{year}-03-31"
-        elif month <= 6:
-            quarter = "Q2"
-            start = f"{year}-04-01"
-            end = f"{year}-06-30"
-        elif month <= 9:
-            quarter = "Q3"
-            start = f"{year}-07-01"
-            end = f"{year}-09-30"
-        else:
-            quarter = "Q4"
-            start = f"{year}-10-01"
-            end = f"{year}-12-31"
+        quarter, start, end = _QUARTER_BOUNDS[(now.month - 1) // 3]
         
-        return (f"{year}-{quarter}", start, end)
+        return (f"{year}-{quarter}", f"{year}-{start}", f"{year}-{end}")
     
     def get_quarter_info(self, quarter_str: str) -> Tuple[str, str]:
         """
@@ -63,17 +92,12 @@ class QuarterlyBillingWorkflow:
         返回:
             (开始日期, 结束日期)
         """
-        year, quarter = quarter_str.split('-')
+        year, quarter = quarter_str.split('-', 1)
         year = int(year)
         
-        if quarter == "Q1":
-            return (f"{year}-01-01", f"{year}-03-31")
-        elif quarter == "Q2":
-            return (f"{year}-04-01", f"{year}-06-30")
-        elif quarter == "Q3":
-            return (f"{year}-07-01", f"{year}-09-30")
-        else:  # Q4
-            return (f"{year}-10-01", f"{year}-12-31")
+        # 未知季度按Q4处理
+        start, end = _QUARTER_MAP.get(quarter, _QUARTER_MAP["Q4"])
+        return (f"{year}-{start}", f"{year}-{end}")
     
     # ==================== 客户端操作 ====================
     
@@ -97,26 +121,28 @@ class QuarterlyBillingWorkflow:
         else:
             start_date, end_date = self.get_quarter_info(quarter)
         
-        # 查询该季度的使用记录
+        # 统计数据（在SQLite中聚合）
+        total_samples, total_exports, total_splits, unique_samples, report_count = \
+            self._aggregate_usage(customer_id, start_date, end_date)
+        
+        # 查询该季度的使用记录明细
         usage_records = self.db.fetchall('''
-            SELECT * FROM usage_records
+            SELECT report_date AS date, total_samples_loaded AS samples_loaded,
+                   total_exports AS exports, total_splits AS splits, unique_samples
+            FROM usage_records
             WHERE customer_id = ?
             AND report_date >= ? AND report_date <= ?
             ORDER BY report_date
         ''', (customer_id, start_date, end_date))
-        
-        # 统计数据
-        total_samples = sum(r['total_samples_loaded'] for r in usage_records)
-        total_exports = sum(r['total_exports'] for r in usage_records)
-        total_splits = sum(r['total_splits'] for r in usage_records)
-        unique_samples = sum(r['unique_samples'] for r in usage_records)
+        # 列名已按USAGE_DETAIL_FIELDS取别名，直接转为明细字典
+        usage_details = list(map(dict, usage_records))
         
         # 获取客户信息
         customer = self.db.get_customer(customer_id)
         
         # 生成报告
         report = {
-            'report_type': 'quarterly_usage',
+            'report_type': REPORT_TYPE,
             'report_version': '1.0',
             'generated_at': datetime.now().isoformat(),
             
@@ -138,24 +164,16 @@ class QuarterlyBillingWorkflow:
                 'total_splits': total_splits,
                 'unique_samples': unique_samples,
                 'total_operations': total_samples + total_exports + total_splits,
-                'report_count': len(usage_records)
+                'report_count': report_count
             },
             
             # 详细记录
-            'usage_details': [
-                {
-                    'date': r['report_date'],
-                    'samples_loaded': r['total_samples_loaded'],
-                    'exports': r['total_exports'],
-                    'splits': r['total_splits'],
-                    'unique_samples': r['unique_samples']
-                }
-                for r in usage_records
-            ],
+            'usage_details': usage_details,
             
             # 完整性验证
             'integrity': {
-                'record_count': len(usage_records),
+                'record_count': report_count,
+                'algorithm': REPORT_CHECKSUM_ALGORITHM,
                 'checksum': self._calculate_report_checksum(usage_records)
             }
         }
@@ -166,16 +184,62 @@ class QuarterlyBillingWorkflow:
         
         return report
     
+    def _aggregate_usage(self, customer_id: str, start_date: str,
+                         end_date: str) -> Tuple[int, int, int, int, int]:
+        """
+        汇总时间段内的使用记录
+        
+        返回:
+            (样本数, 导出次数, 拆分次数, 唯一样本数, 记录条数)
+        """
+        row = self.db.fetchone('''
+            SELECT COALESCE(SUM(total_samples_loaded), 0),
+                   COALESCE(SUM(total_exports), 0),
+                   COALESCE(SUM(total_splits), 0),
+                   COALESCE(SUM(unique_samples), 0),
+                   COUNT(*)
+            FROM usage_records
+            WHERE customer_id = ?
+            AND report_date >= ? AND report_date <= ?
+        ''', (customer_id, start_date, end_date))
+        return tuple(row)
+    
     def _calculate_report_checksum(self, records: List) -> str:
-        """计算报告校验和"""
-        import hashlib
+        """
+        计算报告校验和（SHA-256）
         
-        data_str = json.dumps([dict(r) for r in records], sort_keys=True)
-        return hashlib.sha256(data_str.encode()).hexdigest()
+        按查询的列顺序把每条记录编码为紧凑JSON数组，逐条送入哈希
+        
+        参数:
+            records: 使用记录（sqlite3.Row或按列顺序排列的序列）
+        """
+        h = hashlib.sha256()
+        # 始终用标准库json编码：orjson与json的浮点数格式不同，
+        # 混用会使导出端和导入端算出不同的校验和
+        for r in records:
+            h.update(json.dumps(tuple(r), ensure_ascii=False,
+                                separators=(',', ':')).encode('utf-8'))
+        return h.hexdigest()
     
-    def _save_encrypted_report(self, report: Dict, output_file: str):
-        """保存加密报告"""
-        report_json = json.dumps(report, indent=2, ensure_ascii=False)
+    def _save_encrypted_report(self, report: Dict, output_file: str,
+                               pretty: bool = False):
+        """
+        保存加密报告
+        
+        参数:
+            report: 报告数据
+            output_file: 输出文件路径
+            pretty: 是否缩进JSON（加密后不可读，默认使用紧凑格式）
+        """
+        if HAS_ORJSON:
+            option = orjson.OPT_NON_STR_KEYS
+            if pretty:
+                option |= orjson.OPT_INDENT_2
+            report_json = orjson.dumps(report, option=option).decode('utf-8')
+        elif pretty:
+            report_json = json.dumps(report, indent=2, ensure_ascii=False)
+        else:
+            report_json = json.dumps(report, ensure_ascii=False, separators=(',', ':'))
         
         # 加密
         encrypted = self.encryptor.encrypt_with_license(
@@ -184,7 +248,9 @@ class QuarterlyBillingWorkflow:
         )
         
         # 保存
-        Path(output_file).write_text(encrypted)
+        if isinstance(encrypted, str):
+            encrypted = encrypted.encode('utf-8')
+        _write_file_bytes(output_file, encrypted)
         print(f"[成功] 季度报告已导出: {output_file}")
     
     # ==================== 管理员操作 ====================
@@ -200,8 +266,8 @@ class QuarterlyBillingWorkflow:
             (是否成功, 消息, 报告数据)
         """
         try:
-            # 读取加密报告
-            encrypted_content = Path(report_file).read_text()
+            # 读取加密报告（按字节读取，不做文本解码）
+            encrypted_content = Path(report_file).read_bytes()
             
             # 尝试解密
             decrypted = self.encryptor.decrypt_with_multiple_keys(encrypted_content)
@@ -209,11 +275,11 @@ class QuarterlyBillingWorkflow:
             if not decrypted:
                 return (False, "无法解密报告文件", None)
             
-            # 解析JSON
-            report = json.loads(decrypted)
+            # 解析JSON（str和bytes均可直接解析）
+            report = orjson.loads(decrypted) if HAS_ORJSON else json.loads(decrypted)
             
             # 验证报告格式
-            if report.get('report_type') != 'quarterly_usage':
+            if report.get('report_type') != REPORT_TYPE:
                 return (False, "报告格式不正确", None)
             
             # 验证完整性
@@ -224,11 +290,13 @@ class QuarterlyBillingWorkflow:
             customer_id = report['customer_id']
             quarter = report['quarter']
             
+            year = int(quarter.split('-', 1)[0])
             existing = self.db.fetchone('''
-                SELECT id FROM usage_records
-                WHERE customer_id = ? AND report_date LIKE ?
+                SELECT 1 FROM usage_records
+                WHERE customer_id = ?
+                AND report_date >= ? AND report_date < ?
                 LIMIT 1
-            ''', (customer_id, f"{quarter.split('-')[0]}%"))
+            ''', (customer_id, f"{year}-01-01", f"{year + 1}-01-01"))
             
             if existing:
                 return (False, f"该季度报告已导入: {quarter}", report)
@@ -240,21 +308,36 @@ class QuarterlyBillingWorkflow:
     
     def _verify_report_integrity(self, report: Dict) -> bool:
         """验证报告完整性"""
-        # 这里可以添加更多验证逻辑
-        required_fields = [
-            'customer_id', 'quarter', 'period_start', 'period_end',
-            'usage_summary', 'integrity'
-        ]
+        if report.get('report_type') != REPORT_TYPE:
+            return False
+        if not _REQUIRED_REPORT_FIELDS.issubset(report):
+            return False
+        
+        integrity = report['integrity']
+        algorithm = integrity.get('algorithm')
+        if algorithm is None:
+            # 旧版报告的校验和覆盖整行数据，无法从报告内容重新计算
+            return True
+        
+        if algorithm != REPORT_CHECKSUM_ALGORITHM:
+            print(f"[警告] 不支持的校验算法: {algorithm}")
+            return False
         
-        for field in required_fields:
-            if field not in report:
-                return False
+        details = report.get('usage_details', [])
+        if integrity.get('record_count') != len(details):
+            return False
         
-        return True
+        try:
+            rows = [tuple(d[f] for f in USAGE_DETAIL_FIELDS) for d in details]
+        except (KeyError, TypeError):
+            return False
+        
+        return self._calculate_report_checksum(rows) == integrity.get('checksum')
     
     def generate_quarterly_invoice(self, customer_id: str, 
                                    quarter: str,
-                                   unit_price: float = None) -> Dict:
+                                   unit_price: float = None,
+                                   customer: Dict = None) -> Dict:
         """
         生成季度账单（管理员操作）
         
@@ -262,12 +345,14 @@ class QuarterlyBillingWorkflow:
             customer_id: 客户ID
             quarter: 季度（如"2025-Q1"）
             unit_price: 单价（元/样本），None则使用客户默认单价
+            customer: 已查询的客户信息，None则从数据库读取
         
         返回:
             账单数据
         """
         # 获取客户信息
-        customer = self.db.get_customer(customer_id)
+        if customer is None:
+            customer = self.db.get_customer(customer_id)
         if not customer:
             raise ValueError(f"客户不存在: {customer_id}")
         
@@ -278,15 +363,75 @@ class QuarterlyBillingWorkflow:
         # 获取季度使用数据
         start_date, end_date = self.get_quarter_info(quarter)
         
-        usage_records = self.db.fetchall('''
-            SELECT * FROM usage_records
-            WHERE customer_id = ?
-            AND report_date >= ? AND report_date <= ?
-        ''', (customer_id, start_date, end_date))
-        
         # 计算总样本数
-        total_samples = sum(r['total_samples_loaded'] for r in usage_records)
+        total_samples = self._aggregate_usage(customer_id, start_date, end_date)[0]
+        
+        invoice_data = self._build_invoice_data(
+            customer_id, quarter, start_date, end_date, total_samples, unit_price
+        )
+        
+        # 保存到数据库
+        self.db.create_invoice(invoice_data)
         
+        return invoice_data
+    
+    def generate_quarterly_invoices_batch(self, customer_ids: List[str],
+                                          quarter: str,
+                                          unit_price: float = None) -> List[Dict]:
+        """
+        批量生成季度账单（管理员操作）
+        
+        一次联表汇总所有客户的使用量，并在单个事务中批量写入账单
+        
+        参数:
+            customer_ids: 客户ID列表
+            quarter: 季度（如"2025-Q1"）
+            unit_price: 单价（元/样本），None则使用各客户默认单价
+        
+        返回:
+            账单数据列表（顺序与customer_ids一致）
+        """
+        if not customer_ids:
+            return []
+        
+        start_date, end_date = self.get_quarter_info(quarter)
+        placeholders = ', '.join('?' * len(customer_ids))
+        rows = self.db.fetchall(f'''
+            SELECT c.customer_id, c.unit_price,
+                   COALESCE(SUM(u.total_samples_loaded), 0) AS total_samples
+            FROM customers c
+            LEFT JOIN usage_records u
+                ON u.customer_id = c.customer_id
+                AND u.report_date >= ? AND u.report_date <= ?
+            WHERE c.customer_id IN ({placeholders})
+            GROUP BY c.customer_id
+        ''', (start_date, end_date, *customer_ids))
+        usage = {r['customer_id']: r for r in rows}
+        
+        missing = [cid for cid in customer_ids if cid not in usage]
+        if missing:
+            raise ValueError(f"客户不存在: {', '.join(missing)}")
+        
+        invoices = []
+        for customer_id in customer_ids:
+            row = usage[customer_id]
+            price = unit_price
+            if price is None:
+                price = row['unit_price'] if row['unit_price'] is not None else 10.0
+            invoices.append(self._build_invoice_data(
+                customer_id, quarter, start_date, end_date, row['total_samples'], price
+            ))
+        
+        # 保存到数据库（单个事务）
+        self.db.create_invoices(invoices)
+        
+        return invoices
+    
+    @staticmethod
+    def _build_invoice_data(customer_id: str, quarter: str, start_date: str,
+                            end_date: str, total_samples: int,
+                            unit_price: float) -> Dict:
+        """按样本数计算金额并组装账单数据"""
         # 计算金额
         subtotal = total_samples * unit_price
         tax_rate = 0.06  # 6%税率
@@ -296,8 +441,7 @@ class QuarterlyBillingWorkflow:
         # 生成账单ID
         invoice_id = f"INV-{quarter}-{customer_id}"
         
-        # 创建账单
-        invoice_data = {
+        return {
             'invoice_id': invoice_id,
             'customer_id': customer_id,
             'period_start': start_date,
@@ -315,11 +459,6 @@ class QuarterlyBillingWorkflow:
             'created_at': datetime.now().isoformat(),
             'notes': f'{quarter}季度账单'
         }
-        
-        # 保存到数据库
-        self.db.create_invoice(invoice_data)
-        
-        return invoice_data
     
     def mark_invoice_paid(self, invoice_id: str, 
                          payment_date: str = None) -> bool:
@@ -349,18 +488,22 @@ class QuarterlyBillingWorkflow:
         return count > 0
     
     def extend_license_after_payment(self, customer_id: str, 
-                                    months: int = 3) -> Tuple[bool, str]:
+                                    months: int = 3,
+                                    customer: Dict = None) -> Tuple[bool, str]:
         """
         付款后延长License（管理员操作）
         
         参数:
             customer_id: 客户ID
             months: 延长月数（默认3个月，即一个季度）
+            customer: 已查询的客户信息，None则从数据库读取；
+                      成功后会同步更新其中的到期时间和状态
         
         返回:
             (是否成功, 新到期时间)
         """
-        customer = self.db.get_customer(customer_id)
+        if customer is None:
+            customer = self.db.get_customer(customer_id)
         if not customer:
             return (False, "客户不存在")
         
@@ -368,35 +511,41 @@ class QuarterlyBillingWorkflow:
         current_expires = datetime.fromisoformat(customer['expires_at'])
         
         # 如果已过期，从当前时间开始计算
-        if current_expires < datetime.now():
-            new_expires = datetime.now() + timedelta(days=months * 30)
+        now = datetime.now()
+        if current_expires < now:
+            new_expires = now + timedelta(days=months * 30)
         else:
             # 否则在原到期时间基础上延长
             new_expires = current_expires + timedelta(days=months * 30)
         
-        new_expires_str = new_expires.strftime('%Y-%m-%d')
+        new_expires_str = f"{new_expires.year:04d}-{new_expires.month:02d}-{new_expires.day:02d}"
         
         # 更新数据库
-        self.db.update_customer(customer_id, {
+        updates = {
             'expires_at': new_expires_str,
             'status': 'active'
-        })
+        }
+        self.db.update_customer(customer_id, updates)
+        customer.update(updates)
         
         return (True, new_expires_str)
     
     def generate_license_config(self, customer_id: str, 
-                               output_file: str = None) -> str:
+                               output_file: str = None,
+                               customer: Dict = None) -> str:
         """
         生成License配置文件（管理员操作）
         
         参数:
             customer_id: 客户ID
             output_file: 输出文件路径
+            customer: 已查询的客户信息，None则从数据库读取
         
         返回:
             配置文件内容
         """
-        customer = self.db.get_customer(customer_id)
+        if customer is None:
+            customer = self.db.get_customer(customer_id)
         if not customer:
             raise ValueError(f"客户不存在: {customer_id}")
         
@@ -409,7 +558,7 @@ updated_at={datetime.now().isoformat()}
 """
         
         if output_file:
-            Path(output_file).write_text(config_content)
+            _write_file_bytes(output_file, config_content.encode('utf-8'))
             print(f"[成功] 配置文件已生成: {output_file}")
         
         return config_content
@@ -451,10 +600,13 @@ updated_at={datetime.now().isoformat()}
         if not success:
             return result
         
+        # 客户信息在整个周期内只查询一次，传给后续各步骤
+        customer = self.db.get_customer(customer_id)
+        
         # 步骤2: 生成账单
         try:
             invoice = self.generate_quarterly_invoice(
-                customer_id, quarter, unit_price
+                customer_id, quarter, unit_price, customer=customer
             )
             result['invoice'] = invoice
             result['steps'].append({
@@ -483,7 +635,9 @@ updated_at={datetime.now().isoformat()}
             return result
         
         # 步骤4: 延长License
-        success, new_expires = self.extend_license_after_payment(customer_id)
+        success, new_expires = self.extend_license_after_payment(
+            customer_id, customer=customer
+        )
         result['new_expires'] = new_expires
         result['steps'].append({
             'step': '延长License',
@@ -496,7 +650,7 @@ updated_at={datetime.now().isoformat()}
         
         # 步骤5: 生成配置文件
         config_file = f"{customer_id}_license_config.txt"
-        self.generate_license_config(customer_id, config_file)
+        self.generate_license_config(customer_id, config_file, customer=customer)
         result['config_file'] = config_file
         result['steps'].append({
             'step': '生成配置文件',
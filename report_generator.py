@@ -3,11 +3,22 @@ DESI报告生成器
 生成PDF和Excel格式的分析报告
 """
 
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import warnings
 warnings.filterwarnings('ignore')
 
+# Excel写入引擎（可选，constant_memory模式逐行写出，不在内存中保留整个工作簿）
+try:
+    import xlsxwriter
+    HAS_XLSXWRITER = True
+except ImportError:
+    HAS_XLSXWRITER = False
+
+# 逐离子的数组列（生成Excel时统一转换为numpy数组）
+ION_ARRAY_KEYS = ('mz_bins', 'mean_intensity', 'max_intensity', 'cv')
+
 
 class ReportGenerator:
     """DESI数据分析报告生成器"""
@@ -58,24 +69,58 @@ class ReportGenerator:
         print(f"[STATS] 生成Excel详细报告: {filename}")
 
         try:
-            with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-                # 样本信息表
-                sample_info = self._create_sample_info_sheet(data)
-                sample_info.to_excel(writer, sheet_name='样本信息', index=False)
-
-                # 离子统计表
-                ion_stats = self._create_ion_stats_sheet(data)
-                ion_stats.to_excel(writer, sheet_name='离子统计', index=False)
+            # 各列统一转换一次numpy数组，三个工作表共享
+            soa = self._as_soa(data)
+            sheets = [
+                ('样本信息', self._create_sample_info_sheet(soa)),    # 样本信息表
+                ('离子统计', self._create_ion_stats_sheet(soa)),      # 离子统计表
+                ('高强度离子', self._create_top_ions_sheet(soa)),     # 前50高强度离子
+            ]
 
-                # 前50高强度离子
-                top_ions = self._create_top_ions_sheet(data)
-                top_ions.to_excel(writer, sheet_name='高强度离子', index=False)
+            if HAS_XLSXWRITER:
+                workbook = xlsxwriter.Workbook(filename, {
+                    'constant_memory': True,
+                    'nan_inf_to_errors': True,
+                })
+                try:
+                    for sheet_name, df in sheets:
+                        self._write_sheet_rows(workbook, sheet_name, df)
+                finally:
+                    workbook.close()
+            else:
+                with pd.ExcelWriter(filename, engine='openpyxl') as writer:
+                    for sheet_name, df in sheets:
+                        df.to_excel(writer, sheet_name=sheet_name, index=False)
 
             print(f"[成功] Excel报告已生成: {filename}")
 
         except Exception as e:
             raise Exception(f"生成Excel报告失败: {str(e)}")
 
+    @staticmethod
+    def _as_soa(data):
+        """返回数据字典的副本，其中逐离子的列已转换为numpy数组"""
+        soa = dict(data)
+        for key in ION_ARRAY_KEYS:
+            if key in soa:
+                soa[key] = np.asarray(soa[key])
+        return soa
+
+    @staticmethod
+    def _write_sheet_rows(workbook, sheet_name, df):
+        """
+        按行顺序写入一个工作表
+
+        constant_memory模式下已写完的行会被刷出，不能回头修改，
+        因此不经过pandas（按列写单元格），直接逐行write_row
+        """
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, [str(c) for c in df.columns])
+        # 按列转为Python标量再按行组合，避免逐行访问DataFrame
+        columns = [df[c].tolist() for c in df.columns]
+        for row_idx, row in enumerate(zip(*columns), start=1):
+            worksheet.write_row(row_idx, 0, row)
+
     def generate_comparison_report(self, data_list, labels, output_file):
         """
         生成多样本对比报告
@@ -99,51 +144,60 @@ class ReportGenerator:
 
     def _generate_text_report(self, data):
         """生成文本格式的报告内容"""
-        content = []
-        content.append("=" * 60)
-        content.append("DESI质谱成像分析报告")
-        content.append("=" * 60)
-        content.append("")
-
-        # 样本信息
-        content.append("📋 样本信息:")
-        content.append(f"   文件: {data.get('filename', 'Unknown')}")
-        content.append(f"   扫描点数: {data.get('scan_count', 0)}")
-        content.append(f"   m/z范围: {data.get('mz_range', 'Unknown')}")
-        content.append(f"   离子数: {data.get('ion_count', 0)}")
-        content.append("")
-
-        # 统计信息
-        content.append("[STATS] 统计信息:")
+        separator = "=" * 60
+
+        # 统计信息（可选字段）
+        stats = ""
         if 'mz_bins' in data:
-            content.append(f"   m/z值数量: {len(data['mz_bins'])}")
+            stats += f"   m/z值数量: {len(data['mz_bins'])}\n"
         if 'intensity_matrix' in data:
-            content.append(f"   强度矩阵形状: {data['intensity_matrix'].shape}")
-        content.append("")
-
-        content.append("[FILE] 注意: 这是简化的文本报告，完整的PDF报告功能正在开发中")
-        content.append("=" * 60)
-
-        return "\n".join(content)
+            stats += f"   强度矩阵形状: {data['intensity_matrix'].shape}\n"
+
+        return (
+            f"{separator}\n"
+            "DESI质谱成像分析报告\n"
+            f"{separator}\n"
+            "\n"
+            # 样本信息
+            "📋 样本信息:\n"
+            f"   文件: {data.get('filename', 'Unknown')}\n"
+            f"   扫描点数: {data.get('scan_count', 0)}\n"
+            f"   m/z范围: {data.get('mz_range', 'Unknown')}\n"
+            f"   离子数: {data.get('ion_count', 0)}\n"
+            "\n"
+            "[STATS] 统计信息:\n"
+            f"{stats}"
+            "\n"
+            "[FILE] 注意: 这是简化的文本报告，完整的PDF报告功能正在开发中\n"
+            f"{separator}"
+        )
 
     def _generate_comparison_text_report(self, data_list, labels):
         """生成多样本比较的文本报告"""
-        content = []
-        content.append("=" * 60)
-        content.append("DESI多样本对比分析报告")
-        content.append("=" * 60)
-        content.append("")
-
-        for i, (data, label) in enumerate(zip(data_list, labels)):
-            content.append(f"🔬 样本 {i+1}: {label}")
-            content.append(f"   扫描点数: {data.get('scan_count', 0)}")
-            content.append(f"   离子数: {data.get('ion_count', 0)}")
-            content.append("")
-
-        content.append("[FILE] 注意: 这是简化的文本报告，完整的PDF对比报告功能正在开发中")
-        content.append("=" * 60)
-
-        return "\n".join(content)
+        separator = "=" * 60
+
+        samples = "".join(self._summarize_sample(i, data, label)
+                          for i, (data, label) in enumerate(zip(data_list, labels)))
+
+        return (
+            f"{separator}\n"
+            "DESI多样本对比分析报告\n"
+            f"{separator}\n"
+            "\n"
+            f"{samples}"
+            "[FILE] 注意: 这是简化的文本报告，完整的PDF对比报告功能正在开发中\n"
+            f"{separator}"
+        )
+
+    @staticmethod
+    def _summarize_sample(index, data, label):
+        """生成单个样本的摘要文本块（以空行结尾）"""
+        return (
+            f"🔬 样本 {index+1}: {label}\n"
+            f"   扫描点数: {data.get('scan_count', 0)}\n"
+            f"   离子数: {data.get('ion_count', 0)}\n"
+            "\n"
+        )
 
     def _create_sample_info_sheet(self, data):
         """创建样本信息表"""
@@ -164,11 +218,14 @@ class ReportGenerator:
             # 如果没有统计数据，创建空表
             return pd.DataFrame({'m/z': [], '平均强度': [], '最大强度': [], '变异系数': []})
 
+        # 只显示前100个；统一转为numpy数组，切片为视图
+        mz_values = np.asarray(data['mz_bins'])[:100]
+        n = len(mz_values)
         stats_data = {
-            'm/z': data['mz_bins'][:100],  # 只显示前100个
-            '平均强度': data['mean_intensity'][:100],
-            '最大强度': data['max_intensity'][:100] if 'max_intensity' in data else [0] * 100,
-            '变异系数': data['cv'][:100] if 'cv' in data else [0] * 100
+            'm/z': mz_values,
+            '平均强度': np.asarray(data['mean_intensity'])[:n],
+            '最大强度': np.asarray(data['max_intensity'])[:n] if 'max_intensity' in data else np.zeros(n),
+            '变异系数': np.asarray(data['cv'])[:n] if 'cv' in data else np.zeros(n)
         }
         return pd.DataFrame(stats_data)
 
@@ -177,21 +234,20 @@ class ReportGenerator:
         if 'mz_bins' not in data or 'mean_intensity' not in data:
             return pd.DataFrame({'排名': [], 'm/z': [], '强度': []})
 
-        # 按强度排序
-        intensities = data['mean_intensity']
-        mz_values = data['mz_bins']
+        intensities = np.asarray(data['mean_intensity'])
+        mz_values = np.asarray(data['mz_bins'])
 
-        # 获取排序索引
-        sorted_indices = sorted(range(len(intensities)),
-                               key=lambda i: intensities[i],
-                               reverse=True)
-
-        top_indices = sorted_indices[:50]  # 前50个
+        # 部分排序取前50个，再只对这50个按强度降序排列
+        k = min(50, len(intensities))
+        if k == 0:
+            return pd.DataFrame({'排名': [], 'm/z': [], '强度': []})
+        top_indices = np.argpartition(-intensities, k - 1)[:k]
+        top_indices = top_indices[np.argsort(-intensities[top_indices], kind='stable')]
 
         top_data = {
-            '排名': range(1, len(top_indices) + 1),
-            'm/z': [mz_values[i] for i in top_indices],
-            '强度': [intensities[i] for i in top_indices]
+            '排名': np.arange(1, k + 1),
+            'm/z': mz_values[top_indices],
+            '强度': intensities[top_indices]
         }
 
         return pd.DataFrame(top_data)
@@ -5,21 +5,399 @@
 实现不同样本之间的质谱成像对比（如：高浓度 vs 低浓度）
 """
 
+import csv
+import functools
+import importlib.util
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle
+from matplotlib.collections import PatchCollection
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QGroupBox,
                             QLabel, QListWidget, QPushButton, QDoubleSpinBox,
                             QComboBox, QCheckBox, QSplitter, QWidget,
                             QAbstractItemView, QMessageBox, QLineEdit, QFileDialog)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QUrl
+from PyQt5.QtGui import QDesktopServices
 from pathlib import Path
-import pandas as pd
 
 # ROI tools removed during cleanup
 
+# ROI统计与图像重建内核（可选，numba编译为单次遍历；首次使用时才导入）
+HAS_NUMBA = importlib.util.find_spec('numba') is not None
+
+# ROI数据导出为Parquet/Feather需要pyarrow（可选，由pandas在写入时导入）
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+# Excel导出优先使用xlsxwriter（只写不读，比openpyxl快）
+HAS_XLSXWRITER = importlib.util.find_spec('xlsxwriter') is not None
+
+# ROI分析结果超过该字符数时写入临时文本文件用系统程序打开（QTextEdit排版大段文本会卡住界面）
+LARGE_REPORT_CHARS = 200_000
+
+# ROI数据导出的列（顺序即文件中的列顺序）
+ROI_EXPORT_FIELDS = (
+    'Sample', 'ROI', 'm/z_target', 'm/z_actual',
+    'X_min_pixel', 'X_max_pixel', 'Y_min_pixel', 'Y_max_pixel',
+    'X_min_mm', 'X_max_mm', 'Y_min_mm', 'Y_max_mm',
+    'ROI_width_pixel', 'ROI_height_pixel', 'ROI_area_pixel2',
+    'num_points', 'mean_intensity', 'median_intensity', 'max_intensity',
+    'min_intensity', 'std_intensity', 'total_intensity', 'signal_density',
+)
+
+
+def _nearest_mz_index(mz_bins, mz_target):
+    """
+    在mz_bins中查找最接近mz_target的索引
+    
+    mz_bins为升序时二分查找后比较左右两个相邻值，距离相同时取较小的索引
+    （与argmin一致）；非升序时searchsorted的结果无意义，回退到全量argmin。
+    """
+    mz_bins = np.asarray(mz_bins)
+    if len(mz_bins) > 1 and not (mz_bins[1:] >= mz_bins[:-1]).all():
+        return int(np.abs(mz_bins - mz_target).argmin())
+    
+    i = int(np.searchsorted(mz_bins, mz_target))
+    if i == 0:
+        return 0
+    if i < len(mz_bins) and abs(mz_bins[i] - mz_target) < abs(mz_bins[i - 1] - mz_target):
+        return i
+    # 左侧值有重复时取其第一次出现的位置
+    return int(np.searchsorted(mz_bins, mz_bins[i - 1]))
+
+
+def _grid_index(values):
+    """
+    求坐标值在其唯一值序列中的索引，返回 (唯一值, 索引)
+    
+    结果与 np.unique + np.searchsorted 相同。成像坐标通常是等间距网格：先由少量
+    采样点推断步长，直接按步长计算索引，再验证每个网格点都有数据且同一网格点的
+    坐标完全相同，从而避免对全部坐标排序；验证不通过时回退到np.unique。
+    """
+    values = np.asarray(values)
+    n = len(values)
+    if n > 1:
+        sample = np.unique(np.concatenate((values[:256], values[::max(1, n // 1024)])))
+        if sample.size > 1:
+            v_min = values.min()
+            step = np.diff(sample).min()
+            n_grid = int(round((values.max() - v_min) / step)) + 1
+            if n_grid <= n:
+                index = np.rint((values - v_min) / step).astype(np.intp)
+                axis = np.empty(n_grid, dtype=values.dtype)
+                axis[index] = values
+                if (np.array_equal(axis[index], values)
+                        and np.bincount(index, minlength=n_grid).all()):
+                    return axis, index
+    
+    axis = np.unique(values)
+    return axis, np.searchsorted(axis, values)
+
+
+def _scatter_image_loops(xi, yi, intensity, out):
+    """
+    按像素索引把各扫描点的强度写入2D图像 out[yi, xi]
+    
+    重复坐标以最后一个点为准（与NumPy花式索引赋值一致）。
+    由 _scatter_image_kernel 交给numba编译。
+    """
+    for i in range(intensity.shape[0]):
+        out[yi[i], xi[i]] = intensity[i]
+
+
+def _scatter_image_numpy(xi, yi, intensity, out):
+    """_scatter_image_loops 的NumPy实现（未安装numba时使用）"""
+    out[yi, xi] = intensity
+
+
+@functools.lru_cache(maxsize=None)
+def _scatter_image_kernel():
+    """首次重建图像时选择散射写入的实现（numba编译推迟到第一次使用）"""
+    if HAS_NUMBA:
+        from numba import njit
+        return njit(nogil=True, cache=True)(_scatter_image_loops)
+    return _scatter_image_numpy
+
+
+def _roi_stats_loops(intensity, xs, ys, x_lo, y_lo, x_hi, y_hi, selected):
+    """
+    单次遍历统计矩形ROI [x_lo, x_hi] × [y_lo, y_hi] 内的像素
+    
+    落在ROI内的强度依次写入 selected（用于中位数），同时用Welford算法累计均值和方差。
+    由 _roi_stats_kernel 交给numba编译。
+    
+    返回:
+        (点数, 总强度, 最小值, 最大值, 均值, 方差)
+    """
+    n = 0
+    total = 0.0
+    vmin = np.inf
+    vmax = -np.inf
+    mean = 0.0
+    m2 = 0.0
+    for i in range(intensity.shape[0]):
+        x = xs[i]
+        y = ys[i]
+        if x < x_lo or x > x_hi or y < y_lo or y > y_hi:
+            continue
+        v = float(intensity[i])
+        selected[n] = v
+        n += 1
+        total += v
+        if v < vmin:
+            vmin = v
+        if v > vmax:
+            vmax = v
+        delta = v - mean
+        mean += delta / n
+        m2 += delta * (v - mean)
+    var = m2 / n if n > 0 else 0.0
+    return n, total, vmin, vmax, mean, var
+
+
+def _roi_stats_numpy(intensity, xs, ys, x_lo, y_lo, x_hi, y_hi, selected):
+    """_roi_stats_loops 的NumPy实现（未安装numba时使用）"""
+    mask = (xs >= x_lo) & (xs <= x_hi) & (ys >= y_lo) & (ys <= y_hi)
+    values = intensity[mask].astype(np.float64)
+    n = values.size
+    if n == 0:
+        return 0, 0.0, np.inf, -np.inf, 0.0, 0.0
+    selected[:n] = values
+    return (n, float(values.sum()), float(values.min()), float(values.max()),
+            float(values.mean()), float(values.var()))
+
+
+@functools.lru_cache(maxsize=None)
+def _roi_stats_kernel():
+    """
+    首次统计时选择ROI统计的实现
+    
+    numba编译推迟到第一次ROI分析，不拖慢对话框的导入与打开。
+    """
+    if HAS_NUMBA:
+        from numba import njit
+        return njit(nogil=True, cache=True)(_roi_stats_loops)
+    return _roi_stats_numpy
+
+
+def _empty_rois():
+    """
+    创建一个样本的空ROI表
+    
+    ROI按列存储：'coords' 为 (N, 4) 数组，每行 (x1, y1, x2, y2) 为鼠标拖拽的起止像素坐标；
+    'names' 为对应的ROI名称列表。
+    """
+    return {'coords': np.zeros((0, 4)), 'names': []}
+
+
+def _grid_window_values(img, measured, roi_coords):
+    """
+    取出矩形ROI覆盖的已测量像素的强度（float64）
+    
+    像素网格本身就是空间索引：ROI边界取整后直接切片，开销与ROI面积成正比。
+    """
+    x1, y1, x2, y2 = roi_coords
+    ny, nx = img.shape
+    ix_lo = max(int(np.ceil(min(x1, x2))), 0)
+    ix_hi = min(int(np.floor(max(x1, x2))), nx - 1)
+    iy_lo = max(int(np.ceil(min(y1, y2))), 0)
+    iy_hi = min(int(np.floor(max(y1, y2))), ny - 1)
+    if ix_lo > ix_hi or iy_lo > iy_hi:
+        return np.empty(0)
+    
+    window = (slice(iy_lo, iy_hi + 1), slice(ix_lo, ix_hi + 1))
+    return img[window][measured[window]].astype(np.float64)
+
+
+def _analyze_roi(roi_coords, data, mz_index):
+    """
+    统计矩形ROI内指定m/z的强度
+    
+    roi_coords 为 (x1, y1, x2, y2)，与data['coords']均为像素坐标（由update_comparison转换）。
+    若update_comparison已为该m/z重建了2D图像，则直接切片统计；否则单次遍历全部像素。
+    ROI内无数据点时只返回 {'n_points': 0}。
+    """
+    x1, y1, x2, y2 = roi_coords
+    coords = data['coords']
+    
+    img = data.get('_img')
+    if (img is not None and data.get('_img_mz_index') == mz_index
+            and data.get('_pixel_coords') is coords):
+        # 已有该m/z的2D图像：直接切出ROI矩形，开销与ROI面积成正比
+        values = _grid_window_values(img, data['_measured'], roi_coords)
+        if values.size == 0:
+            return {'n_points': 0}
+        return {
+            'n_points': int(values.size),
+            'mean': float(values.mean()),
+            'median': float(np.median(values)),
+            'max': float(values.max()),
+            'min': float(values.min()),
+            'std': float(values.std()),
+            'sum': float(values.sum()),
+        }
+    
+    # 否则逐点扫描像素坐标
+    intensity = data['intensity_matrix'][:, mz_index]
+    selected = np.empty(len(intensity))
+    
+    n, total, vmin, vmax, mean, var = _roi_stats_kernel()(
+        intensity, coords[:, 0], coords[:, 1],
+        float(min(x1, x2)), float(min(y1, y2)), float(max(x1, x2)), float(max(y1, y2)),
+        selected
+    )
+    if n == 0:
+        return {'n_points': 0}
+    
+    return {
+        'n_points': n,
+        'mean': mean,
+        'median': float(np.median(selected[:n])),
+        'max': vmax,
+        'min': vmin,
+        'std': float(np.sqrt(var)),
+        'sum': total,
+    }
+
+
+def _analyze_rois(roi_coords, data, mz_index):
+    """
+    一次统计多个矩形ROI内指定m/z的强度
+    
+    roi_coords 为 (N, 4) 数组，每行 (x1, y1, x2, y2)。返回与 _analyze_roi 同名键、
+    长度为N的数组；ROI内无数据点时各项为0。
+    
+    样本已有像素网格（update_comparison重建过图像）时，把该m/z散射到网格上一次，
+    每个ROI只切片其覆盖的像素；否则由一次广播得到 (N, 像素数) 的掩码，
+    点数、总强度和平方和通过矩阵乘法一次求出。
+    """
+    roi_coords = np.asarray(roi_coords, dtype=np.float64).reshape(-1, 4)
+    coords = data['coords']
+    
+    measured = data.get('_measured')
+    if measured is not None and data.get('_pixel_coords') is coords:
+        img = data.get('_img') if data.get('_img_mz_index') == mz_index else None
+        if img is None:
+            img = np.zeros(measured.shape, dtype=np.float32)
+            _scatter_image_kernel()(data['_xi'], data['_yi'],
+                                    data['intensity_matrix'][:, mz_index], img)
+        
+        n_rois = len(roi_coords)
+        stats = {key: np.zeros(n_rois) for key in ('mean', 'median', 'max', 'min', 'std', 'sum')}
+        stats['n_points'] = np.zeros(n_rois, dtype=np.int64)
+        for i, row in enumerate(roi_coords.tolist()):
+            values = _grid_window_values(img, measured, row)
+            if values.size == 0:
+                continue
+            stats['n_points'][i] = values.size
+            stats['mean'][i] = values.mean()
+            stats['median'][i] = np.median(values)
+            stats['max'][i] = values.max()
+            stats['min'][i] = values.min()
+            stats['std'][i] = values.std()
+            stats['sum'][i] = values.sum()
+        return stats
+    
+    # 强度列保持float32连续存储，(N, 像素数) 的最值/中位数临时数组随之减半；
+    # 总强度和平方和仍按float64累加，导出的总强度不损失精度
+    intensity = np.ascontiguousarray(data['intensity_matrix'][:, mz_index], dtype=np.float32)
+    intensity64 = intensity.astype(np.float64)
+    
+    lo = np.minimum(roi_coords[:, :2], roi_coords[:, 2:])
+    hi = np.maximum(roi_coords[:, :2], roi_coords[:, 2:])
+    x = np.ascontiguousarray(coords[:, 0])
+    y = np.ascontiguousarray(coords[:, 1])
+    mask = ((x >= lo[:, 0:1]) & (x <= hi[:, 0:1]) &
+            (y >= lo[:, 1:2]) & (y <= hi[:, 1:2]))
+    
+    n_points = mask.sum(axis=1)
+    weights = mask.astype(np.float64)
+    total = weights @ intensity64
+    sq_total = weights @ (intensity64 * intensity64)
+    
+    has_points = n_points > 0
+    mean = np.divide(total, n_points, out=np.zeros(len(n_points)), where=has_points)
+    var = np.divide(sq_total, n_points, out=np.zeros(len(n_points)), where=has_points) - mean * mean
+    vmax = np.where(mask, intensity, -np.inf).max(axis=1, initial=-np.inf)
+    vmin = np.where(mask, intensity, np.inf).min(axis=1, initial=np.inf)
+    median = np.array([np.median(intensity[row]) if n else 0.0
+                       for row, n in zip(mask, n_points)])
+    
+    return {
+        'n_points': n_points,
+        'mean': mean,
+        'median': median,
+        'max': np.where(has_points, vmax, 0.0),
+        'min': np.where(has_points, vmin, 0.0),
+        'std': np.sqrt(np.maximum(var, 0.0)),
+        'sum': total,
+    }
+
+
+def _compute_sample_columns(sample_name, rois, data, mz_target):
+    """
+    计算一个样本所有ROI的导出数据
+    
+    只读取该样本的数据，不修改任何状态，可在线程池中并行调用。
+    按列返回 {列名: 按ROI顺序排列的值列表}，列见 ROI_EXPORT_FIELDS。
+    """
+    mz_bins = data['mz_bins']
+    mz_index = _nearest_mz_index(mz_bins, mz_target)
+    actual_mz = mz_bins[mz_index]
+    n_rois = len(rois['names'])
+    
+    # 获取物理坐标映射（用于导出）
+    x_unique_coords = data.get('x_unique', None)
+    y_unique_coords = data.get('y_unique', None)
+    
+    # 所有ROI的像素边界与尺寸（逐列一次计算）
+    lo = np.minimum(rois['coords'][:, :2], rois['coords'][:, 2:])
+    hi = np.maximum(rois['coords'][:, :2], rois['coords'][:, 2:])
+    width = hi[:, 0] - lo[:, 0]
+    height = hi[:, 1] - lo[:, 1]
+    area = width * height
+    
+    # 所有ROI边界的物理坐标（如果可用）：像素索引截断到有效范围后一次查表
+    if x_unique_coords is not None and y_unique_coords is not None:
+        x_index = np.column_stack((lo[:, 0], hi[:, 0])).astype(np.intp)
+        y_index = np.column_stack((lo[:, 1], hi[:, 1])).astype(np.intp)
+        x_phys = np.asarray(x_unique_coords)[np.clip(x_index, 0, len(x_unique_coords) - 1)]
+        y_phys = np.asarray(y_unique_coords)[np.clip(y_index, 0, len(y_unique_coords) - 1)]
+    else:
+        x_phys = y_phys = np.zeros((n_rois, 2))
+    
+    # 一次统计该样本的所有ROI；无数据点的ROI各项统计为0
+    stats = _analyze_rois(rois['coords'], data, mz_index)
+    
+    # 信号密度（总信号/面积），面积为0时记为0
+    signal_density = np.divide(stats['sum'], area, out=np.zeros(n_rois), where=area > 0)
+    
+    values = (
+        [sample_name] * n_rois, list(rois['names']), [mz_target] * n_rois, [actual_mz] * n_rois,
+        lo[:, 0], hi[:, 0], lo[:, 1], hi[:, 1],
+        x_phys[:, 0], x_phys[:, 1], y_phys[:, 0], y_phys[:, 1],
+        width, height, area,
+        stats['n_points'], stats['mean'], stats['median'], stats['max'],
+        stats['min'], stats['std'], stats['sum'], signal_density,
+    )
+    return {field: column if isinstance(column, list) else column.tolist()
+            for field, column in zip(ROI_EXPORT_FIELDS, values)}
+
+
+@functools.lru_cache(maxsize=256)
+def _short_name(sample_name):
+    """提取样本的简短名称（重绘和日志中反复调用，按样本名缓存）"""
+    if 'sample' in sample_name.lower():
+        parts = sample_name.split('_')
+        sample_num = next((p for p in parts if 'sample' in p.lower()), '')
+        mode = next((p for p in parts if p in ['POS', 'NEG']), '')
+        if sample_num and mode:
+            return f"{sample_num}_{mode}"
+    return sample_name[:30] + '...' if len(sample_name) > 30 else sample_name
+
 
 class SampleComparisonCanvas(FigureCanvas):
     """多样本对比画布"""
@@ -33,17 +411,25 @@ class SampleComparisonCanvas(FigureCanvas):
         self.current_mz = None
         self.colormap = 'hot'
         self.layout_mode = 'horizontal'  # horizontal or vertical
+        self.debug = False  # 是否输出图像重建等调试信息
         
         # ROI相关 - 每个样本独立的ROI
-        self.sample_rois = {}  # {sample_name: [roi1, roi2, ...]}
-        self.roi_patches = {}  # {sample_name: [patch1, patch2, ...]}
+        self.sample_rois = {}  # {sample_name: {'coords': (N, 4)数组, 'names': [...]}}
+        self.roi_patches = {}  # {sample_name: PatchCollection} 每个样本的ROI矩形合并为一个集合
+        self.roi_labels = {}  # {sample_name: [text1, text2, ...]} 重绘时复用的ROI标签
         self.roi_mode = None  # 'rectangle' or None
         self.roi_start = None
         self.current_roi_patch = None
+        self.roi_background = None  # 拖动ROI时缓存的axes背景（用于blit）
         self.roi_counters = {}  # {sample_name: counter}
         self.current_sample = None  # 当前选择的样本用于绘制ROI
         self.sample_axes = {}  # {sample_name: ax}
         
+        # 子图复用：布局未变时只更新图像数据，不重建axes和色标
+        self._layout_key = None  # (nrows, ncols, 样本名, 图像形状)
+        self._image_artists = {}  # {sample_name: (AxesImage, Colorbar)}
+        self._last_params = None  # 上次刷新的 (mz, 布局, 色彩方案, 归一化, 样本)
+        
         # 连接鼠标事件
         self.mpl_connect('button_press_event', self.on_mouse_press)
         self.mpl_connect('motion_notify_event', self.on_mouse_move)
@@ -54,13 +440,7 @@ class SampleComparisonCanvas(FigureCanvas):
     
     def get_short_name(self, sample_name):
         """提取样本的简短名称"""
-        if 'sample' in sample_name.lower():
-            parts = sample_name.split('_')
-            sample_num = next((p for p in parts if 'sample' in p.lower()), '')
-            mode = next((p for p in parts if p in ['POS', 'NEG']), '')
-            if sample_num and mode:
-                return f"{sample_num}_{mode}"
-        return sample_name[:30] + '...' if len(sample_name) > 30 else sample_name
+        return _short_name(sample_name)
     
     def update_comparison(self, samples_data, mz_target, layout_mode='horizontal', colormap='hot', normalize=False):
         """
@@ -84,17 +464,19 @@ class SampleComparisonCanvas(FigureCanvas):
         self.layout_mode = layout_mode
         self.colormap = colormap
         
-        self.fig.clear()
-        self.sample_axes = {}  # 重置样本axes映射
-        
         # 初始化每个样本的ROI列表和计数器
         for sample_name, _ in samples_data:
             if sample_name not in self.sample_rois:
-                self.sample_rois[sample_name] = []
+                self.sample_rois[sample_name] = _empty_rois()
                 self.roi_counters[sample_name] = 0
-                self.roi_patches[sample_name] = []
         
         if not samples_data or len(samples_data) == 0:
+            self.fig.clear()
+            self.sample_axes = {}
+            self._layout_key = None
+            self._image_artists = {}
+            self._last_params = None
+            self.current_roi_patch = None
             ax = self.fig.add_subplot(111)
             ax.text(0.5, 0.5, '请选择要对比的样本',
                    ha='center', va='center', fontsize=14)
@@ -102,6 +484,23 @@ class SampleComparisonCanvas(FigureCanvas):
             self.draw()
             return
         
+        # m/z、布局和样本都未变时无需重建图像：只切换色彩方案或颜色范围
+        params = (mz_target, layout_mode, colormap, normalize,
+                  tuple((name, id(data)) for name, data in samples_data))
+        last_params = self._last_params
+        self._last_params = params
+        if (self._image_artists and last_params is not None
+                and params[:2] == last_params[:2] and params[4] == last_params[4]):
+            if colormap != last_params[2]:
+                for im, _ in self._image_artists.values():
+                    im.set_cmap(colormap)
+            if normalize != last_params[3]:
+                self._apply_color_range(normalize)
+            for im, cbar in self._image_artists.values():
+                cbar.update_normal(im)
+            self.draw_idle()
+            return
+        
         n_samples = len(samples_data)
         
         # 确定布局
@@ -112,134 +511,227 @@ class SampleComparisonCanvas(FigureCanvas):
             nrows, ncols = n_samples, 1
             figsize = (6, 4 * n_samples)
         
-        # 如果需要归一化，先计算全局强度范围
-        global_vmin, global_vmax = None, None
-        if normalize:
+        # 每个样本只提取一次m/z切片，归一化所需的全局最大值在同一遍中累计
+        slices = []  # [(sample_name, data, mz_index, actual_mz, intensity_map), ...]
+        sample_max_all = None
+        if normalize and self.debug:
             print("\n" + "="*60)
             print("🎨 归一化模式：计算全局颜色范围...")
-            sample_maxs = []
+        
+        for sample_name, data in samples_data:
+            # 查找最接近的m/z
+            mz_bins = data['mz_bins']
+            mz_index = _nearest_mz_index(mz_bins, mz_target)
+            actual_mz = mz_bins[mz_index]
             
-            for sample_name, data in samples_data:
-                mz_bins = data['mz_bins']
-                mz_index = np.argmin(np.abs(mz_bins - mz_target))
-                intensity_map = data['intensity_matrix'][:, mz_index]
-                
-                # 计算每个样本的统计信息
-                sample_min = np.min(intensity_map)  # 包含零值
-                sample_max = np.max(intensity_map)
-                nonzero_count = np.count_nonzero(intensity_map)
-                total_count = len(intensity_map)
-                
-                print(f"  [{self.get_short_name(sample_name)}] 强度范围: [{sample_min:.2f}, {sample_max:.2f}] "
-                      f"({nonzero_count}/{total_count}个非零点)")
-                sample_maxs.append(sample_max)
+            # 提取离子分布
+            intensity_map = data['intensity_matrix'][:, mz_index].astype(np.float32, copy=False)
+            slices.append((sample_name, data, mz_index, actual_mz, intensity_map))
             
-            if sample_maxs:
+            if normalize:
+                col_max = data.get('_col_max')
+                sample_max = col_max[mz_index] if col_max is not None else np.max(intensity_map)
+                
+                if self.debug:
+                    # 计算每个样本的统计信息（需要遍历整列，仅调试时输出）
+                    sample_min = np.min(intensity_map)  # 包含零值
+                    nonzero_count = np.count_nonzero(intensity_map)
+                    total_count = len(intensity_map)
+                    print(f"  [{self.get_short_name(sample_name)}] 强度范围: [{sample_min:.2f}, {sample_max:.2f}] "
+                          f"({nonzero_count}/{total_count}个非零点)")
+                sample_max_all = sample_max if sample_max_all is None else max(sample_max_all, sample_max)
+        
+        # 如果需要归一化，使用全局强度范围
+        global_vmin, global_vmax = None, None
+        if normalize:
+            if sample_max_all is not None:
                 # 质谱强度不会是负数，vmin设为0是合理的
                 global_vmin = 0
-                global_vmax = max(sample_maxs)
-                print(f"  [成功] 全局颜色范围: [0, {global_vmax:.2f}]")
-                print(f"  [STATS] 所有样本将使用此颜色范围，便于直接比较")
-                print(f"  [提示] vmin=0确保背景（零值）正确显示为最低颜色")
+                global_vmax = sample_max_all
+                if self.debug:
+                    print(f"  [成功] 全局颜色范围: [0, {global_vmax:.2f}]")
+                    print(f"  [STATS] 所有样本将使用此颜色范围，便于直接比较")
+                    print(f"  [提示] vmin=0确保背景（零值）正确显示为最低颜色")
             else:
                 print("  [警告] 未找到有效数据，将使用独立范围")
-            print("="*60)
+            if self.debug:
+                print("="*60)
+        
+        # 为每个样本重建2D图像
+        # 各样本的重建互不依赖，且NumPy的排序/散射操作会释放GIL，交给线程池并行；
+        # matplotlib绘图仍在主线程中进行
+        with ThreadPoolExecutor(max_workers=min(len(slices), os.cpu_count() or 1)) as pool:
+            reconstructed = list(pool.map(
+                lambda item: self._reconstruct(item[0], item[1], item[2], item[4]), slices
+            ))
+        images = [(sample_name, actual_mz, img, x_unique, y_unique)
+                  for (sample_name, _, _, actual_mz, _), (img, x_unique, y_unique)
+                  in zip(slices, reconstructed)]
+        
+        # 样本、布局和图像尺寸都未变时复用现有子图，只替换图像数据
+        use_global_range = normalize and global_vmin is not None and global_vmax is not None
+        layout_key = (nrows, ncols,
+                      tuple(name for name, *_ in images),
+                      tuple(img.shape for _, _, img, _, _ in images))
+        reuse = layout_key == self._layout_key
+        if reuse:
+            # 移除残留的临时ROI矩形；ROI矩形集合和标签由redraw_rois原地更新
+            if self.current_roi_patch is not None and self.current_roi_patch.axes is not None:
+                self.current_roi_patch.remove()
+        else:
+            self.fig.clear()
+            self.sample_axes = {}  # 重置样本axes映射
+            self._image_artists = {}
+            self._layout_key = layout_key
+        self.current_roi_patch = None
         
-        # 为每个样本创建子图
-        for idx, (sample_name, data) in enumerate(samples_data):
-            ax = self.fig.add_subplot(nrows, ncols, idx + 1)
-            self.sample_axes[sample_name] = ax  # 记录样本对应的axes
-            
-            # 查找最接近的m/z
-            mz_bins = data['mz_bins']
-            mz_index = np.argmin(np.abs(mz_bins - mz_target))
-            actual_mz = mz_bins[mz_index]
+        for idx, (sample_name, actual_mz, img, x_unique, y_unique) in enumerate(images):
+            if reuse:
+                ax = self.sample_axes[sample_name]
+                im, cbar = self._image_artists[sample_name]
+                im.set_data(img)
+                im.set_cmap(self.colormap)
+                if use_global_range:
+                    im.set_clim(global_vmin, global_vmax)
+                else:
+                    im.autoscale()
+                cbar.update_normal(im)
+            else:
+                ax = self.fig.add_subplot(nrows, ncols, idx + 1)
+                self.sample_axes[sample_name] = ax  # 记录样本对应的axes
+                
+                # 显示图像 - 使用像素坐标（与主GUI一致）
+                # 如果启用归一化，使用全局vmin/vmax；否则自动范围
+                # 每个像素即一次测量：最近邻显示，不做重采样；导出PDF时整幅图栅格化
+                imshow_kwargs = {
+                    'cmap': self.colormap,
+                    'aspect': 'auto',
+                    'origin': 'lower',
+                    'interpolation': 'nearest',
+                    'resample': False,
+                    'rasterized': True,
+                }
+                if use_global_range:
+                    imshow_kwargs['vmin'] = global_vmin
+                    imshow_kwargs['vmax'] = global_vmax
+                
+                im = ax.imshow(img, **imshow_kwargs)
+                
+                # 添加色标
+                cbar = self.fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+                cbar.set_label('Intensity', fontsize=8)
+                self._image_artists[sample_name] = (im, cbar)
             
-            # 提取离子分布
-            intensity_map = data['intensity_matrix'][:, mz_index]
-            coords = data['coords']
+            # 设置标题（包含样本名称和实际m/z）
+            short_name = self.get_short_name(sample_name)
+            ax.set_title(f'{short_name}\nm/z {actual_mz:.4f}', fontsize=10, fontweight='bold')
             
+            # 设置坐标轴标签（物理坐标范围作为参考）
+            ax.set_xlabel(f'X Position (像素, {x_unique.min():.1f}~{x_unique.max():.1f} mm)', fontsize=8)
+            ax.set_ylabel(f'Y Position (像素, {y_unique.min():.1f}~{y_unique.max():.1f} mm)', fontsize=8)
+        
+        # 只在子图重建时计算布局；复用子图时axes几何不变，无需再次求解
+        if not reuse:
+            self.fig.tight_layout()
+        
+        # 重绘已存在的ROI
+        self.redraw_rois()
+        
+        self.draw()
+    
+    def _reconstruct(self, sample_name, data, mz_index, intensity_map):
+        """
+        将一个样本的m/z切片重建为2D图像
+        
+        首次重建时把data['coords']换成像素坐标并缓存像素索引，之后直接复用。
+        只读写该样本自己的data字典，可在线程池中并行调用。
+        
+        返回:
+            (img, x_unique, y_unique)
+        """
+        coords = data['coords']
+        
+        if self.debug:
             print(f"\n{'='*60}")
             print(f"[SEARCH] [{sample_name}] 图像重建调试:")
             print(f"   coords类型: {type(coords)}")
             print(f"   coords形状: {coords.shape if isinstance(coords, np.ndarray) else 'N/A'}")
             print(f"   intensity_map形状: {intensity_map.shape}")
-            
-            # 重建2D图像 - 使用与主GUI完全相同的方法
-            try:
-                # 获取唯一的x和y坐标
-                x_unique = np.unique(coords[:, 0])
-                y_unique = np.unique(coords[:, 1])
-                
-                print(f"   X: {len(x_unique)}个唯一值, 范围={x_unique.min():.1f}~{x_unique.max():.1f}")
-                print(f"   Y: {len(y_unique)}个唯一值, 范围={y_unique.min():.1f}~{y_unique.max():.1f}")
-                
-                # 创建网格
-                img = np.zeros((len(y_unique), len(x_unique)))
+        
+        # 重建2D图像 - 使用与主GUI完全相同的方法
+        try:
+            if data.get('_pixel_coords') is coords:
+                # 坐标网格未变：复用首次重建时缓存的像素索引
+                xi, yi = data['_xi'], data['_yi']
+                x_unique = data['x_unique']
+                y_unique = data['y_unique']
+            else:
+                # 获取唯一的x和y坐标，以及每个点的像素索引（规则网格无需排序）
+                x_unique, xi = _grid_index(coords[:, 0])
+                y_unique, yi = _grid_index(coords[:, 1])
                 
-                # 创建像素坐标数组（用于ROI分析）
-                pixel_coords = np.zeros((len(coords), 2))
+                if self.debug:
+                    print(f"   X: {len(x_unique)}个唯一值, 范围={x_unique.min():.1f}~{x_unique.max():.1f}")
+                    print(f"   Y: {len(y_unique)}个唯一值, 范围={y_unique.min():.1f}~{y_unique.max():.1f}")
                 
-                # 填充图像 - 与main_gui_ultimate.py完全相同的方法
-                for i, (x, y) in enumerate(coords):
-                    xi = np.where(x_unique == x)[0][0]
-                    yi = np.where(y_unique == y)[0][0]
-                    img[yi, xi] = intensity_map[i]
-                    # 存储像素坐标（用于ROI分析）
-                    pixel_coords[i] = [xi, yi]
+                # 像素坐标数组（用于ROI分析）
+                pixel_coords = np.column_stack((xi, yi)).astype(np.int32)
                 
-                # 更新data中的coords为像素坐标
+                # 更新data中的coords为像素坐标，并缓存索引供后续刷新复用
                 data['coords'] = pixel_coords
                 data['x_unique'] = x_unique
                 data['y_unique'] = y_unique
+                data['_xi'] = xi
+                data['_yi'] = yi
+                data['_pixel_coords'] = pixel_coords
                 
-                print(f"  [成功] 正确重建图像: {img.shape}, 非零像素: {np.count_nonzero(img)}/{img.size}")
-                print(f"  [STATS] 像素坐标范围: X[0, {len(x_unique)-1}] Y[0, {len(y_unique)-1}]")
-                    
-            except Exception as e:
-                print(f"  [警告] 重建图像失败: {e}")
-                import traceback
-                traceback.print_exc()
-                # 使用简单reshape作为后备方案
-                side_length = int(np.sqrt(len(intensity_map)))
-                if side_length > 0 and side_length * side_length <= len(intensity_map):
-                    img = intensity_map[:side_length**2].reshape(side_length, side_length)
-                    print(f"  使用reshape后备方案: {img.shape}")
-                else:
-                    img = np.zeros((10, 10))
-                    print(f"  使用空白图像")
-            
-            # 显示图像 - 使用像素坐标（与主GUI一致）
-            # 如果启用归一化，使用全局vmin/vmax；否则自动范围
-            imshow_kwargs = {
-                'cmap': self.colormap,
-                'aspect': 'auto',
-                'origin': 'lower'
-            }
-            if normalize and global_vmin is not None and global_vmax is not None:
-                imshow_kwargs['vmin'] = global_vmin
-                imshow_kwargs['vmax'] = global_vmax
-            
-            im = ax.imshow(img, **imshow_kwargs)
+                # 有测量数据的像素（ROI统计时排除网格中的空位）
+                measured = np.zeros((len(y_unique), len(x_unique)), dtype=bool)
+                measured[yi, xi] = True
+                data['_measured'] = measured
             
-            # 设置标题（包含样本名称和实际m/z）
-            short_name = self.get_short_name(sample_name)
-            ax.set_title(f'{short_name}\nm/z {actual_mz:.4f}', fontsize=10, fontweight='bold')
+            # 创建网格并一次性填充图像（单次遍历，不生成花式索引的中间数组）
+            img = np.zeros((len(y_unique), len(x_unique)), dtype=np.float32)
+            _scatter_image_kernel()(xi, yi, intensity_map, img)
             
-            # 添加色标
-            cbar = self.fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
-            cbar.set_label('Intensity', fontsize=8)
+            # 保存当前m/z的2D图像，ROI统计可直接切片
+            data['_img'] = img
+            data['_img_mz_index'] = mz_index
             
-            # 设置坐标轴标签（物理坐标范围作为参考）
-            ax.set_xlabel(f'X Position (像素, {x_unique.min():.1f}~{x_unique.max():.1f} mm)', fontsize=8)
-            ax.set_ylabel(f'Y Position (像素, {y_unique.min():.1f}~{y_unique.max():.1f} mm)', fontsize=8)
-        
-        self.fig.tight_layout()
+            if self.debug:
+                print(f"  [成功] 正确重建图像: {img.shape}, 非零像素: {np.count_nonzero(img)}/{img.size}")
+                print(f"  [STATS] 像素坐标范围: X[0, {len(x_unique)-1}] Y[0, {len(y_unique)-1}]")
+                
+        except Exception as e:
+            print(f"  [警告] 重建图像失败: {e}")
+            import traceback
+            traceback.print_exc()
+            # 使用简单reshape作为后备方案
+            side_length = int(np.sqrt(len(intensity_map)))
+            if side_length > 0 and side_length * side_length <= len(intensity_map):
+                img = intensity_map[:side_length**2].reshape(side_length, side_length)
+                print(f"  使用reshape后备方案: {img.shape}")
+            else:
+                img = np.zeros((10, 10), dtype=np.float32)
+                print(f"  使用空白图像")
+            x_unique = np.arange(img.shape[1])
+            y_unique = np.arange(img.shape[0])
         
-        # 重绘已存在的ROI
-        self.redraw_rois()
+        return img, x_unique, y_unique
+    
+    def _apply_color_range(self, normalize):
+        """按归一化设置更新已有图像的颜色范围
         
-        self.draw()
+        归一化时所有样本使用 [0, 全局最大强度]，否则每个样本按自身数据自动范围。
+        """
+        if normalize:
+            global_vmax = max(float(np.max(im.get_array()))
+                              for im, _ in self._image_artists.values())
+            for im, _ in self._image_artists.values():
+                im.set_clim(0, global_vmax)
+        else:
+            for im, _ in self._image_artists.values():
+                im.autoscale()
     
     def start_roi_selection(self, roi_type):
         """开始ROI选择 - 直接模式"""
@@ -258,62 +750,64 @@ class SampleComparisonCanvas(FigureCanvas):
         if sample_name:
             # 清除指定样本的ROI
             if sample_name in self.sample_rois:
-                self.sample_rois[sample_name] = []
-                self.roi_patches[sample_name] = []
+                self.sample_rois[sample_name] = _empty_rois()
                 print(f"[成功] 已清除 [{sample_name}] 的所有ROI")
         else:
             # 清除所有样本的ROI
             self.sample_rois = {}
-            self.roi_patches = {}
             self.roi_counters = {}
             print("[成功] 已清除所有样本的ROI")
         
         self.roi_mode = None
         
-        # 重新绘制图形
+        # 重新绘制图形（redraw_rois会移除已清除ROI的矩形和标签）
         if self.samples_data:
-            for ax in self.fig.axes:
-                # 移除ROI patches
-                for patch in list(ax.patches):
-                    patch.remove()
             self.redraw_rois()
             self.draw()
     
     def redraw_rois(self):
-        """在每个子图上绘制该样本的ROI"""
-        if not self.sample_rois:
-            return
-        
-        # 清除旧的patches
-        for sample_name in self.roi_patches:
-            self.roi_patches[sample_name] = []
+        """在每个子图上绘制该样本的ROI
         
-        # 为每个样本绘制其自己的ROI
-        for sample_name, rois in self.sample_rois.items():
-            if sample_name not in self.sample_axes:
-                continue
+        每个子图的ROI矩形合并为一个PatchCollection一次添加；
+        标签Text对象缓存复用，重绘时只更新位置和文字。
+        """
+        for sample_name, ax in self.sample_axes.items():
+            rois = self.sample_rois.get(sample_name)
+            roi_coords = rois['coords'] if rois is not None else np.zeros((0, 4))
+            roi_names = rois['names'] if rois is not None else []
             
-            ax = self.sample_axes[sample_name]
+            # 移除旧的矩形集合（子图重建后旧artist已随figure清除）
+            collection = self.roi_patches.pop(sample_name, None)
+            if collection is not None and collection.axes is ax:
+                collection.remove()
             
-            for roi in rois:
-                if roi.roi_type == 'rectangle':
-                    x1, y1, x2, y2 = roi.coords
-                    width = x2 - x1
-                    height = y2 - y1
-                    
-                    rect = Rectangle(
-                        (x1, y1), width, height,
-                        fill=False, edgecolor='yellow', linewidth=2,
-                        linestyle='--'
-                    )
-                    ax.add_patch(rect)
-                    self.roi_patches[sample_name].append(rect)
-                    
-                    # 添加标签
-                    ax.text(x1, y1, roi.name, 
-                           color='yellow', fontsize=8,
-                           bbox=dict(boxstyle='round,pad=0.3', 
-                                   facecolor='black', alpha=0.7))
+            if roi_names:
+                sizes = roi_coords[:, 2:] - roi_coords[:, :2]
+                rects = [Rectangle((x1, y1), w, h)
+                         for (x1, y1), (w, h) in zip(roi_coords[:, :2].tolist(), sizes.tolist())]
+                collection = PatchCollection(
+                    rects, facecolor='none', edgecolor='yellow',
+                    linewidth=2, linestyle='--'
+                )
+                ax.add_collection(collection, autolim=False)
+                self.roi_patches[sample_name] = collection
+            
+            # 更新标签：复用已有Text，多余的移除，不足的新建
+            labels = [t for t in self.roi_labels.get(sample_name, []) if t.axes is ax]
+            for text in labels[len(roi_names):]:
+                text.remove()
+            labels = labels[:len(roi_names)]
+            
+            for i, (name, (x1, y1)) in enumerate(zip(roi_names, roi_coords[:, :2].tolist())):
+                if i < len(labels):
+                    labels[i].set_position((x1, y1))
+                    labels[i].set_text(name)
+                else:
+                    labels.append(ax.text(x1, y1, name, 
+                                          color='yellow', fontsize=8,
+                                          bbox=dict(boxstyle='round,pad=0.3', 
+                                                    facecolor='black', alpha=0.7)))
+            self.roi_labels[sample_name] = labels
     
     def on_mouse_press(self, event):
         """鼠标按下事件 - 自动检测在哪个样本上"""
@@ -335,6 +829,19 @@ class SampleComparisonCanvas(FigureCanvas):
         self.current_sample = clicked_sample
         self.roi_start = (event.xdata, event.ydata)
         
+        # 临时ROI矩形设为animated，不参与整图重绘；缓存不含它的axes背景，
+        # 拖动时只恢复背景并重绘这一个矩形
+        if self.current_roi_patch:
+            self.current_roi_patch.remove()
+        self.current_roi_patch = Rectangle(
+            self.roi_start, 0, 0,
+            fill=False, edgecolor='yellow', linewidth=2,
+            linestyle='--', alpha=0.7, animated=True
+        )
+        event.inaxes.add_patch(self.current_roi_patch)
+        self.draw()
+        self.roi_background = self.copy_from_bbox(event.inaxes.bbox)
+        
         # 提取简短名称用于显示
         short_name = self.get_short_name(clicked_sample)
         print(f"📍 [{short_name}] ROI起点: ({event.xdata:.1f}, {event.ydata:.1f})")
@@ -344,36 +851,34 @@ class SampleComparisonCanvas(FigureCanvas):
         if not self.roi_mode or not self.roi_start or not event.inaxes:
             return
         
-        # 移除临时ROI patch
-        if self.current_roi_patch:
-            self.current_roi_patch.remove()
+        patch = self.current_roi_patch
+        if patch is None or self.roi_background is None or event.inaxes is not patch.axes:
+            return
         
-        # 绘制临时ROI矩形
+        # 更新临时ROI矩形
         x1, y1 = self.roi_start
-        x2, y2 = event.xdata, event.ydata
-        width = x2 - x1
-        height = y2 - y1
+        patch.set_width(event.xdata - x1)
+        patch.set_height(event.ydata - y1)
         
-        self.current_roi_patch = Rectangle(
-            (x1, y1), width, height,
-            fill=False, edgecolor='yellow', linewidth=2,
-            linestyle='--', alpha=0.7
-        )
-        event.inaxes.add_patch(self.current_roi_patch)
-        self.draw()
+        # 只重绘该axes上的临时矩形（blit），不重新渲染整个figure
+        self.restore_region(self.roi_background)
+        event.inaxes.draw_artist(patch)
+        self.blit(event.inaxes.bbox)
     
     def on_mouse_release(self, event):
         """鼠标释放事件"""
         if not self.roi_mode or not self.roi_start or not event.inaxes or not self.current_sample:
             return
         
+        self.roi_background = None
+        
         # 检查是否在当前样本的axes上释放
         if event.inaxes != self.sample_axes.get(self.current_sample):
             self.roi_start = None
             if self.current_roi_patch:
                 self.current_roi_patch.remove()
                 self.current_roi_patch = None
-            self.draw()
+            self.draw_idle()
             return
         
         # 移除临时patch
@@ -394,23 +899,17 @@ class SampleComparisonCanvas(FigureCanvas):
         short_name = self.get_short_name(self.current_sample)
         roi_name = f"{short_name}_ROI_{self.roi_counters[self.current_sample]}"
         
-        roi = ROI(
-            name=roi_name,
-            roi_type=self.roi_mode,
-            coords=(x1, y1, x2, y2)
-        )
-        
-        # 添加到该样本的ROI列表
-        if self.current_sample not in self.sample_rois:
-            self.sample_rois[self.current_sample] = []
-        self.sample_rois[self.current_sample].append(roi)
+        # 添加到该样本的ROI表
+        rois = self.sample_rois.setdefault(self.current_sample, _empty_rois())
+        rois['coords'] = np.concatenate([rois['coords'], [[x1, y1, x2, y2]]])
+        rois['names'].append(roi_name)
         
         print(f"\n[EDIT]  [{short_name}] 创建ROI: {roi_name}")
         print(f"   坐标: X[{x1:.1f}, {x2:.1f}] Y[{y1:.1f}, {y2:.1f}]")
         
         # 重绘ROI
         self.redraw_rois()
-        self.draw()
+        self.draw_idle()
         
         # 重置ROI模式（继续绘制）
         self.roi_start = None
@@ -434,6 +933,7 @@ class SampleComparisonDialog(QDialog):
         self.lock_mass_manager = lock_mass_manager  # Lock Mass管理器
         self.selected_samples = []
         self.loaded_data = {}  # {sample_path: data}
+        self.debug = False  # 是否输出ROI分析/导出的逐项调试信息
         
         self.setWindowTitle('多样本质谱成像对比')
         self.setGeometry(100, 100, 1400, 900)
@@ -628,6 +1128,14 @@ class SampleComparisonDialog(QDialog):
                             except Exception as e:
                                 print(f"  [警告] 校准出错: {e}，使用原始数据")
                         
+                        # 改为列优先的float32存储：intensity_matrix[:, mz_index]成为连续内存视图，
+                        # 切换m/z时只需顺序读取一列，且读取量减半（显示与统计不需要float64精度）
+                        data['intensity_matrix'] = np.asfortranarray(data['intensity_matrix'],
+                                                                     dtype=np.float32)
+                        
+                        # 每个m/z的最大强度（加载时算一次），归一化时按下标直接读取
+                        data['_col_max'] = data['intensity_matrix'].max(axis=0)
+                        
                         self.loaded_data[sample_name] = data
                         self.loaded_list.addItem(f"[成功] {sample_name}")
                         print(f"  加载成功: {data['n_scans']} 扫描, {len(data['mz_bins'])} m/z bins")
@@ -665,7 +1173,7 @@ class SampleComparisonDialog(QDialog):
     
     def update_roi_stats(self):
         """更新ROI统计信息"""
-        total_rois = sum(len(rois) for rois in self.comparison_canvas.sample_rois.values())
+        total_rois = sum(len(rois['names']) for rois in self.comparison_canvas.sample_rois.values())
         self.roi_stats_label.setText(f'所有样本的ROI: {total_rois}个')
     
     def on_canvas_roi_updated(self):
@@ -710,36 +1218,36 @@ class SampleComparisonDialog(QDialog):
     def analyze_rois(self):
         """分析每个样本的ROI数据"""
         try:
-            print("[SEARCH] 开始ROI分析...")
+            if self.debug:
+                print("[SEARCH] 开始ROI分析...")
             
             if len(self.loaded_data) == 0:
                 QMessageBox.warning(self, '警告', '请先生成对比图')
                 return
             
             # 检查是否有任何ROI
-            total_rois = sum(len(rois) for rois in self.comparison_canvas.sample_rois.values())
-            print(f"[STATS] 总ROI数: {total_rois}")
+            total_rois = sum(len(rois['names']) for rois in self.comparison_canvas.sample_rois.values())
+            if self.debug:
+                print(f"[STATS] 总ROI数: {total_rois}")
             
             if total_rois == 0:
                 QMessageBox.warning(self, '警告', '请先为样本添加ROI')
                 return
             
-            # 创建ROI分析器
-            analyzer = ROIAnalyzer()
             mz_target = self.mz_input.value()
             
-            results_text = f"[STATS] ROI分析结果 (m/z {mz_target:.4f}):\n\n"
+            # 结果文本分段收集，最后一次拼接
+            results_parts = [f"[STATS] ROI分析结果 (m/z {mz_target:.4f}):\n\n"]
             
             # 为每个样本分析其ROI
             for sample_name, rois in self.comparison_canvas.sample_rois.items():
-                if not rois:
+                if not rois['names']:
                     continue
                 
-                print(f"[FOLDER] 分析样本: {sample_name}, ROI数: {len(rois)}")
+                if self.debug:
+                    print(f"[FOLDER] 分析样本: {sample_name}, ROI数: {len(rois['names'])}")
                 
-                results_text += f"{'='*60}\n"
-                results_text += f"[FOLDER] 样本: {sample_name}\n"
-                results_text += f"{'='*60}\n\n"
+                results_parts.append(f"{'='*60}\n[FOLDER] 样本: {sample_name}\n{'='*60}\n\n")
                 
                 # 获取样本数据
                 if sample_name not in self.loaded_data:
@@ -748,7 +1256,7 @@ class SampleComparisonDialog(QDialog):
                 
                 data = self.loaded_data[sample_name]
                 mz_bins = data['mz_bins']
-                mz_index = np.argmin(np.abs(mz_bins - mz_target))
+                mz_index = _nearest_mz_index(mz_bins, mz_target)
                 actual_mz = mz_bins[mz_index]
                 coords = data['coords']
                 intensity_map = data['intensity_matrix'][:, mz_index]
@@ -758,14 +1266,14 @@ class SampleComparisonDialog(QDialog):
                 y_unique_coords = data.get('y_unique', None)
                 
                 # 分析该样本的每个ROI
-                for roi in rois:
-                    print(f"  [TARGET] 分析ROI: {roi.name}")
-                    results_text += f"[TARGET] {roi.name}:\n"
-                    results_text += f"  🔬 实际m/z: {actual_mz:.4f}\n"
+                for roi_name, roi_coords in zip(rois['names'], rois['coords'].tolist()):
+                    if self.debug:
+                        print(f"  [TARGET] 分析ROI: {roi_name}")
+                    results_parts.append(f"[TARGET] {roi_name}:\n  🔬 实际m/z: {actual_mz:.4f}\n")
                     
                     try:
                         # ROI坐标（像素坐标系）
-                        x1, y1, x2, y2 = roi.coords
+                        x1, y1, x2, y2 = roi_coords
                         roi_width = abs(x2 - x1)
                         roi_height = abs(y2 - y1)
                         roi_area = roi_width * roi_height
@@ -783,44 +1291,59 @@ class SampleComparisonDialog(QDialog):
                         else:
                             physical_info = ""
                         
-                        # 使用ROIAnalyzer分析ROI区域
-                        # 正确的方法签名：analyze_roi(roi, data, mz_index)
-                        stats = analyzer.analyze_roi(roi, data, mz_index)
+                        # 统计ROI区域（单次遍历内核）
+                        stats = _analyze_roi(roi_coords, data, mz_index)
                         
                         if stats and stats['n_points'] > 0:
                             # 计算信号密度（总信号/面积）
                             signal_density = stats['sum'] / roi_area if roi_area > 0 else 0
                             
-                            results_text += f"  📍 数据点数: {stats['n_points']}\n"
-                            results_text += f"  📏 ROI尺寸（像素）: {roi_width:.1f} × {roi_height:.1f} = {roi_area:.1f} 像素²\n"
-                            results_text += physical_info
-                            results_text += f"  [TREND] 平均强度: {stats['mean']:.2f}\n"
-                            results_text += f"  [STATS] 中位数强度: {stats['median']:.2f}\n"
-                            results_text += f"  [UP]  最大强度: {stats['max']:.2f}\n"
-                            results_text += f"  [DOWN]  最小强度: {stats['min']:.2f}\n"
-                            results_text += f"  📐 标准差: {stats['std']:.2f}\n"
-                            results_text += f"  ∑  总强度: {stats['sum']:.2f}\n"
-                            results_text += f"  [TARGET] 信号密度: {signal_density:.2f} (强度/像素²)\n"
+                            results_parts.append(
+                                f"  📍 数据点数: {stats['n_points']}\n"
+                                f"  📏 ROI尺寸（像素）: {roi_width:.1f} × {roi_height:.1f} = {roi_area:.1f} 像素²\n"
+                                f"{physical_info}"
+                                f"  [TREND] 平均强度: {stats['mean']:.2f}\n"
+                                f"  [STATS] 中位数强度: {stats['median']:.2f}\n"
+                                f"  [UP]  最大强度: {stats['max']:.2f}\n"
+                                f"  [DOWN]  最小强度: {stats['min']:.2f}\n"
+                                f"  📐 标准差: {stats['std']:.2f}\n"
+                                f"  ∑  总强度: {stats['sum']:.2f}\n"
+                                f"  [TARGET] 信号密度: {signal_density:.2f} (强度/像素²)\n"
+                            )
                         else:
-                            results_text += f"  📏 ROI尺寸（像素）: {roi_width:.1f} × {roi_height:.1f} = {roi_area:.1f} 像素²\n"
-                            results_text += physical_info
-                            results_text += f"  [警告]  ROI区域内无数据点\n"
+                            results_parts.append(
+                                f"  📏 ROI尺寸（像素）: {roi_width:.1f} × {roi_height:.1f} = {roi_area:.1f} 像素²\n"
+                                f"{physical_info}"
+                                f"  [警告]  ROI区域内无数据点\n"
+                            )
                     except Exception as roi_error:
-                        print(f"[错误] ROI分析错误 ({roi.name}): {roi_error}")
+                        print(f"[错误] ROI分析错误 ({roi_name}): {roi_error}")
                         import traceback
                         traceback.print_exc()
-                        results_text += f"  [错误] 分析错误: {str(roi_error)}\n"
+                        results_parts.append(f"  [错误] 分析错误: {str(roi_error)}\n")
                     
-                    results_text += "\n"
+                    results_parts.append("\n")
                 
-                results_text += "\n"
+                results_parts.append("\n")
             
-            print("[成功] ROI分析完成，准备显示结果...")
+            results_text = "".join(results_parts)
+            
+            if self.debug:
+                print("[成功] ROI分析完成，准备显示结果...")
+            
+            if len(results_text) > LARGE_REPORT_CHARS:
+                with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False,
+                                                 encoding='utf-8') as f:
+                    f.write(results_text)
+                QDesktopServices.openUrl(QUrl.fromLocalFile(f.name))
+                print(f"[成功] ROI分析结果较大，已写入: {f.name}")
+                return
             
             # 显示完整结果对话框
             from PyQt5.QtWidgets import QTextEdit, QVBoxLayout, QPushButton
             
-            print("[NOTE] 创建结果对话框...")
+            if self.debug:
+                print("[NOTE] 创建结果对话框...")
             
             # 创建自定义对话框
             dialog = QDialog(self)
@@ -840,9 +1363,11 @@ class SampleComparisonDialog(QDialog):
             close_btn.clicked.connect(dialog.accept)
             layout.addWidget(close_btn)
             
-            print("[LAUNCH] 显示对话框...")
+            if self.debug:
+                print("[LAUNCH] 显示对话框...")
             dialog.exec_()
-            print("[成功] 对话框已关闭")
+            if self.debug:
+                print("[成功] 对话框已关闭")
             
         except Exception as e:
             print(f"[错误] analyze_rois 严重错误: {e}")
@@ -854,21 +1379,32 @@ class SampleComparisonDialog(QDialog):
         """导出每个样本的ROI数据"""
         try:
             # 检查是否有任何ROI
-            total_rois = sum(len(rois) for rois in self.comparison_canvas.sample_rois.values())
+            total_rois = sum(len(rois['names']) for rois in self.comparison_canvas.sample_rois.values())
             if total_rois == 0:
                 QMessageBox.warning(self, '警告', '请先为样本添加ROI')
                 return
             
-            print("[FOLDER] 准备导出ROI数据...")
+            if self.debug:
+                print("[FOLDER] 准备导出ROI数据...")
+            
+            # 有pyarrow时默认导出Parquet（列式二进制，写入快、文件小），Excel作为后备
+            if HAS_PYARROW:
+                default_ext = 'parquet'
+                file_filter = ('Parquet Files (*.parquet);;Feather Files (*.feather);;'
+                               'Excel Files (*.xlsx);;CSV Files (*.csv)')
+            else:
+                default_ext = 'xlsx'
+                file_filter = 'Excel Files (*.xlsx);;CSV Files (*.csv)'
             
             filename, _ = QFileDialog.getSaveFileName(
                 self,
                 '导出ROI数据',
-                f'roi_per_sample_mz_{self.mz_input.value():.4f}.xlsx',
-                'Excel Files (*.xlsx);;CSV Files (*.csv)'
+                f'roi_per_sample_mz_{self.mz_input.value():.4f}.{default_ext}',
+                file_filter
             )
             
-            print(f"选择的文件名: {filename}")
+            if self.debug:
+                print(f"选择的文件名: {filename}")
         except Exception as e:
             print(f"[错误] 文件对话框错误: {e}")
             import traceback
@@ -878,113 +1414,53 @@ class SampleComparisonDialog(QDialog):
         
         if filename:
             try:
-                print(f"[STATS] 开始导出ROI数据到: {filename}")
+                if self.debug:
+                    print(f"[STATS] 开始导出ROI数据到: {filename}")
                 
-                # 创建ROI分析器
-                analyzer = ROIAnalyzer()
                 mz_target = self.mz_input.value()
                 
-                # 创建数据表
-                data_list = []
-                
                 # 为每个样本导出其ROI数据
-                for sample_name, rois in self.comparison_canvas.sample_rois.items():
-                    if not rois or sample_name not in self.loaded_data:
-                        continue
-                    
-                    print(f"  [FOLDER] 导出样本: {sample_name}, ROI数: {len(rois)}")
-                    
-                    data = self.loaded_data[sample_name]
-                    mz_bins = data['mz_bins']
-                    mz_index = np.argmin(np.abs(mz_bins - mz_target))
-                    actual_mz = mz_bins[mz_index]
-                    coords = data['coords']
-                    intensity_map = data['intensity_matrix'][:, mz_index]
-                    
-                    # 获取物理坐标映射（用于导出）
-                    x_unique_coords = data.get('x_unique', None)
-                    y_unique_coords = data.get('y_unique', None)
-                    
-                    for roi in rois:
-                        # 计算ROI面积（像素坐标系）
-                        x1, y1, x2, y2 = roi.coords
-                        roi_width = abs(x2 - x1)
-                        roi_height = abs(y2 - y1)
-                        roi_area = roi_width * roi_height
-                        
-                        # 使用ROIAnalyzer分析ROI区域
-                        # 正确的方法签名：analyze_roi(roi, data, mz_index)
-                        stats = analyzer.analyze_roi(roi, data, mz_index)
-                        
-                        # 计算物理坐标（如果可用）
-                        if x_unique_coords is not None and y_unique_coords is not None:
-                            try:
-                                x1_phys = x_unique_coords[int(min(x1, x2))]
-                                x2_phys = x_unique_coords[min(int(max(x1, x2)), len(x_unique_coords)-1)]
-                                y1_phys = y_unique_coords[int(min(y1, y2))]
-                                y2_phys = y_unique_coords[min(int(max(y1, y2)), len(y_unique_coords)-1)]
-                            except:
-                                x1_phys = x2_phys = y1_phys = y2_phys = 0
-                        else:
-                            x1_phys = x2_phys = y1_phys = y2_phys = 0
-                        
-                        row_data = {
-                            'Sample': sample_name,
-                            'ROI': roi.name,
-                            'm/z_target': mz_target,
-                            'm/z_actual': actual_mz,
-                            'X_min_pixel': min(roi.coords[0], roi.coords[2]),
-                            'X_max_pixel': max(roi.coords[0], roi.coords[2]),
-                            'Y_min_pixel': min(roi.coords[1], roi.coords[3]),
-                            'Y_max_pixel': max(roi.coords[1], roi.coords[3]),
-                            'X_min_mm': x1_phys,
-                            'X_max_mm': x2_phys,
-                            'Y_min_mm': y1_phys,
-                            'Y_max_mm': y2_phys,
-                            'ROI_width_pixel': roi_width,
-                            'ROI_height_pixel': roi_height,
-                            'ROI_area_pixel2': roi_area,
-                        }
-                        
-                        # 添加统计数据
-                        if stats and stats['n_points'] > 0:
-                            # 计算信号密度（总信号/面积）
-                            signal_density = stats['sum'] / roi_area if roi_area > 0 else 0
-                            
-                            row_data.update({
-                                'num_points': stats['n_points'],
-                                'mean_intensity': stats['mean'],
-                                'median_intensity': stats['median'],
-                                'max_intensity': stats['max'],
-                                'min_intensity': stats['min'],
-                                'std_intensity': stats['std'],
-                                'total_intensity': stats['sum'],
-                                'signal_density': signal_density,
-                            })
-                        else:
-                            row_data.update({
-                                'num_points': 0,
-                                'mean_intensity': 0,
-                                'median_intensity': 0,
-                                'max_intensity': 0,
-                                'min_intensity': 0,
-                                'std_intensity': 0,
-                                'total_intensity': 0,
-                                'signal_density': 0,
-                            })
-                        
-                        data_list.append(row_data)
+                active = [(s, r) for s, r in self.comparison_canvas.sample_rois.items()
+                          if r['names'] and s in self.loaded_data]
+                if self.debug:
+                    for sample_name, rois in active:
+                        print(f"  [FOLDER] 导出样本: {sample_name}, ROI数: {len(rois['names'])}")
+                jobs = [(sample_name, rois, self.loaded_data[sample_name])
+                        for sample_name, rois in active]
+                
+                # 各样本的ROI统计互不依赖，交给线程池并行（NumPy运算会释放GIL）
+                with ThreadPoolExecutor(max_workers=max(1, min(len(jobs), os.cpu_count() or 1))) as pool:
+                    sample_columns = list(pool.map(
+                        lambda job: _compute_sample_columns(job[0], job[1], job[2], mz_target), jobs
+                    ))
                 
-                print(f"📋 创建DataFrame，总行数: {len(data_list)}")
-                df = pd.DataFrame(data_list)
+                # 按列合并各样本的结果（DataFrame直接由列构建，无需逐行推断）
+                columns = {field: [] for field in ROI_EXPORT_FIELDS}
+                for sample_data in sample_columns:
+                    for field in ROI_EXPORT_FIELDS:
+                        columns[field].extend(sample_data[field])
                 
-                print(f"[SAVE] 写入文件: {filename}")
+                if self.debug:
+                    print(f"[SAVE] 写入文件: {filename}，总行数: {len(columns['Sample'])}")
                 if filename.endswith('.csv'):
-                    df.to_csv(filename, index=False)
+                    # CSV只含数字和短字符串，直接逐行写出，不经过DataFrame
+                    with open(filename, 'w', newline='', encoding='utf-8', buffering=1 << 20) as f:
+                        writer = csv.writer(f)
+                        writer.writerow(ROI_EXPORT_FIELDS)
+                        writer.writerows(zip(*(columns[field] for field in ROI_EXPORT_FIELDS)))
                 else:
-                    df.to_excel(filename, index=False, engine='openpyxl')
+                    # pandas只在导出表格文件时才用到，推迟到此处导入以加快对话框打开
+                    import pandas as pd
+                    df = pd.DataFrame(columns, columns=ROI_EXPORT_FIELDS)
+                    if filename.endswith('.parquet'):
+                        df.to_parquet(filename, engine='pyarrow', compression='snappy', index=False)
+                    elif filename.endswith('.feather'):
+                        df.to_feather(filename)
+                    else:
+                        df.to_excel(filename, index=False,
+                                    engine='xlsxwriter' if HAS_XLSXWRITER else 'openpyxl')
                 
-                num_samples = len([s for s in self.comparison_canvas.sample_rois if self.comparison_canvas.sample_rois[s]])
+                num_samples = len(active)
                 print(f"[成功] ROI数据已导出: {filename} ({num_samples} 样本, {total_rois} ROIs)")
                 
                 QMessageBox.information(self, '成功', 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代谢物注释缓存数据库测试
+"""
+
+import sqlite3
+import unittest
+import shutil
+import tempfile
+from pathlib import Path
+import sys
+
+# 添加父目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from metabolite_cache_db import MetaboliteCacheDB
+
+
+def _annotation(name, theoretical_mz, measured_mz):
+    """构造注释结果字典"""
+    error_da = abs(measured_mz - theoretical_mz)
+    return {
+        'name': name,
+        'formula': 'C18H34O2',
+        'hmdb_id': 'HMDB0000207',
+        'theoretical_mz': theoretical_mz,
+        'measured_mz': measured_mz,
+        'error_ppm': error_da / theoretical_mz * 1e6,
+        'error_da': error_da,
+        'source': 'HMDB',
+    }
+
+
+class TestMetaboliteCacheDB(unittest.TestCase):
+    """缓存数据库测试"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = str(Path(self.temp_dir) / "metabolite_cache.db")
+        self.cache_db = MetaboliteCacheDB(self.db_path)
+    
+    def tearDown(self):
+        """测试后清理"""
+        self.cache_db.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _count_committed(self):
+        """用独立连接统计已提交的注释数"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM annotation_cache').fetchone()[0]
+        finally:
+            conn.close()
+    
+    def test_add_annotations_and_query(self):
+        """测试批量添加后可以查询到，并按当前m/z重新计算误差"""
+        self.cache_db.add_annotations(283.2635, 10, 'positive', [
+            _annotation('Oleic acid', 283.2632, 283.2635),
+            _annotation('Elaidic acid', 283.2633, 283.2635),
+        ])
+        self.assertEqual(self._count_committed(), 2)
+        
+        results = self.cache_db.query_cache(283.2634, 10, 'positive')
+        self.assertEqual([r['name'] for r in results], ['Elaidic acid', 'Oleic acid'])
+        self.assertAlmostEqual(results[1]['error_da'], 0.0002, places=8)
+    
+    def test_query_cache_deduplicates_names(self):
+        """测试不同测量m/z缓存的同一代谢物只返回一条"""
+        for measured_mz in (283.2630, 283.2640):
+            self.cache_db.add_annotation(measured_mz, 10, 'positive',
+                                         _annotation('Oleic acid', 283.2632, measured_mz))
+        
+        results = self.cache_db.query_cache(283.2635, 10, 'positive')
+        self.assertEqual([r['name'] for r in results], ['Oleic acid'])
+    
+    def test_mark_empty(self):
+        """测试无匹配记录：被覆盖的查询返回空列表，其余返回None"""
+        self.assertIsNone(self.cache_db.query_cache(100.0, 10, 'positive'))
+        
+        self.cache_db.mark_empty(100.0, 10, 'positive')
+        self.assertEqual(self.cache_db.query_cache(100.0, 10, 'positive'), [])
+        self.assertEqual(self.cache_db.query_cache(100.0003, 5, 'positive'), [])
+        self.assertIsNone(self.cache_db.query_cache(100.0003, 10, 'positive'))
+        self.assertIsNone(self.cache_db.query_cache(100.0, 10, 'negative'))
+        self.assertIsNone(self.cache_db.query_cache(100.0, 20, 'positive'))
+    
+    def test_export_import_roundtrip(self):
+        """测试导出的CSV可以重新导入"""
+        self.cache_db.add_annotations(283.2635, 10, 'positive', [
+            _annotation('Oleic acid', 283.2632, 283.2635),
+            _annotation('Elaidic acid', 283.2633, 283.2635),
+        ])
+        csv_file = str(Path(self.temp_dir) / "cache.csv")
+        self.cache_db.export_cache_to_csv(csv_file)
+        
+        other = MetaboliteCacheDB(str(Path(self.temp_dir) / "other.db"))
+        try:
+            other.import_cache_from_csv(csv_file)
+            results = other.query_cache(283.2635, 10, 'positive')
+        finally:
+            other.close()
+        
+        self.assertEqual([r['name'] for r in results], ['Elaidic acid', 'Oleic acid'])
+        self.assertEqual(results[0]['hmdb_id'], 'HMDB0000207')
+    
+    def test_transaction_defers_commit(self):
+        """测试事务内的写入在最外层结束时才提交"""
+        with self.cache_db.transaction():
+            with self.cache_db.transaction():
+                self.cache_db.add_annotation(283.2635, 10, 'positive',
+                                             _annotation('Oleic acid', 283.2632, 283.2635))
+            self.cache_db.batch_add_annotations([
+                (255.2330, 10, 'negative', _annotation('Palmitic acid', 255.2330, 255.2330)),
+            ])
+            self.assertEqual(self._count_committed(), 0)
+        
+        self.assertEqual(self._count_committed(), 2)
+    
+    def test_transaction_rollback(self):
+        """测试事务内发生异常时回滚"""
+        with self.assertRaises(RuntimeError):
+            with self.cache_db.transaction():
+                self.cache_db.add_annotation(283.2635, 10, 'positive',
+                                             _annotation('Oleic acid', 283.2632, 283.2635))
+                raise RuntimeError("中断")
+        
+        self.assertEqual(self._count_committed(), 0)
+        self.assertIsNone(self.cache_db.query_cache(283.2635, 10, 'positive'))
+
+
+if __name__ == '__main__':
+    unittest.main()
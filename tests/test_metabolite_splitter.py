@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代谢物数据拆分器单元测试
+"""
+
+import unittest
+import shutil
+import tempfile
+from pathlib import Path
+import sys
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+# 添加父目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from metabolite_splitter import MetaboliteSplitter, HAS_PYARROW
+
+try:
+    import openpyxl
+    HAS_OPENPYXL = True
+except ImportError:
+    HAS_OPENPYXL = False
+
+
+class TestMetaboliteSplitter(unittest.TestCase):
+    """代谢物数据拆分器测试"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.temp_dir = tempfile.mkdtemp()
+        
+        # 3×4 网格，按行扫描
+        xs, ys = np.meshgrid(np.arange(4) * 0.1, np.arange(3) * 0.2)
+        self.coords = np.column_stack([xs.ravel(), ys.ravel()])
+        rng = np.random.default_rng(0)
+        self.mz_bins = np.array([100.0, 200.5, 300.25, 400.125, 500.0625])
+        self.intensity_matrix = rng.uniform(0, 1000, size=(len(self.coords), len(self.mz_bins)))
+        self.intensity_matrix[:, 2] *= 10  # 强度最高的离子
+        
+        self.data = {
+            'coords': self.coords,
+            'mz_bins': self.mz_bins,
+            'intensity_matrix': self.intensity_matrix,
+        }
+        self.splitter = MetaboliteSplitter(n_processes=2, batch_size=2)
+    
+    def tearDown(self):
+        """测试后清理"""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _expected_matrix(self, column):
+        """参考实现：pandas pivot"""
+        df = pd.DataFrame({
+            'X_mm': self.coords[:, 0],
+            'Y_mm': self.coords[:, 1],
+            'value': self.intensity_matrix[:, column]
+        })
+        expected_file = Path(self.temp_dir) / f"expected_{column}.csv"
+        df.pivot(index='Y_mm', columns='X_mm', values='value').to_csv(expected_file)
+        return pd.read_csv(expected_file, index_col=0)
+    
+    def test_split_from_data(self):
+        """测试内存数据拆分输出每个代谢物的二维矩阵"""
+        result = self.splitter.split_from_data(
+            self.data, self.temp_dir, 'sample', create_archive=False
+        )
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(result['success_count'], len(self.mz_bins))
+        self.assertEqual(result['error_count'], 0)
+        
+        output_dir = Path(result['output_dir'])
+        for i, mz in enumerate(self.mz_bins):
+            output_file = output_dir / f"{mz:.4f}.csv"
+            self.assertTrue(output_file.exists())
+            
+            matrix = pd.read_csv(output_file, index_col=0)
+            expected = self._expected_matrix(i)
+            np.testing.assert_allclose(matrix.values, expected.values, rtol=1e-6)
+            np.testing.assert_allclose(matrix.index.values, expected.index.values)
+            np.testing.assert_allclose(matrix.columns.astype(float), expected.columns.astype(float))
+    
+    def test_split_from_data_top_n(self):
+        """测试按强度选择Top N个m/z"""
+        result = self.splitter.split_from_data(
+            self.data, self.temp_dir, 'sample', create_archive=True, max_mz=1
+        )
+        
+        self.assertEqual(result['metabolites_count'], 1)
+        output_files = list(Path(result['output_dir']).glob('*.csv'))
+        self.assertEqual([f.name for f in output_files], ['300.2500.csv'])
+        self.assertIsNotNone(result['zip_file'])
+        self.assertTrue(Path(result['zip_file']).exists())
+    
+    @unittest.skipUnless(HAS_OPENPYXL and HAS_PYARROW, "需要openpyxl和pyarrow")
+    def test_split_from_excel_parquet_cache(self):
+        """测试Excel拆分并写入/复用Parquet缓存"""
+        excel_file = Path(self.temp_dir) / 'sample.xlsx'
+        df = pd.DataFrame({'X_mm': self.coords[:, 0], 'Y_mm': self.coords[:, 1]})
+        for i, mz in enumerate(self.mz_bins):
+            df[f"mz_{mz:.4f}"] = self.intensity_matrix[:, i]
+        df.to_excel(excel_file, index=False)
+        
+        output_dir = Path(self.temp_dir) / 'out'
+        result = self.splitter.split_from_excel(
+            str(excel_file), str(output_dir), create_archive=False,
+            convert_to_parquet_cache=True
+        )
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(result['success_count'], len(self.mz_bins))
+        self.assertTrue(excel_file.with_suffix('.parquet').exists())
+        
+        # 第二次读取命中Parquet缓存
+        cached = self.splitter._read_table(str(excel_file))
+        pd.testing.assert_frame_equal(cached, df)
+        
+        matrix = pd.read_csv(output_dir / 'sample' / '100.0000.csv', index_col=0)
+        np.testing.assert_allclose(matrix.values, self._expected_matrix(0).values, rtol=1e-6)
+    
+    def test_split_from_csv(self):
+        """测试CSV输入一次读入后拆分"""
+        csv_file = Path(self.temp_dir) / 'sample_csv.csv'
+        df = pd.DataFrame({'X_mm': self.coords[:, 0], 'Y_mm': self.coords[:, 1]})
+        for i, mz in enumerate(self.mz_bins):
+            df[f"mz_{mz:.4f}"] = self.intensity_matrix[:, i]
+        df.to_csv(csv_file, index=False)
+        
+        output_dir = Path(self.temp_dir) / 'out'
+        result = self.splitter.split_from_excel(str(csv_file), str(output_dir),
+                                                create_archive=False)
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(result['success_count'], len(self.mz_bins))
+        for i, mz in enumerate(self.mz_bins):
+            matrix = pd.read_csv(output_dir / 'sample_csv' / f"{mz:.4f}.csv", index_col=0)
+            np.testing.assert_allclose(matrix.values, self._expected_matrix(i).values, rtol=1e-6)
+    
+    def test_split_from_feather_streaming_read_error(self):
+        """测试Feather按列组流式拆分，读取失败的列组计入失败数而不中断其余批次"""
+        df = pd.DataFrame({'X_mm': self.coords[:, 0], 'Y_mm': self.coords[:, 1]})
+        for i, mz in enumerate(self.mz_bins):
+            df[f"mz_{mz:.4f}"] = self.intensity_matrix[:, i]
+        
+        def read_columns(table_file, columns):
+            if 'mz_300.2500' in columns:
+                raise OSError("损坏的列")
+            return df[columns]
+        
+        output_dir = Path(self.temp_dir) / 'out'
+        with mock.patch.object(self.splitter, '_read_header', return_value=list(df.columns)), \
+                mock.patch.object(self.splitter, '_read_columns', side_effect=read_columns):
+            result = self.splitter.split_from_excel(str(Path(self.temp_dir) / 'sample.feather'),
+                                                    str(output_dir), create_archive=False)
+        
+        # 批大小为1、每组2列：第二组（300.25和400.125）读取失败
+        self.assertEqual(result['success_count'], 3)
+        self.assertEqual(result['error_count'], 2)
+        for i in (0, 1, 4):
+            mz = self.mz_bins[i]
+            matrix = pd.read_csv(output_dir / 'sample' / f"{mz:.4f}.csv", index_col=0)
+            np.testing.assert_allclose(matrix.values, self._expected_matrix(i).values, rtol=1e-6)
+    
+    def test_effective_batch_size(self):
+        """测试批大小按进程数自动确定"""
+        splitter = MetaboliteSplitter(n_processes=4)
+        self.assertEqual(splitter._effective_batch_size(1000), 62)
+        self.assertEqual(splitter._effective_batch_size(3), 1)
+        
+        # 指定批大小时作为上限
+        splitter = MetaboliteSplitter(n_processes=4, batch_size=50)
+        self.assertEqual(splitter._effective_batch_size(1000), 50)
+        self.assertEqual(splitter._effective_batch_size(160), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+m/z合并器单元测试
+"""
+
+import unittest
+from pathlib import Path
+import sys
+
+import numpy as np
+
+# 添加父目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from mz_merger import MzMerger
+
+
+class TestMzMerger(unittest.TestCase):
+    """m/z合并器测试"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.merger = MzMerger(tolerance_ppm=20, merge_method='weighted_mean')
+        self.mz = np.array([600.001, 500.000, 500.005, 700.0, 599.999])
+        self.intensity = np.array([100.0, 300.0, 100.0, 50.0, 300.0])
+    
+    def test_grouping(self):
+        """测试相近m/z被归为同组"""
+        result = self.merger.merge_mz_values(self.mz, self.intensity)
+        
+        self.assertEqual(result['n_merged'], 3)
+        self.assertEqual(list(result['group_sizes']), [2, 2, 1])
+        # 组ID按原始顺序返回
+        self.assertEqual(list(result['group_ids']), [1, 0, 0, 2, 1])
+    
+    def test_weighted_mean_and_intensity(self):
+        """测试加权平均m/z与强度求和"""
+        result = self.merger.merge_mz_values(self.mz, self.intensity)
+        
+        np.testing.assert_allclose(result['merged_intensity'], [400.0, 400.0, 50.0])
+        np.testing.assert_allclose(result['merged_mz'][0], 500.00125)
+        np.testing.assert_allclose(result['merged_mz'][1], 599.9995)
+    
+    def test_merge_methods(self):
+        """测试平均与中位数方法"""
+        for method in ('mean', 'median'):
+            merger = MzMerger(tolerance_ppm=20, merge_method=method)
+            result = merger.merge_mz_values(self.mz, self.intensity)
+            np.testing.assert_allclose(result['merged_mz'], [500.0025, 600.0, 700.0])
+    
+    def test_absolute_tolerance(self):
+        """测试绝对容差优先于ppm容差"""
+        merger = MzMerger(tolerance_ppm=20, tolerance_da=0.5)
+        result = merger.merge_mz_values([100.0, 100.4, 101.0, 101.3])
+        
+        self.assertEqual(result['n_merged'], 2)
+        self.assertEqual(result['merge_info'][0]['member_mz'], [100.0, 100.4])
+    
+    def test_merge_info(self):
+        """测试合并详细信息"""
+        result = self.merger.merge_mz_values(self.mz, self.intensity)
+        info = result['merge_info'][0]
+        
+        self.assertEqual(info['n_members'], 2)
+        self.assertEqual(info['mz_range'], [500.0, 500.005])
+        self.assertAlmostEqual(info['mz_std'], 0.0025)
+        self.assertEqual(info['total_intensity'], 400.0)
+    
+    def test_merge_statistics(self):
+        """测试合并统计信息"""
+        self.assertEqual(self.merger.get_merge_statistics()['n_groups'], 0)
+        
+        self.merger.merge_mz_values(self.mz, self.intensity)
+        stats = self.merger.get_merge_statistics()
+        
+        self.assertEqual(stats['n_groups'], 3)
+        self.assertEqual(stats['n_multi_member_groups'], 2)
+        self.assertAlmostEqual(stats['mean_group_size'], 5 / 3)
+        self.assertEqual(stats['max_group_size'], 2)
+        self.assertAlmostEqual(stats['min_mz'], 500.00125)
+        self.assertAlmostEqual(stats['max_mz'], 700.0)
+        self.assertEqual([g['group_id'] for g in stats['largest_groups']], [0, 1])
+    
+    def test_merge_dataset_ions(self):
+        """测试数据集离子合并后强度矩阵按组求和"""
+        rng = np.random.default_rng(0)
+        intensity_matrix = rng.uniform(0, 100, size=(6, len(self.mz)))
+        intensity_matrix[:, 3] = 0  # 700.0 被强度阈值过滤
+        data = {
+            'sample_name': 'S1',
+            'mz_bins': self.mz,
+            'intensity_matrix': intensity_matrix,
+        }
+        
+        merged = self.merger.merge_dataset_ions(data, intensity_threshold=0)
+        
+        self.assertEqual(merged['n_bins'], 2)
+        self.assertEqual(merged['intensity_matrix'].shape, (6, 2))
+        np.testing.assert_allclose(merged['intensity_matrix'][:, 0],
+                                   intensity_matrix[:, 1] + intensity_matrix[:, 2], rtol=1e-6)
+        np.testing.assert_allclose(merged['intensity_matrix'][:, 1],
+                                   intensity_matrix[:, 0] + intensity_matrix[:, 4], rtol=1e-6)
+    
+    def test_merge_dataset_ions_sorted_bins(self):
+        """测试已排序m/z bins（分段求和路径）与未排序结果一致"""
+        rng = np.random.default_rng(1)
+        order = np.argsort(self.mz)
+        intensity_matrix = rng.uniform(0, 100, size=(4, len(self.mz)))
+        
+        unsorted = self.merger.merge_dataset_ions(
+            {'mz_bins': self.mz, 'intensity_matrix': intensity_matrix})
+        sorted_ = self.merger.merge_dataset_ions(
+            {'mz_bins': self.mz[order], 'intensity_matrix': intensity_matrix[:, order]})
+        
+        self.assertEqual(sorted_['intensity_matrix'].dtype, np.float32)
+        np.testing.assert_allclose(sorted_['mz_bins'], unsorted['mz_bins'])
+        np.testing.assert_allclose(sorted_['intensity_matrix'], unsorted['intensity_matrix'],
+                                   rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
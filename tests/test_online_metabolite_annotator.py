@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+在线代谢物注释器单元测试
+"""
+
+import os
+import unittest
+import shutil
+import tempfile
+from pathlib import Path
+import sys
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+# 添加父目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import online_metabolite_annotator
+from online_metabolite_annotator import OnlineMetaboliteAnnotator
+
+
+class TestOnlineMetaboliteAnnotator(unittest.TestCase):
+    """在线代谢物注释器测试"""
+    
+    def setUp(self):
+        """测试前准备：创建临时HMDB CSV文件"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.hmdb_csv_file = str(Path(self.temp_dir) / "hmdb_metabolites.csv")
+        
+        pd.DataFrame([
+            {'name': 'Palmitic acid', 'formula': 'C16H32O2', 'hmdb_id': 'HMDB0000220',
+             'mz_positive': 257.2475, 'mz_negative': 255.2330},
+            {'name': 'Oleic acid', 'formula': 'C18H34O2', 'hmdb_id': 'HMDB0000207',
+             'mz_positive': 283.2632, 'mz_negative': 281.2486},
+            {'name': 'Elaidic acid', 'formula': 'C18H34O2', 'hmdb_id': 'HMDB0000573',
+             'mz_positive': 283.2632, 'mz_negative': 281.2486},
+            {'name': 'Stearic acid', 'formula': 'C18H36O2', 'hmdb_id': 'HMDB0000827',
+             'mz_positive': 285.2788, 'mz_negative': 283.2643},
+            {'name': 'Glucose', 'formula': 'C6H12O6', 'hmdb_id': 'HMDB0000122',
+             'mz_positive': 181.0707, 'mz_negative': None},
+            {'name': 'Unnamed feature', 'formula': None, 'hmdb_id': None,
+             'mz_positive': 500.1234, 'mz_negative': 498.1088},
+        ]).to_csv(self.hmdb_csv_file, index=False)
+        
+        self.memory_cache_file = str(Path(self.temp_dir) / "annotation_cache.pkl")
+        self.annotator = self._create_annotator()
+    
+    def _create_annotator(self):
+        """创建只使用临时文件的注释器"""
+        annotator = OnlineMetaboliteAnnotator(use_cache_db=False,
+                                              hmdb_csv_file=self.hmdb_csv_file,
+                                              memory_cache_file=self.memory_cache_file)
+        # 只测试CSV数据源
+        annotator.hmdb_db = None
+        return annotator
+    
+    def tearDown(self):
+        """测试后清理"""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_read_hmdb_csv_readers_agree(self):
+        """测试各CSV读取器返回相同的列数据"""
+        columns = OnlineMetaboliteAnnotator._read_hmdb_csv(self.hmdb_csv_file)
+        
+        with mock.patch.object(online_metabolite_annotator, 'HAS_POLARS', False), \
+                mock.patch.object(online_metabolite_annotator, 'HAS_PYARROW', False):
+            pandas_columns = OnlineMetaboliteAnnotator._read_hmdb_csv(self.hmdb_csv_file)
+        
+        self.assertEqual(set(columns), set(pandas_columns))
+        for col in ('name', 'formula', 'hmdb_id'):
+            self.assertEqual(list(columns[col]), list(pandas_columns[col]))
+        for col in ('mz_positive', 'mz_negative'):
+            self.assertEqual(columns[col].dtype, np.float64)
+            np.testing.assert_array_equal(columns[col], pandas_columns[col])
+        self.assertTrue(np.isnan(columns['mz_negative'][4]))
+        # 空文本在所有读取器中都是空字符串
+        self.assertEqual((columns['formula'][5], columns['hmdb_id'][5]), ('', ''))
+        
+        # 字典编码的分子式列中相同的值共用同一个字符串对象
+        for formulas in (columns['formula'], pandas_columns['formula']):
+            self.assertIs(formulas[1], formulas[2])
+    
+    def test_read_hmdb_csv_with_bom(self):
+        """测试带UTF-8 BOM的CSV首列（名称）不会被丢弃"""
+        bom_file = str(Path(self.temp_dir) / "hmdb_bom.csv")
+        pd.read_csv(self.hmdb_csv_file).to_csv(bom_file, index=False, encoding='utf-8-sig')
+        
+        for has_reader in (True, False):
+            with mock.patch.object(online_metabolite_annotator, 'HAS_POLARS',
+                                   has_reader and online_metabolite_annotator.HAS_POLARS), \
+                    mock.patch.object(online_metabolite_annotator, 'HAS_PYARROW',
+                                      has_reader and online_metabolite_annotator.HAS_PYARROW):
+                columns = OnlineMetaboliteAnnotator._read_hmdb_csv(bom_file)
+            self.assertEqual(columns['name'][0], 'Palmitic acid')
+        
+        annotator = OnlineMetaboliteAnnotator(use_cache_db=False, hmdb_csv_file=bom_file,
+                                              memory_cache_file=self.memory_cache_file)
+        annotator.hmdb_db = None
+        results = annotator.annotate_mz(257.2470, tolerance_ppm=10, ion_mode='positive')
+        self.assertEqual(results[0]['name'], 'Palmitic acid')
+    
+    def test_query_hmdb_range(self):
+        """测试HMDB CSV按ppm范围查询"""
+        results = self.annotator._query_hmdb(283.2635, 10, 'positive')
+        
+        self.assertEqual(sorted(r['name'] for r in results), ['Elaidic acid', 'Oleic acid'])
+        for result in results:
+            self.assertEqual(result['source'], 'HMDB')
+            self.assertAlmostEqual(result['theoretical_mz'], 283.2632)
+            self.assertAlmostEqual(result['error_da'], 0.0003, places=6)
+            self.assertAlmostEqual(result['error_ppm'], 0.0003 / 283.2632 * 1e6, places=4)
+    
+    def test_query_hmdb_strip_index_matches_full_search(self):
+        """测试条带索引查询与在整个数组上查找的结果一致（含跨条带的窗口）"""
+        rng = np.random.default_rng(1)
+        masses = np.concatenate([rng.uniform(50, 1200, 3000), [99.9999, 100.0, 100.0001]])
+        pd.DataFrame({
+            'name': [f"M{i}" for i in range(len(masses))],
+            'formula': '', 'hmdb_id': '',
+            'mz_positive': masses, 'mz_negative': masses,
+        }).to_csv(self.hmdb_csv_file, index=False)
+        annotator = self._create_annotator()
+        
+        sorted_masses = np.sort(masses)
+        queries = np.concatenate([rng.uniform(40, 1250, 300), [100.0, 5.0, 2000.0]])
+        for mz in queries:
+            for tolerance_ppm in (5, 200):
+                tolerance_da = tolerance_ppm / 1e6 * mz
+                expected = sorted_masses[(sorted_masses >= mz - tolerance_da) &
+                                         (sorted_masses <= mz + tolerance_da)]
+                results = annotator._query_hmdb(float(mz), tolerance_ppm, 'positive')
+                np.testing.assert_array_equal([r['theoretical_mz'] for r in results], expected)
+    
+    def test_query_hmdb_ion_mode(self):
+        """测试离子模式选择对应的m/z列，并跳过缺失值"""
+        results = self.annotator._query_hmdb(283.2640, 10, 'negative')
+        self.assertEqual([r['name'] for r in results], ['Stearic acid'])
+        
+        self.assertEqual(self.annotator._query_hmdb(181.0707, 10, 'negative'), [])
+        self.assertEqual(self.annotator._query_hmdb(100.0, 10, 'positive'), [])
+    
+    def test_missing_hmdb_file(self):
+        """测试HMDB文件不存在时返回空结果"""
+        annotator = self._create_annotator()
+        annotator.hmdb_csv_file = str(Path(self.temp_dir) / "missing.csv")
+        self.assertEqual(annotator._query_hmdb(283.2635, 10, 'positive'), [])
+    
+    def test_annotate_mz_sorted_and_cached(self):
+        """测试单个m/z注释结果按误差排序并写入内存缓存"""
+        results = self.annotator.annotate_mz(283.2638, tolerance_ppm=10, ion_mode='negative')
+        
+        self.assertEqual([r['name'] for r in results], ['Stearic acid'])
+        self.assertEqual(self.annotator.stats['new_queries'], 1)
+        
+        again = self.annotator.annotate_mz(283.2638, tolerance_ppm=10, ion_mode='negative')
+        self.assertEqual(again, results)
+        self.assertEqual(self.annotator.stats['memory_cache_hits'], 1)
+    
+    def test_memory_cache_near_duplicate_hit(self):
+        """测试同一桶内的相近m/z命中内存缓存，并按当前m/z重新计算误差"""
+        self.annotator.annotate_mz(283.26350, tolerance_ppm=10, ion_mode='positive')
+        results = self.annotator.annotate_mz(283.26351, tolerance_ppm=10, ion_mode='positive')
+        
+        self.assertEqual(self.annotator.stats['memory_cache_hits'], 1)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertEqual(result['measured_mz'], 283.26351)
+            self.assertAlmostEqual(result['error_da'], 0.00031, places=8)
+        
+        # 容差不同时不命中
+        self.annotator.annotate_mz(283.26350, tolerance_ppm=5, ion_mode='positive')
+        self.assertEqual(self.annotator.stats['memory_cache_hits'], 1)
+    
+    def test_memory_cache_lru_eviction(self):
+        """测试内存缓存超出容量时淘汰最久未使用的条目"""
+        annotator = OnlineMetaboliteAnnotator(use_cache_db=False,
+                                              hmdb_csv_file=self.hmdb_csv_file,
+                                              memory_cache_file=self.memory_cache_file,
+                                              memory_cache_size=2)
+        annotator.hmdb_db = None
+        
+        annotator.annotate_mz(257.2475, ion_mode='positive')
+        annotator.annotate_mz(283.2632, ion_mode='positive')
+        annotator.annotate_mz(257.2475, ion_mode='positive')  # 命中并刷新为最近使用
+        annotator.annotate_mz(285.2788, ion_mode='positive')  # 淘汰 283.2632
+        self.assertEqual(annotator.stats['memory_cache_hits'], 1)
+        self.assertEqual(len(annotator.memory_cache), 2)
+        
+        annotator.annotate_mz(257.2475, ion_mode='positive')
+        annotator.annotate_mz(283.2632, ion_mode='positive')
+        self.assertEqual(annotator.stats['memory_cache_hits'], 2)
+    
+    def test_memory_cache_persisted(self):
+        """测试内存缓存在close()时保存并在下次启动时载入"""
+        results = self.annotator.annotate_mz(257.2470, tolerance_ppm=10, ion_mode='positive')
+        self.annotator.close()
+        
+        annotator = self._create_annotator()
+        self.assertEqual(annotator.annotate_mz(257.2470, tolerance_ppm=10, ion_mode='positive'),
+                         results)
+        self.assertEqual(annotator.stats['memory_cache_hits'], 1)
+    
+    def test_memory_cache_saved_after_batch_annotate(self):
+        """测试批量注释结束后即写入内存缓存快照，无需调用close()"""
+        annotations = self.annotator.batch_annotate([257.2470], tolerance_ppm=10,
+                                                    ion_mode='positive')
+        
+        annotator = self._create_annotator()
+        self.assertEqual(annotator.annotate_mz(257.2470, tolerance_ppm=10, ion_mode='positive'),
+                         annotations[257.2470])
+        self.assertEqual(annotator.stats['memory_cache_hits'], 1)
+    
+    def test_memory_cache_invalidated_by_newer_hmdb_file(self):
+        """测试HMDB文件更新后丢弃旧的内存缓存快照"""
+        self.annotator.annotate_mz(257.2470, tolerance_ppm=10, ion_mode='positive')
+        self.annotator.close()
+        
+        mtime = Path(self.memory_cache_file).stat().st_mtime
+        os.utime(self.hmdb_csv_file, (mtime + 10, mtime + 10))
+        
+        self.assertEqual(self._create_annotator().memory_cache, {})
+    
+    def test_annotate_mz_dedup_keeps_best_error(self):
+        """测试同名结果去重时保留误差最小的一条"""
+        worse = {'name': 'Oleic acid', 'formula': 'C18H34O2', 'hmdb_id': '',
+                 'theoretical_mz': 283.2650, 'measured_mz': 283.2635,
+                 'error_ppm': 5.3, 'error_da': 0.0015, 'source': 'Local'}
+        better = dict(worse, theoretical_mz=283.2636, error_ppm=0.35, error_da=0.0001)
+        self.annotator._query_local_database = lambda mz, tol, mode: [worse, better]
+        
+        results = self.annotator.annotate_mz(283.2635, tolerance_ppm=10, ion_mode='positive')
+        
+        self.assertEqual([r['name'] for r in results], ['Oleic acid', 'Elaidic acid'])
+        self.assertEqual(results[0]['source'], 'Local')
+        self.assertEqual(results[0]['error_ppm'], 0.35)
+    
+    def test_batch_annotate(self):
+        """测试批量注释"""
+        mz_list = [283.2635, 100.0, 257.2470]
+        annotations = self.annotator.batch_annotate(mz_list, tolerance_ppm=10, ion_mode='positive')
+        
+        self.assertEqual(list(annotations.keys()), mz_list)
+        self.assertEqual(len(annotations[283.2635]), 2)
+        self.assertEqual(annotations[100.0], [])
+        self.assertEqual(annotations[257.2470][0]['name'], 'Palmitic acid')
+    
+    def test_batch_annotate_threaded_with_cache_db(self):
+        """测试多线程批量注释与单线程结果一致，并写入数据库缓存"""
+        from metabolite_cache_db import MetaboliteCacheDB
+        
+        rng = np.random.default_rng(0)
+        mz_list = [float(mz) for mz in rng.choice([257.2475, 283.2635, 285.2790, 100.0], 200)
+                   + rng.normal(0, 0.0005, 200)]
+        
+        serial = self.annotator.batch_annotate(mz_list, ion_mode='positive', n_workers=1)
+        
+        annotator = OnlineMetaboliteAnnotator(use_cache_db=False,
+                                              hmdb_csv_file=self.hmdb_csv_file,
+                                              memory_cache_file=str(Path(self.temp_dir) / "threaded.pkl"))
+        annotator.hmdb_db = None
+        annotator.cache_db = MetaboliteCacheDB(str(Path(self.temp_dir) / "cache.db"))
+        annotator.use_cache_db = True
+        try:
+            threaded = annotator.batch_annotate(mz_list, ion_mode='positive', n_workers=8)
+            self.assertGreater(annotator.cache_db.get_stats()['total_cached_annotations'], 0)
+        finally:
+            annotator.cache_db.close()
+        
+        self.assertEqual(list(threaded.keys()), list(serial.keys()))
+        for mz in mz_list:
+            self.assertEqual([r['name'] for r in threaded[mz]], [r['name'] for r in serial[mz]])
+        self.assertEqual(annotator.stats['total_queries'], len(mz_list))
+    
+    def test_batch_annotate_vectorized_matches_single(self):
+        """测试批量向量化查询与逐个查询结果一致（含乱序与重复m/z）"""
+        mz_array = np.array([285.2790, 100.0, 283.2635, 257.2470, 283.2635])
+        batch = self.annotator._batch_annotate_vectorized(mz_array, 10, 'positive')
+        
+        self.assertEqual(len(batch), len(mz_array))
+        for mz, results in zip(mz_array, batch):
+            self.assertEqual(results, self.annotator._query_hmdb(float(mz), 10, 'positive'))
+    
+    def test_max_results_and_best_only(self):
+        """测试限制返回数量与只返回最佳匹配"""
+        results = self.annotator.annotate_mz(283.2634, tolerance_ppm=10, ion_mode='positive',
+                                             max_results=1)
+        self.assertEqual(len(results), 1)
+        
+        # 截取不影响缓存中的完整结果
+        self.assertEqual(len(self.annotator.annotate_mz(283.2634, ion_mode='positive')), 2)
+        
+        best = self.annotator.batch_annotate([257.2470, 100.0], ion_mode='positive', best_only=True)
+        self.assertEqual(best[257.2470]['name'], 'Palmitic acid')
+        self.assertIsNone(best[100.0])
+    
+    def test_early_exit_skips_local_database(self):
+        """测试找到足够好的匹配后不再查询本地数据库，且不完整的结果不写入缓存"""
+        local_queries = []
+        
+        class FakeMetaboliteDatabase:
+            def search(self, mz, tolerance_ppm, ion_mode):
+                local_queries.append(mz)
+                return []
+        
+        fake_module = type(sys)('metabolite_db')
+        fake_module.MetaboliteDatabase = FakeMetaboliteDatabase
+        with mock.patch.dict(sys.modules, {'metabolite_db': fake_module}):
+            results = self.annotator.annotate_mz(257.2475, ion_mode='positive', early_exit_ppm=1)
+            self.assertEqual(results[0]['name'], 'Palmitic acid')
+            self.assertEqual(local_queries, [])
+            self.assertEqual(len(self.annotator.memory_cache), 0)
+            
+            self.annotator.annotate_mz(257.2475, ion_mode='positive')
+            self.assertEqual(local_queries, [257.2475])
+    
+    def test_source_pipeline_promotes_results(self):
+        """测试HMDB数据库的结果写回内存缓存和数据库缓存"""
+        from metabolite_cache_db import MetaboliteCacheDB
+        
+        hmdb_db = mock.Mock(db_available=True)
+        hmdb_db.search.side_effect = lambda mz, tol, mode: (
+            [{'name': 'Oleic acid', 'formula': 'C18H34O2', 'hmdb_id': 'HMDB0000207',
+              'theoretical_mz': 283.2632, 'measured_mz': mz,
+              'error_ppm': abs(mz - 283.2632) / 283.2632 * 1e6,
+              'error_da': abs(mz - 283.2632), 'source': 'HMDB'}] if mz > 200 else []
+        )
+        self.annotator.hmdb_db = hmdb_db
+        self.annotator.cache_db = MetaboliteCacheDB(str(Path(self.temp_dir) / "cache.db"))
+        self.annotator.use_cache_db = True
+        try:
+            self.annotator.annotate_mz(283.2635, ion_mode='positive')
+            self.annotator.annotate_mz(100.0, ion_mode='positive')
+            self.annotator.annotate_mz(283.2635, ion_mode='positive')
+            
+            self.assertEqual(hmdb_db.search.call_count, 2)
+            self.assertEqual(self.annotator.stats['hmdb_db_hits'], 1)
+            self.assertEqual(self.annotator.stats['new_queries'], 1)
+            self.assertEqual(self.annotator.stats['memory_cache_hits'], 1)
+            
+            self.annotator.memory_cache.clear()
+            self.assertEqual(self.annotator.annotate_mz(100.0, ion_mode='positive'), [])
+            self.assertEqual(len(self.annotator.annotate_mz(283.2635, ion_mode='positive')), 1)
+            self.assertEqual(self.annotator.stats['db_cache_hits'], 2)
+            self.assertEqual(hmdb_db.search.call_count, 2)
+        finally:
+            self.annotator.cache_db.close()
+    
+    def test_batch_query_columns(self):
+        """测试列式批量查询结果的布局与误差计算"""
+        mz_array = np.array([285.2790, 100.0, 283.2635])
+        columns = self.annotator._batch_query_columns(mz_array, 10, 'positive')
+        
+        np.testing.assert_array_equal(columns['query_index'], [2, 2, 0])
+        self.assertEqual(list(columns['name']), ['Oleic acid', 'Elaidic acid', 'Stearic acid'])
+        np.testing.assert_allclose(columns['error_da'], [0.0003, 0.0003, 0.0002], atol=1e-9)
+        np.testing.assert_allclose(columns['error_ppm'],
+                                   columns['error_da'] / columns['theoretical_mz'] * 1e6)
+    
+    def test_local_database_created_once(self):
+        """测试本地代谢物数据库只创建一次并被复用"""
+        created = []
+        
+        class FakeMetaboliteDatabase:
+            def __init__(self):
+                created.append(self)
+            
+            def search(self, mz, tolerance_ppm, ion_mode):
+                return [{'name': 'Local compound', 'formula': 'C1', 'theoretical_mz': mz,
+                         'measured_mz': mz, 'error_ppm': 0.0, 'error_da': 0.0}]
+        
+        fake_module = type(sys)('metabolite_db')
+        fake_module.MetaboliteDatabase = FakeMetaboliteDatabase
+        with mock.patch.dict(sys.modules, {'metabolite_db': fake_module}):
+            for mz in (100.0, 200.0, 300.0):
+                results = self.annotator.annotate_mz(mz, ion_mode='positive')
+                self.assertEqual(results[0]['source'], 'Local')
+        
+        self.assertEqual(len(created), 1)
+    
+    def test_export_annotations_to_csv(self):
+        """测试导出注释结果到CSV"""
+        annotations = self.annotator.batch_annotate([257.2470, 100.0], ion_mode='positive')
+        output_file = Path(self.temp_dir) / "annotations.csv"
+        self.annotator.export_annotations_to_csv(annotations, str(output_file))
+        
+        df = pd.read_csv(output_file, encoding='utf-8-sig', keep_default_na=False)
+        self.assertEqual(list(df.columns), ['measured_mz', 'metabolite_name', 'formula', 'hmdb_id',
+                                            'theoretical_mz', 'error_ppm', 'error_da', 'source'])
+        self.assertEqual(list(df['metabolite_name']), ['Palmitic acid', '未匹配'])
+        self.assertEqual(df['hmdb_id'][0], 'HMDB0000220')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+季度计费工作流程测试
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import pytest
+from contextlib import contextmanager
+from datetime import datetime
+
+import quarterly_billing_workflow
+from database_manager import DatabaseManager
+from quarterly_billing_workflow import QuarterlyBillingWorkflow, HAS_ORJSON
+
+
+CUSTOMER_ID = 'CUST-TEST0001'
+LICENSE_KEY = 'LIC-TEST-0001'
+
+
+class PlainEncryptor:
+    """不加密的报告编解码器，只用于测试报告读写流程"""
+    
+    def encrypt_with_license(self, data: str, license_key: str) -> bytes:
+        return data.encode('utf-8')
+    
+    def decrypt_with_multiple_keys(self, encrypted_data: bytes) -> bytes:
+        assert isinstance(encrypted_data, bytes)
+        return encrypted_data
+
+
+@contextmanager
+def temp_workflow_context():
+    """创建带测试客户和使用记录的临时工作流程"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    
+    db = DatabaseManager(db_path=path, mode='admin')
+    now = datetime.now().isoformat()
+    db.create_customer({
+        'customer_id': CUSTOMER_ID,
+        'name': '测试客户',
+        'email': 'test@example.com',
+        'company': '测试公司',
+        'license_key': LICENSE_KEY,
+        'created_at': now,
+        'expires_at': '2025-12-31',
+    })
+    for report_date, samples in (('2025-01-15', 12), ('2025-02-20', 30), ('2025-05-01', 7)):
+        db.add_usage_record({
+            'customer_id': CUSTOMER_ID,
+            'license_key': LICENSE_KEY,
+            'report_date': report_date,
+            'total_samples_loaded': samples,
+            'total_exports': 2,
+            'total_splits': 1,
+            'unique_samples': samples // 2,
+            'imported_at': now,
+        })
+    
+    workflow = QuarterlyBillingWorkflow(db)
+    workflow.encryptor = PlainEncryptor()
+    
+    try:
+        yield workflow
+    finally:
+        db.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def test_export_import_roundtrip(tmp_path):
+    """测试导出的季度报告可以被重新解析"""
+    report_file = str(tmp_path / 'report.enc')
+    
+    with temp_workflow_context() as workflow:
+        report = workflow.export_quarterly_report(CUSTOMER_ID, '2025-Q1', report_file)
+        assert report['usage_summary']['total_samples_loaded'] == 42
+        assert report['usage_summary']['report_count'] == 2
+        
+        # 数据库中已有该年度记录，导入会被判定为重复，但报告内容应完整解析
+        success, message, imported = workflow.import_quarterly_report(report_file)
+    
+    assert not success
+    assert imported == report
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_report_checksum_independent_of_backend(monkeypatch, use_orjson):
+    """测试orjson与标准库计算的校验和一致"""
+    if use_orjson and not HAS_ORJSON:
+        pytest.skip("未安装orjson")
+    
+    with temp_workflow_context() as workflow:
+        records = workflow.db.fetchall('SELECT * FROM usage_records ORDER BY report_date')
+        monkeypatch.setattr(quarterly_billing_workflow, 'HAS_ORJSON', use_orjson)
+        checksum = workflow._calculate_report_checksum(records)
+    
+    expected = ''.join(json.dumps(list(r), ensure_ascii=False, separators=(',', ':'))
+                       for r in records)
+    assert checksum == hashlib.sha256(expected.encode('utf-8')).hexdigest()
+
+
+@pytest.mark.parametrize('quarter, expected', [
+    ('2025-Q1', ('2025-01-01', '2025-03-31')),
+    ('2025-Q2', ('2025-04-01', '2025-06-30')),
+    ('2025-Q3', ('2025-07-01', '2025-09-30')),
+    ('2025-Q4', ('2025-10-01', '2025-12-31')),
+])
+def test_get_quarter_info(quarter, expected):
+    """测试季度字符串解析"""
+    workflow = QuarterlyBillingWorkflow.__new__(QuarterlyBillingWorkflow)
+    assert workflow.get_quarter_info(quarter) == expected
+
+
+def test_generate_quarterly_invoice_totals():
+    """测试季度账单按SQL汇总的样本数计费"""
+    with temp_workflow_context() as workflow:
+        invoice = workflow.generate_quarterly_invoice(CUSTOMER_ID, '2025-Q1', unit_price=2.0)
+        empty = workflow.generate_quarterly_invoice(CUSTOMER_ID, '2025-Q3', unit_price=2.0)
+    
+    assert invoice['total_samples'] == 42
+    assert invoice['subtotal'] == pytest.approx(84.0)
+    assert empty['total_samples'] == 0
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_saved_report_matches_report(monkeypatch, tmp_path, use_orjson):
+    """测试保存的报告JSON与导出的报告内容一致"""
+    if use_orjson and not HAS_ORJSON:
+        pytest.skip("未安装orjson")
+    
+    report_file = str(tmp_path / 'report.enc')
+    with temp_workflow_context() as workflow:
+        monkeypatch.setattr(quarterly_billing_workflow, 'HAS_ORJSON', use_orjson)
+        report = workflow.export_quarterly_report(CUSTOMER_ID, '2025-Q1', report_file)
+    
+    with open(report_file, encoding='utf-8') as f:
+        assert json.load(f) == report
+
+
+def test_verify_report_integrity_detects_tampering():
+    """测试篡改使用明细后完整性验证失败"""
+    with temp_workflow_context() as workflow:
+        report = workflow.export_quarterly_report(CUSTOMER_ID, '2025-Q1')
+        assert workflow._verify_report_integrity(report)
+        
+        report['usage_details'][0]['samples_loaded'] = 1
+        assert not workflow._verify_report_integrity(report)
+
+
+def test_usage_range_queries_use_covering_index():
+    """测试季度范围查询只读覆盖索引且无需额外排序"""
+    with temp_workflow_context() as workflow:
+        plan = workflow.db.fetchall('''
+            EXPLAIN QUERY PLAN
+            SELECT report_date, total_samples_loaded, total_exports,
+                   total_splits, unique_samples
+            FROM usage_records
+            WHERE customer_id = ?
+            AND report_date >= ? AND report_date <= ?
+            ORDER BY report_date
+        ''', (CUSTOMER_ID, '2025-01-01', '2025-03-31'))
+    
+    details = ' '.join(row['detail'] for row in plan)
+    assert 'COVERING INDEX idx_usage_cust_date' in details
+    assert 'TEMP B-TREE' not in details
+
+
+def test_import_accepts_report_for_new_year(tmp_path):
+    """测试导入前的重复检查只匹配同一年份的记录"""
+    report_file = str(tmp_path / 'report.enc')
+    
+    with temp_workflow_context() as workflow:
+        workflow.export_quarterly_report(CUSTOMER_ID, '2026-Q1', report_file)
+        success, message, report = workflow.import_quarterly_report(report_file)
+    
+    assert success, message
+    assert report['quarter'] == '2026-Q1'
+
+
+def test_billing_cycle_reads_customer_once(monkeypatch, tmp_path):
+    """测试完整计费周期只查询一次客户信息，配置文件使用延长后的到期时间"""
+    monkeypatch.chdir(tmp_path)
+    report_file = str(tmp_path / 'report.enc')
+    
+    with temp_workflow_context() as workflow:
+        workflow.export_quarterly_report(CUSTOMER_ID, '2026-Q1', report_file)
+        
+        calls = []
+        get_customer = workflow.db.get_customer
+        monkeypatch.setattr(workflow.db, 'get_customer',
+                            lambda cid: calls.append(cid) or get_customer(cid))
+        
+        result = workflow.complete_quarterly_billing_cycle(
+            CUSTOMER_ID, '2026-Q1', report_file, unit_price=2.0
+        )
+        config = (tmp_path / result['config_file']).read_text()
+    
+    assert result['success'], result['steps']
+    assert calls == [CUSTOMER_ID]
+    assert f"expires_at={result['new_expires']}T23:59:59" in config
+
+
+def test_extend_license_after_payment():
+    """测试未过期License在原到期时间基础上延长"""
+    with temp_workflow_context() as workflow:
+        workflow.db.update_customer(CUSTOMER_ID, {'expires_at': '2999-01-15'})
+        success, new_expires = workflow.extend_license_after_payment(CUSTOMER_ID)
+        customer = workflow.db.get_customer(CUSTOMER_ID)
+    
+    assert success
+    assert new_expires == '2999-04-15'
+    assert customer['expires_at'] == new_expires
+
+
+def test_generate_quarterly_invoices_batch():
+    """测试批量生成账单与逐个生成结果一致，并全部写入数据库"""
+    with temp_workflow_context() as workflow:
+        workflow.db.create_customer({
+            'customer_id': 'CUST-TEST0002',
+            'name': '空客户',
+            'email': 'empty@example.com',
+            'license_key': 'LIC-TEST-0002',
+            'unit_price': 3.0,
+            'created_at': datetime.now().isoformat(),
+            'expires_at': '2025-12-31',
+        })
+        
+        invoices = workflow.generate_quarterly_invoices_batch(
+            [CUSTOMER_ID, 'CUST-TEST0002'], '2025-Q1'
+        )
+        stored = workflow.db.list_invoices()
+        
+        with pytest.raises(ValueError):
+            workflow.generate_quarterly_invoices_batch(['CUST-MISSING'], '2025-Q1')
+    
+    assert [i['total_samples'] for i in invoices] == [42, 0]
+    assert invoices[0]['subtotal'] == pytest.approx(420.0)
+    assert invoices[1]['unit_price'] == 3.0
+    assert sorted(i['invoice_id'] for i in stored) == sorted(i['invoice_id'] for i in invoices)
+
+
+def test_verify_rejects_unsupported_checksum_algorithm():
+    """测试报告固定使用SHA-256校验，其他算法拒绝导入"""
+    with temp_workflow_context() as workflow:
+        report = workflow.export_quarterly_report(CUSTOMER_ID, '2025-Q1')
+    
+    assert report['integrity']['algorithm'] == 'sha256'
+    assert workflow._verify_report_integrity(report)
+    
+    for algorithm in ('crc32c', 'md5'):
+        report['integrity']['algorithm'] = algorithm
+        assert not workflow._verify_report_integrity(report)
+
+
+@pytest.mark.parametrize('field', ['report_type', 'customer_id', 'integrity'])
+def test_verify_rejects_incomplete_report(field):
+    """测试缺少报告类型或必需字段时完整性验证失败"""
+    with temp_workflow_context() as workflow:
+        report = workflow.export_quarterly_report(CUSTOMER_ID, '2025-Q1')
+        del report[field]
+        assert not workflow._verify_report_integrity(report)
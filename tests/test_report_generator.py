@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+报告生成器测试
+"""
+
+import numpy as np
+import pytest
+
+from report_generator import ReportGenerator
+
+
+@pytest.fixture
+def generator():
+    return ReportGenerator()
+
+
+def test_top_ions_sheet_sorted_by_intensity(generator):
+    """测试高强度离子表按强度降序取前50个"""
+    rng = np.random.default_rng(0)
+    intensities = rng.random(500)
+    mz_bins = np.linspace(100.0, 600.0, 500)
+
+    sheet = generator._create_top_ions_sheet({'mz_bins': list(mz_bins),
+                                              'mean_intensity': list(intensities)})
+
+    order = np.argsort(-intensities)[:50]
+    assert list(sheet['排名']) == list(range(1, 51))
+    np.testing.assert_allclose(sheet['强度'], intensities[order])
+    np.testing.assert_allclose(sheet['m/z'], mz_bins[order])
+
+
+def test_top_ions_sheet_fewer_than_50(generator):
+    """测试离子数少于50个时全部列出"""
+    sheet = generator._create_top_ions_sheet({'mz_bins': [100.0, 200.0, 300.0],
+                                              'mean_intensity': [5.0, 9.0, 1.0]})
+
+    assert list(sheet['m/z']) == [200.0, 100.0, 300.0]
+
+
+def test_ion_stats_sheet_without_optional_columns(generator):
+    """测试缺少最大强度和变异系数时以0填充，行数与离子数一致"""
+    sheet = generator._create_ion_stats_sheet({'mz_bins': [100.0, 200.0],
+                                               'mean_intensity': [5.0, 9.0]})
+
+    assert len(sheet) == 2
+    assert list(sheet['最大强度']) == [0.0, 0.0]
+    assert list(sheet['变异系数']) == [0.0, 0.0]
+
+
+def test_generate_excel_report(generator, tmp_path):
+    """测试Excel报告包含三个工作表且高强度离子按强度排序"""
+    import pandas as pd
+
+    filename = str(tmp_path / 'report.xlsx')
+    generator.generate_excel_report({
+        'filename': 'sample.raw',
+        'scan_count': 3,
+        'ion_count': 3,
+        'mz_bins': [100.0, 200.0, 300.0],
+        'mean_intensity': [5.0, 9.0, 1.0],
+    }, filename)
+
+    sheets = pd.read_excel(filename, sheet_name=None)
+    assert list(sheets) == ['样本信息', '离子统计', '高强度离子']
+    assert list(sheets['高强度离子']['m/z']) == [200.0, 100.0, 300.0]
+
+
+def test_comparison_text_report_keeps_sample_order(generator):
+    """测试多样本对比报告按输入顺序列出各样本"""
+    data_list = [{'scan_count': i, 'ion_count': 10 * i} for i in range(1, 6)]
+    labels = [f"S{i}" for i in range(1, 6)]
+
+    content = generator._generate_comparison_text_report(data_list, labels)
+
+    lines = content.split("\n")
+    assert lines[:4] == ["=" * 60, "DESI多样本对比分析报告", "=" * 60, ""]
+    assert [line for line in lines if line.startswith("🔬")] == \
+        [f"🔬 样本 {i}: S{i}" for i in range(1, 6)]
+    assert lines[4:8] == ["🔬 样本 1: S1", "   扫描点数: 1", "   离子数: 10", ""]
+    assert lines[-2:] == ["[FILE] 注意: 这是简化的文本报告，完整的PDF对比报告功能正在开发中", "=" * 60]